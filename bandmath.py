@@ -0,0 +1,209 @@
+# Band math.
+#
+# Evaluate an expression over named source bands one block at a time and write
+# the result to a destination band. Blocks are read and evaluated by a thread
+# pool, each thread with its own handle on the source dataset, and handed back
+# in order to the calling thread which writes them to the destination band.
+# Every block in flight has its own set of preallocated buffers that are reused
+# for later blocks. Invalid pixels are tracked with a boolean mask and filled
+# with the destination nodata value, no masked arrays are created.
+#
+# Example, NDVI from bands 2 (red) and 3 (near infrared):
+#
+#   result = bandmath.band_math(SRC_RASTERFILE, dstBand, bandmath.NDVI,
+#                               {'red': 2, 'nir': 3}, NO_DATA_VALUE)
+
+import gdal
+import numpy as np
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import blockcache
+import utils
+
+# Common expressions.
+NDVI = '(nir - red) / (nir + red)'
+SAVI = '1.5 * (nir - red) / (nir + red + 0.5)'
+NDWI = '(green - nir) / (green + nir)'
+
+# Names available to expressions in addition to the band names.
+FUNCTIONS = {name: getattr(np, name) for name in (
+    'abs', 'sqrt', 'exp', 'log', 'log10', 'sin', 'cos', 'tan', 'arctan2',
+    'minimum', 'maximum', 'clip', 'where', 'floor', 'ceil')}
+
+# Pixels are invalid where any input band is nodata.
+NODATA_ANY = 'any'
+# Input nodata values are not checked, only non-finite results are invalid.
+NODATA_IGNORE = 'ignore'
+
+# Blocks in flight per worker.
+PREFETCH_PER_WORKER = 2
+
+
+# Summary of a band math run.
+class BandMathResult:
+
+    def __init__(self):
+        self.valid_count = 0
+        self.pixel_count = 0
+        self.sum = 0.0
+        self.no_valid = 0
+        self.some_valid = 0
+        self.all_valid = 0
+
+    @property
+    def mean(self):
+        return self.sum / self.valid_count if self.valid_count else None
+
+    # Add the counts for one block.
+    def add_block(self, block_size, valid_count, block_sum):
+        self.pixel_count += block_size
+        self.valid_count += valid_count
+        self.sum += block_sum
+        if valid_count == 0:
+            self.no_valid += 1
+        elif valid_count < block_size:
+            self.some_valid += 1
+        else:
+            self.all_valid += 1
+
+
+# Compile an expression and check it only refers to bands and FUNCTIONS.
+def compile_expression(expression, band_names):
+    code = compile(expression, '<band math>', 'eval')
+    unknown = set(code.co_names) - set(band_names) - set(FUNCTIONS)
+    if unknown:
+        raise ValueError('Unknown names in expression: ' + ', '.join(sorted(unknown)))
+    return code
+
+
+# Evaluate an expression over named source bands and write the result to dstBand.
+# Returns a BandMathResult.
+#
+#   src_rasterfile - source raster file
+#   dstBand        - destination band, same size as the source, or a
+#                    blockwriter.BlockWriter
+#   expression     - expression string using the names in band_map
+#   band_map       - dict of name: source band number
+#   dst_nodata     - value written to invalid pixels
+#   src_nodata     - dict of name: nodata value, default each band's nodata value
+#   nodata_policy  - NODATA_ANY or NODATA_IGNORE
+#   work_type      - numpy type the bands are read as and the expression evaluated in
+#   workers        - read/evaluate thread count, default is the number of CPUs
+#   use_cache      - read source blocks through the process-wide block cache
+def band_math(src_rasterfile, dstBand, expression, band_map, dst_nodata,
+              src_nodata=None, nodata_policy=NODATA_ANY, work_type=np.float32,
+              workers=None, use_cache=False):
+    names = list(band_map)
+    code = compile_expression(expression, names)
+
+    srcDS = gdal.Open(src_rasterfile, gdal.GA_ReadOnly)
+    if srcDS is None:
+        raise IOError("Can't open source raster file " + src_rasterfile)
+
+    cols = srcDS.RasterXSize
+    rows = srcDS.RasterYSize
+    xblock, yblock = srcDS.GetRasterBand(band_map[names[0]]).GetBlockSize()
+
+    # Cached reads are whole blocks, which needs the same layout in every band.
+    cache = None
+    if use_cache and all(
+            srcDS.GetRasterBand(n).GetBlockSize() == [xblock, yblock] for n in band_map.values()):
+        cache = blockcache.get_cache()
+
+    if nodata_policy == NODATA_IGNORE:
+        nodata_values = {}
+    elif nodata_policy == NODATA_ANY:
+        if src_nodata is None:
+            nodata_values = {
+                name: srcDS.GetRasterBand(n).GetNoDataValue() for name, n in band_map.items()}
+        else:
+            nodata_values = dict(src_nodata)
+        nodata_values = {name: v for name, v in nodata_values.items() if v is not None}
+    else:
+        raise ValueError('Unknown nodata policy: ' + str(nodata_policy))
+    srcDS = None
+
+    dst_type = np.dtype(work_type)
+    block_size = xblock * yblock
+    local = threading.local()
+
+    # Preallocated buffers for one block in flight.
+    def new_buffers():
+        buffers = {name: np.empty(block_size, dtype=dst_type) for name in names}
+        buffers['.out'] = np.empty(block_size, dtype=dst_type)
+        buffers['.valid'] = np.empty(block_size, dtype=bool)
+        buffers['.tmp'] = np.empty(block_size, dtype=bool)
+        return buffers
+
+    # Read and evaluate one block into a set of buffers.
+    def evaluate(window, buffers):
+        xoff, yoff, xsize, ysize = window
+        n = xsize * ysize
+        view = {key: buf[:n].reshape(ysize, xsize) for key, buf in buffers.items()}
+
+        if getattr(local, 'ds', None) is None:
+            local.ds = gdal.Open(src_rasterfile, gdal.GA_ReadOnly)
+
+        arrays = {}
+        for name in names:
+            if cache is None:
+                band = local.ds.GetRasterBand(band_map[name])
+                band.ReadAsArray(xoff, yoff, xsize, ysize, buf_obj=view[name])
+            else:
+                data = cache.read_block(local.ds, band_map[name], xoff // xblock, yoff // yblock)
+                np.copyto(view[name], data, casting='unsafe')
+            arrays[name] = view[name]
+
+        out, valid, tmp = view['.out'], view['.valid'], view['.tmp']
+        with np.errstate(all='ignore'):
+            np.copyto(out, eval(code, {'__builtins__': {}}, dict(FUNCTIONS, **arrays)),
+                      casting='unsafe')
+
+        # Valid where the result is finite and no input is nodata.
+        np.isfinite(out, out=valid)
+        for name, value in nodata_values.items():
+            if np.isnan(value):
+                np.isnan(arrays[name], out=tmp)
+                np.logical_not(tmp, out=tmp)
+            else:
+                np.not_equal(arrays[name], value, out=tmp)
+            np.logical_and(valid, tmp, out=valid)
+
+        valid_count = int(np.count_nonzero(valid))
+        block_sum = float(out.sum(where=valid, dtype=np.float64)) if valid_count else 0.0
+
+        if valid_count < n:
+            np.logical_not(valid, out=tmp)
+            np.copyto(out, dst_nodata, where=tmp, casting='unsafe')
+
+        return window, out, valid_count, block_sum
+
+    result = BandMathResult()
+    windows = utils.block_windows(cols, rows, xblock, yblock)
+    workers = utils.worker_count(workers)
+
+    # Keep a bounded number of blocks in flight and write them in order.
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for window in windows:
+            if len(pending) < workers * PREFETCH_PER_WORKER:
+                buffers = new_buffers()
+            else:
+                buffers = _write_block(pending.popleft(), dstBand, result)
+            pending.append((executor.submit(evaluate, window, buffers), buffers))
+
+        while pending:
+            _write_block(pending.popleft(), dstBand, result)
+
+    return result
+
+
+# Write a completed block to the destination band and return its buffers for reuse.
+def _write_block(item, dstBand, result):
+    future, buffers = item
+    (xoff, yoff, xsize, ysize), out, valid_count, block_sum = future.result()
+    dstBand.WriteArray(out, xoff, yoff)
+    result.add_block(xsize * ysize, valid_count, block_sum)
+    return buffers
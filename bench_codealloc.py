@@ -0,0 +1,139 @@
+# Code allocation benchmark.
+#
+# Time filling the codes table with the 1,296 multi-row INSERT statements
+# example.py used against codealloc's single INSERT ... SELECT, then run
+# concurrent clients reserving codes, with FOR UPDATE SKIP LOCKED and with a
+# plain FOR UPDATE where clients queue on each other's locks. Each client holds
+# its reservation for HOLD_TIME before committing, as a client would while it
+# uses the codes. Reserved codes are checked for duplicates.
+
+import threading
+import time
+
+import codealloc
+import pgdb
+
+PROFILE = 'local'
+SCHEMA = 'example'
+TABLE = 'codes_bench'
+
+CLIENT_COUNTS = (1, 4, 16, 32)
+RESERVATIONS = 50
+CODES_PER_RESERVATION = 5
+HOLD_TIME = 0.002
+
+LOCKING_QUERY = """
+UPDATE {schema}.{table} AS c SET used = true
+FROM (
+  SELECT gid FROM {schema}.{table}
+  WHERE NOT used
+  ORDER BY gid
+  LIMIT %s
+  FOR UPDATE
+) AS free
+WHERE c.gid = free.gid
+RETURNING c.code
+"""
+
+
+# The codes table filled the way example.py did, one statement per leading
+# pair of characters.
+def create_codes_rowwise(conn, schema, table):
+    chars = codealloc.CHARS
+    with conn.cursor() as curs:
+        curs.execute("""
+        DROP TABLE IF EXISTS {schema}.{table};
+        CREATE TABLE {schema}.{table}
+        (
+          gid serial NOT NULL,
+          code character(3),
+          used boolean NOT NULL DEFAULT false,
+          CONSTRAINT {table}_pkey PRIMARY KEY (gid)
+        );
+        """.format(schema=schema, table=table))
+        for prefix in [c2 + c1 for c2 in chars for c1 in chars]:
+            codes = ','.join(["('{0}')".format(prefix + c0) for c0 in chars])
+            curs.execute('INSERT INTO {schema}.{table} (code) VALUES {codes}'.format(
+                schema=schema, table=table, codes=codes))
+
+
+def reserve_locking(conn, count, schema, table):
+    with conn.cursor() as curs:
+        curs.execute(LOCKING_QUERY.format(schema=schema, table=table), (count,))
+        return sorted(row[0] for row in curs.fetchall())
+
+
+STRATEGIES = (
+    ('skip locked', codealloc.reserve),
+    ('for update', reserve_locking),
+)
+
+
+def contention(clients, reserve):
+    pgdb.run(PROFILE, lambda conn: codealloc.create_codes(conn, SCHEMA, TABLE))
+    reserved = []
+    latency = pgdb.Timing()
+    errors = []
+
+    def hold(conn):
+        codes = reserve(conn, CODES_PER_RESERVATION, SCHEMA, TABLE)
+        time.sleep(HOLD_TIME)
+        return codes
+
+    def client():
+        try:
+            for i in range(RESERVATIONS):
+                startTime = time.time()
+                codes = pgdb.run(PROFILE, hold)
+                latency.add(time.time() - startTime)
+                reserved.extend(codes)
+        except BaseException as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=client) for i in range(clients)]
+    startTime = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - startTime
+    if errors:
+        raise errors[0]
+    return elapsed, latency, reserved
+
+
+def bench():
+    pgdb.get_pool(PROFILE, maxconn=max(CLIENT_COUNTS))
+
+    for name, create in (('row-wise INSERTs', create_codes_rowwise),
+                         ('generate_series', codealloc.create_codes)):
+        startTime = time.time()
+        pgdb.run(PROFILE, lambda conn: create(conn, SCHEMA, TABLE))
+        print('populate {0}: {1:.3f} sec'.format(name, time.time() - startTime))
+
+    print()
+    for clients in CLIENT_COUNTS:
+        for name, reserve in STRATEGIES:
+            elapsed, latency, reserved = contention(clients, reserve)
+            requested = clients * RESERVATIONS * CODES_PER_RESERVATION
+            print('{0:3d} clients {1:<12} {2:8,.0f} codes/s  reservation {3}  '
+                  '{4} of {5} codes{6}'.format(
+                      clients, name, len(reserved) / elapsed, latency.report(),
+                      len(reserved), requested,
+                      '' if len(set(reserved)) == len(reserved) else '  DUPLICATES'))
+
+    pgdb.run(PROFILE, lambda conn: conn.cursor().execute(
+        'DROP TABLE IF EXISTS {schema}.{table}'.format(schema=SCHEMA, table=TABLE)))
+
+    # Gap lookups on the in-memory bitmap.
+    bitmap = codealloc.UsedBitmap(codealloc.code_at(n) for n in range(0, codealloc.CODE_COUNT, 2))
+    startTime = time.time()
+    for n in range(1000):
+        bitmap.next_free(codealloc.code_at(n * 37 % codealloc.CODE_COUNT))
+    print()
+    print('bitmap next_free: {0:.1f} us'.format((time.time() - startTime) * 1000))
+
+
+if __name__ == '__main__':
+    bench()
+    pgdb.close_all()
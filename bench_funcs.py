@@ -0,0 +1,183 @@
+# funcs.sql benchmark.
+#
+# Install funcs.sql, and the former plpython3u ST_AsBearing and CTE
+# ST_InverseSimilarity in a scratch schema, then
+#
+#   check that both give the same results on the funcs.sql test vectors and
+#   on a sweep of azimuths and transform parameters,
+#
+#   time each function per row over a table of ROWS azimuths or points with
+#   EXPLAIN ANALYZE, reporting the parallel workers used, and the batch
+#   (array) variants over the same values.
+
+import json
+import os
+
+import pgdb
+
+PROFILE = 'local'
+SCHEMA = 'funcs_bench'
+FUNCS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'funcs.sql')
+
+ROWS = 1000000
+
+LEGACY_SQL = """
+DROP SCHEMA IF EXISTS {schema} CASCADE;
+CREATE SCHEMA {schema};
+
+CREATE FUNCTION {schema}.ST_AsBearing(
+  param_azimuth float,
+  param_ndigits integer DEFAULT 0)
+RETURNS text AS
+$$
+import math
+
+# ST_Azimuth return NULL when given tow identical points
+azimuth = param_azimuth if param_azimuth is not None else 0.0
+ndigits = param_ndigits if param_ndigits is not None else 0
+
+quadrant = ('NE','SE','SW','NW')[int((azimuth // (math.pi/2.0)) % 4)]
+degrees = math.degrees(math.asin(abs(math.sin(azimuth))))
+width = ndigits + (2 if ndigits == 0 else 3)
+bearing = '{{0:s}}{{1:0{{2:d}}.{{3:d}}f}}{{4:s}}'.format(quadrant[0], degrees, width, ndigits, quadrant[1])
+
+return bearing
+
+$$ LANGUAGE plpython3u IMMUTABLE;
+
+CREATE FUNCTION {schema}.ST_InverseSimilarity(
+  geom geometry, a0 float, b0 float, a1 float, b1 float)
+RETURNS geometry AS
+$$
+WITH a AS (
+    SELECT 1.0/(a1^2 + b1^2) AS idet
+  ), b AS (
+    SELECT
+      -idet * ( a0*a1 + b0*b1) AS ia0,
+      -idet * (-a0*b1 + a1*b0) AS ib0,
+       idet *  a1 AS              ia1,
+       idet * -b1 AS              ib1
+    FROM a
+  )
+SELECT ST_Affine(geom, ia1, -ib1, ib1, ia1, ia0, ib0)
+FROM b
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE TABLE {schema}.azimuths AS
+  SELECT n, radians(random() * 720 - 180) AS azimuth
+  FROM generate_series(1, {rows}) AS n;
+
+CREATE TABLE {schema}.points AS
+  SELECT n, ST_SetSRID(ST_MakePoint(6000000 + random() * 100000,
+                                    2000000 + random() * 100000), 2225) AS geom
+  FROM generate_series(1, {rows}) AS n;
+
+ANALYZE {schema}.azimuths;
+ANALYZE {schema}.points;
+"""
+
+# The ST_AsBearing test vectors of funcs.sql, a sweep in 0.005 degree steps,
+# and NULL.
+BEARING_CHECK = """
+SELECT count(*) FROM (
+  SELECT azimuth, ndigits FROM (
+    VALUES
+      (-0.01),(0.0),(0.01),
+      (45.0),
+      (89.99),(90.0),(90.01),
+      (135.0),
+      (179.99),(180.0),(180.01),
+      (225.0),
+      (269.99),(270.0),(270.01),
+      (315.0),
+      (359.99),(360.0),(360.01)
+  ) AS v (azimuth), generate_series(0, 4) AS ndigits
+  UNION ALL
+  SELECT n * 0.005, ndigits FROM generate_series(-72000, 144000) AS n, generate_series(0, 2) AS ndigits
+  UNION ALL
+  SELECT NULL, 0
+) AS v
+WHERE ST_AsBearing(radians(azimuth), ndigits)
+    IS DISTINCT FROM {schema}.ST_AsBearing(radians(azimuth), ndigits)
+  OR ST_AsBearingArray(ARRAY[radians(azimuth)], ndigits)
+    IS DISTINCT FROM ARRAY[{schema}.ST_AsBearing(radians(azimuth), ndigits)]
+"""
+
+# The round trip test of funcs.sql over a range of rotations and scales.
+SIMILARITY_CHECK = """
+SELECT count(*) FROM (
+  SELECT
+    ST_Transform(ST_PointFromText('POINT(-124.0 40.0)', 4326), 2225) AS geom,
+    6000000.0 AS a0,
+    2000000.0 AS b0,
+    scale * cos(radians(rotate)) AS a1,
+    scale * sin(radians(rotate)) AS b1
+  FROM generate_series(-180.0, 180.0, 0.5) AS rotate,
+    generate_series(0.90, 1.10, 0.01) AS scale
+) AS b
+WHERE ST_AsBinary(ST_InverseSimilarity(ST_Similarity(geom, a0, b0, a1, b1), a0, b0, a1, b1))
+    <> ST_AsBinary({schema}.ST_InverseSimilarity(ST_Similarity(geom, a0, b0, a1, b1), a0, b0, a1, b1))
+  OR ST_AsBinary(ST_InverseSimilarity(geom, a0, b0, a1, b1))
+    <> ST_AsBinary({schema}.ST_InverseSimilarity(geom, a0, b0, a1, b1))
+  OR ST_AsBinary((ST_InverseSimilarityArray(ARRAY[geom], a0, b0, a1, b1))[1])
+    <> ST_AsBinary({schema}.ST_InverseSimilarity(geom, a0, b0, a1, b1))
+"""
+
+SIMILARITY_ARGS = '6000000.0, 2000000.0, 0.95 * cos(radians(-1.5)), 0.95 * sin(radians(-1.5))'
+
+TIMINGS = (
+    ('ST_AsBearing plpython3u',
+     'SELECT count({schema}.ST_AsBearing(azimuth, 2)) FROM {schema}.azimuths'),
+    ('ST_AsBearing sql',
+     'SELECT count(ST_AsBearing(azimuth, 2)) FROM {schema}.azimuths'),
+    ('ST_AsBearingArray',
+     'SELECT cardinality(ST_AsBearingArray(array_agg(azimuth), 2)) FROM {schema}.azimuths'),
+    ('ST_InverseSimilarity cte',
+     'SELECT count({schema}.ST_InverseSimilarity(geom, ' + SIMILARITY_ARGS + ')) '
+     'FROM {schema}.points'),
+    ('ST_InverseSimilarity sql',
+     'SELECT count(ST_InverseSimilarity(geom, ' + SIMILARITY_ARGS + ')) FROM {schema}.points'),
+    ('ST_InverseSimilarityArray',
+     'SELECT cardinality(ST_InverseSimilarityArray(array_agg(geom), ' + SIMILARITY_ARGS + ')) '
+     'FROM {schema}.points'),
+)
+
+
+# Execution time in ms and the parallel workers launched.
+def explain(curs, sql):
+    curs.execute('EXPLAIN (ANALYZE, FORMAT JSON) ' + sql)
+    plan = curs.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    workers = 0
+    nodes = [plan[0]['Plan']]
+    while nodes:
+        node = nodes.pop()
+        workers += node.get('Workers Launched', 0)
+        nodes += node.get('Plans', [])
+    return plan[0]['Execution Time'], workers
+
+
+def bench(conn):
+    with conn.cursor() as curs:
+        with open(FUNCS_FILE) as f:
+            curs.execute(f.read())
+        curs.execute(LEGACY_SQL.format(schema=SCHEMA, rows=ROWS))
+
+        curs.execute(BEARING_CHECK.format(schema=SCHEMA))
+        print('ST_AsBearing: {0} differences'.format(curs.fetchone()[0]))
+        curs.execute(SIMILARITY_CHECK.format(schema=SCHEMA))
+        print('ST_InverseSimilarity: {0} differences'.format(curs.fetchone()[0]))
+
+        print()
+        for name, sql in TIMINGS:
+            ms, workers = explain(curs, sql.format(schema=SCHEMA))
+            print('{0:<28} {1:10.1f} ms  {2:8.1f} ns/row  {3} workers'.format(
+                name, ms, ms * 1e6 / ROWS, workers))
+
+        curs.execute('DROP SCHEMA IF EXISTS {schema} CASCADE'.format(schema=SCHEMA))
+
+
+if __name__ == '__main__':
+    pgdb.run(PROFILE, bench)
+    pgdb.close_all()
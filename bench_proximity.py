@@ -0,0 +1,79 @@
+# Proximity engine benchmark.
+#
+# On the synthetic layers of bench_siteselect, time a sweep of recreation and
+# interstate mile thresholds answered by the in-process proximity engine, and
+# the same criteria answered by siteselect's SQL for a few of the thresholds.
+# The engine's rows are checked against the SQL rows for each of those.
+
+import time
+
+import numpy as np
+
+import bench_siteselect
+import pgdb
+import proximity
+import siteselect
+
+PROFILE = 'local'
+SCHEMA = bench_siteselect.SCHEMA
+
+SCALES = (1, 16)
+
+RECREATION_MILES = np.arange(0, 21, 0.5)
+INTERSTATE_MILES = np.arange(0, 41, 1.0)
+
+# Thresholds checked against the SQL and timed there.
+CHECKS = ((None, None), (10, 20), (5, 10), (2.5, 40), (20, 2))
+
+
+def bench(conn):
+    for scale in SCALES:
+        bench_siteselect.make_layers(conn, scale)
+        siteselect.prepare(conn, SCHEMA)
+
+        startTime = time.time()
+        engine = proximity.load(conn, SCHEMA)
+        load_time = time.time() - startTime
+
+        startTime = time.time()
+        counts = engine.sweep(RECREATION_MILES, INTERSTATE_MILES)
+        sweep_time = time.time() - startTime
+
+        print('scale {0}: {1} candidates, load {2:.3f} sec, sweep of {3} thresholds '
+              '{4:.2f} ms, {5} to {6} sites ({7})'.format(
+                  scale, len(engine), load_time, counts.size, sweep_time * 1000,
+                  counts.min(), counts.max(),
+                  'shapely' if proximity.shapely is not None else 'numpy'))
+
+        sql_time = 0.0
+        select_time = 0.0
+        mismatches = 0
+        for rec_miles, ist_miles in CHECKS:
+            sql, args = siteselect.selection_query(SCHEMA, rec_miles, ist_miles)
+            startTime = time.time()
+            with conn.cursor() as curs:
+                curs.execute(sql, args)
+                expected = sorted(curs.fetchall())
+            sql_time += time.time() - startTime
+
+            startTime = time.time()
+            rows = engine.select(rec_miles, ist_miles)
+            select_time += time.time() - startTime
+
+            if sorted(tuple(row) for row in rows) != expected:
+                mismatches += 1
+                print('  MISMATCH recreation {0} interstate {1}: {2} rows, SQL {3}'.format(
+                    rec_miles, ist_miles, len(rows), len(expected)))
+
+        print('  {0} checks: SQL {1:.1f} ms per query, engine {2:.2f} ms per select, '
+              '{3}'.format(len(CHECKS), sql_time * 1000 / len(CHECKS),
+                           select_time * 1000 / len(CHECKS),
+                           'results match' if not mismatches else '{0} mismatched'.format(mismatches)))
+
+    with conn.cursor() as curs:
+        curs.execute('DROP SCHEMA IF EXISTS {schema} CASCADE'.format(schema=SCHEMA))
+
+
+if __name__ == '__main__':
+    pgdb.run(PROFILE, bench)
+    pgdb.close_all()
@@ -0,0 +1,196 @@
+# Raster workload benchmark suite.
+#
+# Generate synthetic rasters over a range of sizes, band counts, data types and
+# block layouts (striped or tiled) and time the usu04a point sampling, usu04b
+# block statistics and usu05a NDVI workloads against them. Each case runs in a
+# fresh process so its peak memory can be measured. Results are appended as
+# JSON lines to RESULTS_FILE, one record per case, tagged with the git commit
+# so runs from different versions can be compared.
+#
+#   python bench_raster.py [results file]
+
+import gdal
+import json
+import multiprocessing
+import numpy as np
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import bandmath
+import blockstats
+import sampling
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+RESULTS_FILE = 'bench_results.jsonl'
+
+SIZES = (1024, 4096)
+BAND_COUNTS = (1, 3)
+DATA_TYPES = ('Byte', 'UInt16', 'Float32')
+LAYOUTS = ('striped', 'tiled')
+TILE_SIZE = 256
+
+WORKLOADS = ('sampling', 'stats', 'ndvi')
+SAMPLE_SITES = 100000
+WORKERS = None
+
+
+# Create a synthetic raster. Striped files use the GTiff default strips, tiled
+# files TILE_SIZE square tiles.
+def make_raster(filename, size, band_count, data_type, layout):
+    options = ['TILED=YES', 'BLOCKXSIZE={0}'.format(TILE_SIZE),
+               'BLOCKYSIZE={0}'.format(TILE_SIZE)] if layout == 'tiled' else []
+    driver = gdal.GetDriverByName('GTiff')
+    ds = driver.Create(filename, size, size, band_count, gdal.GetDataTypeByName(data_type),
+                       options=options)
+
+    rng = np.random.default_rng(size * band_count)
+    rows_per_write = max(1, (16 * 1024 * 1024) // (size * 8))
+    for n in range(1, band_count + 1):
+        band = ds.GetRasterBand(n)
+        for yoff in range(0, size, rows_per_write):
+            ysize = min(rows_per_write, size - yoff)
+            if data_type == 'Float32':
+                data = rng.random((ysize, size), dtype=np.float32) * 1000
+            else:
+                data = rng.integers(0, 256 if data_type == 'Byte' else 4096, (ysize, size))
+            band.WriteArray(data, 0, yoff)
+    ds = None
+
+
+def run_sampling(rasterfile):
+    ds = gdal.Open(rasterfile, gdal.GA_ReadOnly)
+    rng = np.random.default_rng(0)
+    cols = rng.integers(0, ds.RasterXSize, SAMPLE_SITES)
+    rows = rng.integers(0, ds.RasterYSize, SAMPLE_SITES)
+    sampling.sample_offsets(ds, cols, rows)
+    return SAMPLE_SITES * ds.RasterCount
+
+
+def run_stats(rasterfile):
+    ds = gdal.Open(rasterfile, gdal.GA_ReadOnly)
+    pixels = ds.RasterXSize * ds.RasterYSize * ds.RasterCount
+    ds = None
+    blockstats.band_statistics(rasterfile, workers=WORKERS)
+    return pixels
+
+
+def run_ndvi(rasterfile):
+    ds = gdal.Open(rasterfile, gdal.GA_ReadOnly)
+    cols, rows = ds.RasterXSize, ds.RasterYSize
+    ds = None
+    dstDS = gdal.GetDriverByName('MEM').Create('', cols, rows, 1, gdal.GDT_Float32)
+    bandmath.band_math(rasterfile, dstDS.GetRasterBand(1), bandmath.NDVI,
+                       {'red': 1, 'nir': 2}, -99, workers=WORKERS)
+    return cols * rows * 2
+
+
+RUNNERS = {'sampling': run_sampling, 'stats': run_stats, 'ndvi': run_ndvi}
+
+
+# Run one workload in this process and put the timing on a queue.
+def run_case(workload, rasterfile, itemsize, queue):
+    gdal.UseExceptions()
+    try:
+        startTime = time.time()
+        pixels = RUNNERS[workload](rasterfile)
+        elapsed = time.time() - startTime
+    except Exception as e:
+        queue.put({'error': repr(e)})
+        return
+
+    # Peak resident memory of this process, ru_maxrss is in kilobytes on Linux
+    # and bytes on macOS. Not available on Windows.
+    peak_mb = None
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak_mb = peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+
+    queue.put({
+        'seconds': elapsed,
+        'pixels': pixels,
+        'pixels_per_sec': pixels / elapsed if elapsed > 0 else None,
+        'mb_per_sec': pixels * itemsize / (1024.0 * 1024.0) / elapsed if elapsed > 0 else None,
+        'peak_rss_mb': peak_mb,
+    })
+
+
+# Git commit of the working tree, if any.
+def git_version():
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+
+    gdal.UseExceptions()
+    results_file = sys.argv[1] if len(sys.argv) > 1 else RESULTS_FILE
+
+    run_info = {
+        'version': git_version(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'gdal': gdal.__version__,
+        'numpy': np.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+    fmt = '{0:>5d} {1:>2d} {2:>8s} {3:>8s} {4:>9s} {5:9.3f} {6:10.1f} {7:14,.0f} {8:10.1f}'
+    print('\n{0:>5s} {1:>2s} {2:>8s} {3:>8s} {4:>9s} {5:>9s} {6:>10s} {7:>14s} {8:>10s}'.format(
+        'size', 'nb', 'type', 'layout', 'workload', 'sec', 'MB/s', 'pixels/s', 'peak MB'))
+
+    context = multiprocessing.get_context('spawn')
+
+    with tempfile.TemporaryDirectory() as tmpdir, open(results_file, 'a') as out:
+        for size in SIZES:
+            for band_count in BAND_COUNTS:
+                for data_type in DATA_TYPES:
+                    for layout in LAYOUTS:
+
+                        rasterfile = os.path.join(tmpdir, 'bench.tif')
+                        make_raster(rasterfile, size, band_count, data_type, layout)
+                        itemsize = gdal.GetDataTypeSize(gdal.GetDataTypeByName(data_type)) // 8
+
+                        for workload in WORKLOADS:
+                            if workload == 'ndvi' and band_count < 2:
+                                continue
+
+                            queue = context.Queue()
+                            proc = context.Process(
+                                target=run_case, args=(workload, rasterfile, itemsize, queue))
+                            proc.start()
+                            result = queue.get()
+                            proc.join()
+
+                            record = dict(run_info, size=size, bands=band_count,
+                                          data_type=data_type, layout=layout,
+                                          workload=workload, **result)
+                            out.write(json.dumps(record) + '\n')
+                            out.flush()
+
+                            if 'error' in result:
+                                print('{0:>5d} {1:>2d} {2:>8s} {3:>8s} {4:>9s} error: {5}'.format(
+                                    size, band_count, data_type, layout, workload,
+                                    result['error']))
+                                continue
+
+                            print(fmt.format(
+                                size, band_count, data_type, layout, workload,
+                                result['seconds'], result['mb_per_sec'] or 0.0,
+                                result['pixels_per_sec'] or 0.0, result['peak_rss_mb'] or 0.0))
+
+                        os.remove(rasterfile)
+
+    print('\nResults appended to ' + results_file)
@@ -0,0 +1,114 @@
+# Point sampling benchmark.
+#
+# Compare the three usu04a read modes on a synthetic raster: one ReadAsArray
+# call per site per band, reading each entire band into memory and reading each
+# block holding a site once (sampling.sample_offsets). Sites are drawn either
+# uniformly over the raster or in a few tight clusters.
+
+import gdal
+import numpy as np
+import os
+import tempfile
+import time
+
+import sampling
+
+gdal.UseExceptions()
+
+RASTER_SIZE = (8192, 8192)
+BAND_COUNT = 3
+TILE_SIZE = 256
+
+SITE_COUNTS = (1000, 10000, 100000)
+CLUSTERS = 20
+
+# Skip the per-pixel mode above this many sites, it is far too slow.
+MAX_PIXEL_SITES = 10000
+
+
+# Create a tiled GeoTIFF of random bytes.
+def make_raster(filename, size, band_count, tile_size):
+    driver = gdal.GetDriverByName('GTiff')
+    ds = driver.Create(filename, size[0], size[1], band_count, gdal.GDT_Byte, options=[
+        'TILED=YES', 'BLOCKXSIZE={0}'.format(tile_size), 'BLOCKYSIZE={0}'.format(tile_size)])
+    rng = np.random.default_rng(0)
+    for n in range(1, band_count + 1):
+        band = ds.GetRasterBand(n)
+        for yoff in range(0, size[1], tile_size):
+            ysize = min(tile_size, size[1] - yoff)
+            band.WriteArray(rng.integers(0, 256, (ysize, size[0]), dtype=np.uint8), 0, yoff)
+    ds = None
+
+
+# Random site offsets, uniform or in clusters.
+def make_sites(count, size, clustered):
+    rng = np.random.default_rng(count)
+    if clustered:
+        centers = rng.integers(0, min(size), (CLUSTERS, 2))
+        pick = rng.integers(0, CLUSTERS, count)
+        offsets = centers[pick] + rng.normal(0, 64, (count, 2)).astype(np.int64)
+        offsets = np.clip(offsets, 0, np.array(size) - 1)
+    else:
+        offsets = rng.integers(0, size, (count, 2))
+    return offsets[:, 0], offsets[:, 1]
+
+
+def read_pixels(ds, cols, rows):
+    values = np.empty((cols.size, ds.RasterCount), dtype=np.uint8)
+    for i in range(ds.RasterCount):
+        band = ds.GetRasterBand(i + 1)
+        for j, (col, row) in enumerate(zip(cols.tolist(), rows.tolist())):
+            values[j, i] = band.ReadAsArray(col, row, 1, 1)[0, 0]
+    return values
+
+
+def read_bands(ds, cols, rows):
+    values = np.empty((cols.size, ds.RasterCount), dtype=np.uint8)
+    for i in range(ds.RasterCount):
+        data = ds.GetRasterBand(i + 1).ReadAsArray()
+        values[:, i] = data[rows, cols]
+    return values
+
+
+def read_blocks(ds, cols, rows):
+    return sampling.sample_offsets(ds, cols, rows)
+
+
+MODES = (('pixel', read_pixels), ('band', read_bands), ('block', read_blocks))
+
+
+with tempfile.TemporaryDirectory() as tmpdir:
+
+    rasterfile = os.path.join(tmpdir, 'bench.tif')
+    make_raster(rasterfile, RASTER_SIZE, BAND_COUNT, TILE_SIZE)
+    print('\nRaster: {0}x{1}x{2} Byte, {3}x{3} tiles'.format(
+        RASTER_SIZE[0], RASTER_SIZE[1], BAND_COUNT, TILE_SIZE))
+
+    print('\n{0:>9s} {1:>9s} {2:>6s} {3:>10s} {4:>12s}'.format(
+        'sites', 'layout', 'mode', 'time (s)', 'sites/s'))
+
+    for count in SITE_COUNTS:
+        for clustered in (False, True):
+            cols, rows = make_sites(count, RASTER_SIZE, clustered)
+            expected = None
+
+            for mode, read in MODES:
+                if mode == 'pixel' and count > MAX_PIXEL_SITES:
+                    continue
+
+                # Open a fresh handle so the GDAL block cache starts empty.
+                gdal.SetCacheMax(64 * 1024 * 1024)
+                ds = gdal.Open(rasterfile, gdal.GA_ReadOnly)
+                startTime = time.time()
+                values = read(ds, cols, rows)
+                elapsed = time.time() - startTime
+                ds = None
+
+                if expected is None:
+                    expected = values
+                elif not np.array_equal(values, expected):
+                    print('  {0}: values differ'.format(mode))
+
+                print('{0:9,d} {1:>9s} {2:>6s} {3:10.3f} {4:12,.0f}'.format(
+                    count, 'clustered' if clustered else 'uniform', mode,
+                    elapsed, count / elapsed if elapsed > 0 else float('inf')))
@@ -0,0 +1,143 @@
+# Site selection benchmark.
+#
+# Compare the original geog897d site selection query with the index driven
+# siteselect query on synthetic layers scaled up from the project data: a grid
+# of counties over Pennsylvania, and random cities, recreation areas and
+# interstate segments. Each query is run with EXPLAIN ANALYZE, with and without
+# the recreation and interstate criteria, and the two result sets are checked
+# against each other.
+
+import json
+
+import pgdb
+import siteselect
+
+PROFILE = 'local'
+SCHEMA = 'siteselect_bench'
+
+# Multiples of the project layer sizes.
+SCALES = (1, 4, 16)
+
+COUNTY_GRID = 8
+CITIES = 400
+REC_AREAS = 80
+INTERSTATES = 30
+
+# Pennsylvania, in NAD83 degrees.
+EXTENT = (-80.5, 39.7, -74.7, 42.3)
+SRID = 4269
+
+CRITERIA = (
+    {},
+    {'max_recreation_miles': 10, 'max_interstate_miles': 20},
+)
+
+
+# Create the synthetic layers, scale times the project sizes. The county grid
+# grows so that city density stays the same.
+def make_layers(conn, scale):
+    grid = int(COUNTY_GRID * scale ** 0.5)
+    xmin, ymin, xmax, ymax = EXTENT
+    with conn.cursor() as curs:
+        curs.execute("""
+        DROP SCHEMA IF EXISTS {schema} CASCADE;
+        CREATE SCHEMA {schema};
+        SELECT setseed(0.5);
+
+        CREATE TABLE {schema}.counties AS
+          SELECT row_number() OVER ()::integer AS gid,
+              'County ' || i || '-' || j AS name,
+              (random() * 1500)::numeric AS no_farms87,
+              (random() * 80000)::numeric AS age_18_64,
+              (random() * 300)::numeric AS pop_sqmile,
+              ST_Multi(ST_MakeEnvelope(
+                {xmin} + i * {dx}, {ymin} + j * {dy},
+                {xmin} + (i + 1) * {dx}, {ymin} + (j + 1) * {dy}, {srid})) AS geom
+          FROM generate_series(0, {grid} - 1) AS i, generate_series(0, {grid} - 1) AS j;
+
+        CREATE TABLE {schema}.cities AS
+          SELECT n AS gid, 'City ' || n AS name,
+              (random() * 0.04)::numeric AS crime_inde,
+              (random() < 0.3)::integer AS university,
+              ST_SetSRID(ST_MakePoint(
+                {xmin} + random() * ({xmax} - {xmin}),
+                {ymin} + random() * ({ymax} - {ymin})), {srid}) AS geom
+          FROM generate_series(1, {cities}) AS n;
+
+        CREATE TABLE {schema}.rec_areas AS
+          SELECT n AS gid,
+              ST_Multi(ST_Buffer(ST_SetSRID(ST_MakePoint(
+                {xmin} + random() * ({xmax} - {xmin}),
+                {ymin} + random() * ({ymax} - {ymin})), {srid}), 0.01 + random() * 0.04)) AS geom
+          FROM generate_series(1, {rec_areas}) AS n;
+
+        CREATE TABLE {schema}.interstates AS
+          SELECT n AS gid,
+              ST_Multi(ST_MakeLine(p, ST_Translate(p, random() - 0.5, random() - 0.5))) AS geom
+          FROM (
+            SELECT n, ST_SetSRID(ST_MakePoint(
+                {xmin} + random() * ({xmax} - {xmin}),
+                {ymin} + random() * ({ymax} - {ymin})), {srid}) AS p
+            FROM generate_series(1, {interstates}) AS n
+          ) AS a;
+
+        ALTER TABLE {schema}.counties ADD PRIMARY KEY (gid);
+        ALTER TABLE {schema}.cities ADD PRIMARY KEY (gid);
+        ALTER TABLE {schema}.rec_areas ADD PRIMARY KEY (gid);
+        ALTER TABLE {schema}.interstates ADD PRIMARY KEY (gid);
+
+        CREATE VIEW {schema}.v_jb_candidate_counties AS
+          SELECT * FROM {schema}.counties
+          WHERE no_farms87 > 500 AND age_18_64 >= 25000 AND pop_sqmile < 150;
+        """.format(schema=SCHEMA, srid=SRID, grid=grid,
+                   xmin=xmin, ymin=ymin, xmax=xmax, ymax=ymax,
+                   dx=(xmax - xmin) / grid, dy=(ymax - ymin) / grid,
+                   cities=CITIES * scale, rec_areas=REC_AREAS * scale,
+                   interstates=INTERSTATES * scale))
+    conn.commit()
+
+
+# Run a query under EXPLAIN ANALYZE, returns the execution time in ms.
+def explain(conn, sql, args):
+    with conn.cursor() as curs:
+        curs.execute('EXPLAIN (ANALYZE, FORMAT JSON) ' + sql, args)
+        plan = curs.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]['Planning Time'] + plan[0]['Execution Time']
+
+
+def fetch(conn, sql, args):
+    with conn.cursor() as curs:
+        curs.execute(sql, args)
+        return sorted(curs.fetchall())
+
+
+def bench(conn):
+    for scale in SCALES:
+        make_layers(conn, scale)
+        siteselect.prepare(conn, SCHEMA)
+        print('scale {0}: {1} cities, {2} recreation areas, {3} interstates'.format(
+            scale, CITIES * scale, REC_AREAS * scale, INTERSTATES * scale))
+
+        for criteria in CRITERIA:
+            original = siteselect.original_query(SCHEMA, **criteria)
+            rewrite = siteselect.selection_query(SCHEMA, **criteria)
+            original_ms = explain(conn, *original)
+            rewrite_ms = explain(conn, *rewrite)
+            rows = fetch(conn, *rewrite)
+            match = rows == fetch(conn, *original)
+            print('  {0:<40} original {1:10.1f} ms  knn {2:8.1f} ms  {3:6.1f}x  '
+                  '{4} rows{5}'.format(
+                      ', '.join('{0}={1}'.format(k, v) for k, v in sorted(criteria.items()))
+                      or 'no distance criteria',
+                      original_ms, rewrite_ms, original_ms / max(rewrite_ms, 0.001),
+                      len(rows), '' if match else '  MISMATCH'))
+
+    with conn.cursor() as curs:
+        curs.execute('DROP SCHEMA IF EXISTS {schema} CASCADE'.format(schema=SCHEMA))
+
+
+if __name__ == '__main__':
+    pgdb.run(PROFILE, bench)
+    pgdb.close_all()
@@ -0,0 +1,129 @@
+# Raster block cache.
+#
+# A process-wide LRU cache of raster blocks keyed by (dataset path, band,
+# block x, block y) with a memory budget in bytes. The sampling, block
+# statistics and band math readers can read through the cache so running them
+# back to back over the same raster, in one process, reads each block from disk
+# once. Cached blocks are shared between readers and marked read only.
+#
+# The cache lives in the memory of one process and is gone when it exits.
+# Separate scripts, such as usu04a, usu04b and usu05a, never share blocks, and
+# blocks read by a process pool worker are not seen by the parent process or
+# other workers. It only saves I/O when one program runs several readers over
+# the same raster with threads or serially.
+
+import numpy as np
+import os
+import threading
+from collections import OrderedDict
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+# LRU cache of raster blocks with hit/miss/eviction counters.
+class BlockCache:
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._blocks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._blocks)
+
+    # Cached block for a key or None, marking the block most recently used.
+    def get(self, key):
+        with self._lock:
+            data = self._blocks.get(key)
+            if data is None:
+                self.misses += 1
+            else:
+                self._blocks.move_to_end(key)
+                self.hits += 1
+            return data
+
+    # Add a block to the cache, evicting least recently used blocks to stay
+    # within the budget. Blocks larger than the whole budget are not cached.
+    def put(self, key, data):
+        if data.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._blocks.pop(key, None)
+            if old is not None:
+                self.bytes -= old.nbytes
+            self._blocks[key] = data
+            self.bytes += data.nbytes
+            self._evict()
+
+    # Change the budget, evicting blocks if the cache is now over it.
+    def resize(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def _evict(self):
+        while self.bytes > self.max_bytes and self._blocks:
+            key, data = self._blocks.popitem(last=False)
+            self.bytes -= data.nbytes
+            self.evictions += 1
+
+    # Drop all blocks, or only the blocks from one dataset path.
+    def clear(self, path=None):
+        with self._lock:
+            if path is None:
+                self._blocks.clear()
+                self.bytes = 0
+            else:
+                path = dataset_key(path)
+                for key in [key for key in self._blocks if key[0] == path]:
+                    self.bytes -= self._blocks.pop(key).nbytes
+
+    # Counters as a dict.
+    def stats(self):
+        with self._lock:
+            return {
+                'blocks': len(self._blocks), 'bytes': self.bytes, 'max_bytes': self.max_bytes,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+            }
+
+    # Read block (bx, by) of band n of a dataset through the cache. Edge blocks
+    # are clipped to the raster size.
+    def read_block(self, ds, n, bx, by):
+        key = (dataset_key(ds.GetDescription()), n, bx, by)
+        data = self.get(key)
+        if data is None:
+            band = ds.GetRasterBand(n)
+            xblock, yblock = band.GetBlockSize()
+            xoff, yoff = bx * xblock, by * yblock
+            xsize = min(xblock, ds.RasterXSize - xoff)
+            ysize = min(yblock, ds.RasterYSize - yoff)
+            data = np.ascontiguousarray(band.ReadAsArray(xoff, yoff, xsize, ysize))
+            data.setflags(write=False)
+            self.put(key, data)
+        return data
+
+
+# Cache key for a dataset path. File paths are made absolute so the same file
+# opened through different relative paths shares blocks.
+def dataset_key(path):
+    return os.path.abspath(path) if os.path.exists(path) else path
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+# The process-wide block cache.
+def get_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = BlockCache()
+        return _cache
+
+# Set the memory budget of the process-wide block cache.
+def set_cache_max(max_bytes):
+    get_cache().resize(max_bytes)
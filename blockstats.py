@@ -0,0 +1,187 @@
+# Block statistics engine.
+#
+# Calculate per-band statistics for a raster one block at a time. The block grid
+# is split into contiguous runs of blocks that are handed to a thread or process
+# pool. Each task opens its own dataset handle, reads one block at a time and
+# keeps a partial BandStats accumulator per band. The partials are merged into
+# the final per-band results as the tasks complete.
+
+import gdal
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+
+import blockcache
+import rasteraccess
+import utils
+
+# Number of tasks queued per worker. A few tasks per worker keeps the pool busy
+# when some parts of the raster are slower to read than others.
+TASKS_PER_WORKER = 4
+
+# Partial statistics for one band. Integer data up to 16 bits is accumulated
+# with integer arithmetic so merged results are exact regardless of the order
+# the partials are combined.
+class BandStats:
+
+    def __init__(self):
+        self.count = 0
+        self.nodata = 0
+        self.nonzero = 0
+        self.sum = 0
+        self.sumsq = 0
+        self.min = None
+        self.max = None
+
+    # Add a block of data to the statistics. Pixels equal to nodata_value are
+    # counted but otherwise ignored.
+    def update(self, data, nodata_value=None):
+        self.count += data.size
+
+        if nodata_value is not None:
+            if np.isnan(nodata_value):
+                valid = ~np.isnan(data)
+            else:
+                valid = np.not_equal(data, nodata_value)
+            valid_count = np.count_nonzero(valid)
+            if valid_count < data.size:
+                self.nodata += data.size - valid_count
+                data = data[valid]
+
+        if data.size == 0:
+            return
+
+        # Sum of squares without a full size temporary, data may be a strided view.
+        axes = 'ij'[:data.ndim]
+        sumsq = axes + ',' + axes + '->'
+        if data.dtype.kind in 'ui' and data.dtype.itemsize <= 2:
+            acc_type = np.int64
+            self.sum += int(data.sum(dtype=acc_type))
+            self.sumsq += int(np.einsum(sumsq, data, data, dtype=acc_type))
+        else:
+            acc_type = np.float64
+            self.sum += float(data.sum(dtype=acc_type))
+            self.sumsq += float(np.einsum(sumsq, data, data, dtype=acc_type))
+
+        self.nonzero += int(np.count_nonzero(np.greater(data, 0)))
+
+        block_min, block_max = data.min().item(), data.max().item()
+        self.min = block_min if self.min is None else min(self.min, block_min)
+        self.max = block_max if self.max is None else max(self.max, block_max)
+
+    # Combine the partial statistics from another accumulator into this one.
+    def merge(self, other):
+        self.count += other.count
+        self.nodata += other.nodata
+        self.nonzero += other.nonzero
+        self.sum += other.sum
+        self.sumsq += other.sumsq
+        if other.min is not None:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+        return self
+
+    # Number of pixels that are not nodata.
+    @property
+    def valid(self):
+        return self.count - self.nodata
+
+    @property
+    def mean(self):
+        return self.sum / self.valid if self.valid else None
+
+    @property
+    def nonzero_mean(self):
+        return self.sum / self.nonzero if self.nonzero else None
+
+    # Population standard deviation of the valid pixels.
+    @property
+    def std(self):
+        if not self.valid:
+            return None
+        mean = self.sum / self.valid
+        return max(self.sumsq / self.valid - mean * mean, 0.0) ** 0.5
+
+
+# Pool task: accumulate statistics for a run of block windows. Runs in a worker
+# thread or process, so it opens its own handle on the dataset.
+def _stats_task(rasterfile, band_list, nodata_values, windows, use_cache=False,
+                use_mmap=True, accumulator=BandStats):
+    ds = gdal.Open(rasterfile, gdal.GA_ReadOnly)
+    if ds is None:
+        raise IOError("Can't open raster data file " + rasterfile)
+
+    reader = rasteraccess.RasterReader(ds, use_mmap)
+    stats = [accumulator() for n in band_list]
+
+    # Mapped files are read straight from the page cache.
+    cache = blockcache.get_cache() if use_cache and not reader.mapped else None
+    xblock, yblock = ds.GetRasterBand(band_list[0]).GetBlockSize()
+
+    for xoff, yoff, xsize, ysize in windows:
+        for n, band_stats, nodata_value in zip(band_list, stats, nodata_values):
+            if cache is None:
+                data = reader.read(n, xoff, yoff, xsize, ysize)
+            else:
+                data = cache.read_block(ds, n, xoff // xblock, yoff // yblock)
+            band_stats.update(data, nodata_value)
+
+    reader = ds = None
+    return stats
+
+
+# Calculate statistics for the bands in a raster file. Returns a dict of
+# accumulators, BandStats by default, keyed by band number.
+#
+#   band_list     - band numbers to process, default all bands
+#   workers       - pool size, default is the number of CPUs
+#   processes     - use a process pool instead of a thread pool
+#   ignore_nodata - exclude each band's nodata value from the statistics
+#   use_cache     - read blocks through the process-wide block cache
+#   use_mmap      - memory map the file when its layout allows, see rasteraccess
+#   accumulator   - callable returning a new per-band accumulator with update(data,
+#                   nodata_value) and merge(other) methods, e.g. histograms.BandSketch
+def band_statistics(rasterfile, band_list=None, workers=None, processes=False,
+                    ignore_nodata=True, use_cache=False, use_mmap=True,
+                    accumulator=BandStats):
+    ds = gdal.Open(rasterfile, gdal.GA_ReadOnly)
+    if ds is None:
+        raise IOError("Can't open raster data file " + rasterfile)
+
+    if band_list is None:
+        band_list = list(range(1, ds.RasterCount + 1))
+
+    nodata_values = []
+    block_sizes = []
+    for n in band_list:
+        band = ds.GetRasterBand(n)
+        nodata_values.append(band.GetNoDataValue() if ignore_nodata else None)
+        block_sizes.append(band.GetBlockSize())
+
+    # Blocks follow the layout of the first band. Cached reads are whole blocks
+    # so they need the same layout in every band.
+    xblock, yblock = block_sizes[0]
+    use_cache = use_cache and all(size == block_sizes[0] for size in block_sizes)
+    windows = list(utils.block_windows(ds.RasterXSize, ds.RasterYSize, xblock, yblock))
+    band = ds = None
+
+    workers = utils.worker_count(workers)
+    stats = [accumulator() for n in band_list]
+
+    if workers == 1:
+        stats = _stats_task(
+            rasterfile, band_list, nodata_values, windows, use_cache, use_mmap, accumulator)
+
+    else:
+        Executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+        with Executor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(
+                    _stats_task, rasterfile, band_list, nodata_values, run,
+                    use_cache, use_mmap, accumulator)
+                for run in utils.split_runs(windows, workers * TASKS_PER_WORKER)
+            ]
+            for future in as_completed(futures):
+                for total, part in zip(stats, future.result()):
+                    total.merge(part)
+
+    return dict(zip(band_list, stats))
@@ -0,0 +1,176 @@
+# Block writer with in-pass statistics and overviews.
+#
+# Wraps a destination band and updates its statistics and overviews as blocks
+# are written, so neither needs another pass over the finished file. Blocks
+# must arrive in row-major block order, as written by bandmath.band_math.
+# BlockWriter has the band's WriteArray signature so it can be used wherever a
+# band is written a block at a time.
+#
+#   writer = blockwriter.BlockWriter(dstDS, 1, NO_DATA_VALUE, [2, 4, 8])
+#   for each block: writer.WriteArray(data, xoff, yoff)
+#   writer.close()
+#
+# Overview levels are created empty up front with BuildOverviews('NONE') and
+# each level keeps sum and count accumulators for only the overview rows the
+# current block row touches. NEAREST, the default as for BuildOverviews, takes
+# the source pixel under the centre of each overview pixel, source offset
+# floor((i + 0.5) * source size / overview size), GDAL's pixel centre rule.
+# Where the size ratio isn't a whole number a GDAL version that rounds the
+# offset differently can pick the neighbouring pixel. AVERAGE averages the
+# valid pixels of each factor x factor overview cell.
+
+import gdal_array
+import numpy as np
+
+import blockstats
+
+
+# Accumulator for one overview level.
+class _OverviewLevel:
+
+    def __init__(self, ovrBand, factor, src_size, yblock, nodata, resampling):
+        self.band = ovrBand
+        self.factor = factor
+        self.nodata = nodata
+        self.resampling = resampling
+        self.cols = ovrBand.XSize
+        self.rows = ovrBand.YSize
+        self.row0 = 0
+
+        # Source pixel sampled by each overview column and row for NEAREST.
+        src_cols, src_rows = src_size
+        self.src_col = np.minimum(
+            ((np.arange(self.cols) + 0.5) * src_cols / self.cols).astype(np.int64), src_cols - 1)
+        self.src_row = np.minimum(
+            ((np.arange(self.rows) + 0.5) * src_rows / self.rows).astype(np.int64), src_rows - 1)
+
+        # Overview rows in progress, enough for one source block row.
+        nbuf = -(-yblock * self.rows // src_rows) + 2
+        self.sum = np.zeros((nbuf, self.cols), dtype=np.float64)
+        self.count = np.zeros((nbuf, self.cols), dtype=np.int64)
+
+        data_type = np.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(ovrBand.DataType))
+        self.round = data_type.kind in 'ui'
+
+    # Add a block of data with its valid mask.
+    def add(self, data, valid, xoff, yoff):
+        f = self.factor
+        ysize, xsize = data.shape
+
+        if self.resampling == 'NEAREST':
+            rr = np.flatnonzero((self.src_row >= yoff) & (self.src_row < yoff + ysize))
+            cc = np.flatnonzero((self.src_col >= xoff) & (self.src_col < xoff + xsize))
+            if rr.size == 0 or cc.size == 0:
+                return
+            r = self.src_row[rr] - yoff
+            c = self.src_col[cc] - xoff
+            self.sum[np.ix_(rr - self.row0, cc)] = data[np.ix_(r, c)]
+            self.count[np.ix_(rr - self.row0, cc)] = valid[np.ix_(r, c)]
+            return
+
+        # Group starts of the overview cells crossed by the block.
+        r = np.flatnonzero(((yoff + np.arange(ysize)) % f == 0) | (np.arange(ysize) == 0))
+        c = np.flatnonzero(((xoff + np.arange(xsize)) % f == 0) | (np.arange(xsize) == 0))
+        values = np.where(valid, data, 0).astype(np.float64)
+        sums = np.add.reduceat(np.add.reduceat(values, r, axis=0), c, axis=1)
+        counts = np.add.reduceat(np.add.reduceat(valid.astype(np.int64), r, axis=0), c, axis=1)
+
+        rr = (yoff + r) // f - self.row0
+        cc = (xoff + c) // f
+        self.sum[np.ix_(rr, cc)] += sums
+        self.count[np.ix_(rr, cc)] += counts
+
+    # Write the overview rows completed by source rows up to yend.
+    def flush(self, yend, last=False):
+        if last:
+            done = self.rows
+        elif self.resampling == 'NEAREST':
+            done = int(np.searchsorted(self.src_row, yend))
+        else:
+            done = min(yend // self.factor, self.rows)
+        n = done - self.row0
+        if n <= 0:
+            return
+
+        count = self.count[:n]
+        with np.errstate(all='ignore'):
+            data = self.sum[:n] if self.resampling == 'NEAREST' else self.sum[:n] / count
+        if self.round:
+            data = np.rint(data)
+        data = np.where(count > 0, data, self.nodata)
+        self.band.WriteArray(data, 0, self.row0)
+
+        # Shift the rows still in progress to the top.
+        self.sum = np.roll(self.sum, -n, axis=0)
+        self.count = np.roll(self.count, -n, axis=0)
+        self.sum[-n:] = 0
+        self.count[-n:] = 0
+        self.row0 = done
+
+
+# Destination band writer that computes exact statistics and overviews as the
+# blocks are written.
+#
+#   dstDS          - destination dataset
+#   band_number    - band to write
+#   nodata         - destination nodata value, excluded from the statistics
+#   overview_list  - overview factors, e.g. [2, 4, 8], None for no overviews
+#   resampling     - 'NEAREST' or 'AVERAGE'
+class BlockWriter:
+
+    def __init__(self, dstDS, band_number, nodata, overview_list=None, resampling='NEAREST'):
+        if resampling not in ('AVERAGE', 'NEAREST'):
+            raise ValueError('Unsupported resampling: ' + str(resampling))
+
+        self.band = dstDS.GetRasterBand(band_number)
+        self.nodata = nodata
+        self.cols = dstDS.RasterXSize
+        self.rows = dstDS.RasterYSize
+        self.stats = blockstats.BandStats()
+        self.levels = []
+
+        if overview_list:
+            dstDS.BuildOverviews('NONE', overviewlist=list(overview_list))
+            self.band = dstDS.GetRasterBand(band_number)
+            yblock = self.band.GetBlockSize()[1]
+            ovrBands = [self.band.GetOverview(i) for i in range(self.band.GetOverviewCount())]
+            for factor in overview_list:
+                xsize, ysize = -(-self.cols // factor), -(-self.rows // factor)
+                for ovrBand in ovrBands:
+                    if ovrBand.XSize == xsize and ovrBand.YSize == ysize:
+                        self.levels.append(_OverviewLevel(
+                            ovrBand, factor, (self.cols, self.rows), yblock, nodata, resampling))
+                        break
+                else:
+                    raise ValueError('No {0}x{1} overview for factor {2} of the {3}x{4} band'.format(
+                        xsize, ysize, factor, self.cols, self.rows))
+
+    # Write a block to the band and add it to the statistics and overviews.
+    def WriteArray(self, data, xoff, yoff):
+        self.band.WriteArray(data, xoff, yoff)
+        self.stats.update(data, self.nodata)
+
+        if self.levels:
+            if np.isnan(self.nodata):
+                valid = ~np.isnan(data)
+            else:
+                valid = np.not_equal(data, self.nodata)
+            ysize, xsize = data.shape
+            for level in self.levels:
+                level.add(data, valid, xoff, yoff)
+                if xoff + xsize == self.cols:
+                    level.flush(yoff + ysize)
+
+    # Write the remaining overview rows and set the band statistics.
+    def close(self):
+        for level in self.levels:
+            level.flush(self.rows, last=True)
+            level.band.FlushCache()
+
+        self.band.SetNoDataValue(self.nodata)
+        if self.stats.valid:
+            self.band.SetStatistics(
+                float(self.stats.min), float(self.stats.max),
+                float(self.stats.mean), float(self.stats.std))
+        self.band.FlushCache()
+        return self.stats
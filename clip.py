@@ -0,0 +1,170 @@
+# Clip features to a trim geometry.
+#
+# A spatial filter only selects features whose bounding boxes touch the trim
+# geometry. TrimClipper does the real clip: each feature is classified as inside
+# the trim geometry (passed through untouched), outside (dropped) or crossing
+# its boundary (replaced by the intersection). Most features are classified
+# without a geometry test:
+#
+#   - a coarse grid over the trim envelope is built once, each cell marked
+#     inside, outside or boundary. A feature whose envelope only covers inside
+#     cells is inside, one that only covers outside cells is outside.
+#   - the envelopes of the trim geometry's parts are kept in numpy arrays, so
+#     only parts whose envelopes overlap the feature are tested.
+#   - the parts are prepared geometries when the GDAL bindings provide them.
+#
+# Only the crossing features pay for Intersection.
+#
+#   clipper = clip.TrimClipper(trimGeom)
+#   geom = clipper.clip(geom)    # None when the feature is outside
+
+import ogr
+import numpy as np
+
+# Cells along each side of the classification grid.
+GRID_SIZE = 64
+
+INSIDE = 1
+OUTSIDE = 0
+CROSSING = 2
+
+# Output type for clipped geometry of each dimension.
+MULTI_TYPES = {0: ogr.wkbMultiPoint, 1: ogr.wkbMultiLineString, 2: ogr.wkbMultiPolygon}
+
+
+def _prepare(geom):
+    if hasattr(geom, 'CreatePreparedGeometry'):
+        return geom.CreatePreparedGeometry()
+    return geom
+
+
+def _box(minx, miny, maxx, maxy):
+    ring = ogr.Geometry(ogr.wkbLinearRing)
+    for x, y in ((minx, miny), (maxx, miny), (maxx, maxy), (minx, maxy), (minx, miny)):
+        ring.AddPoint_2D(x, y)
+    box = ogr.Geometry(ogr.wkbPolygon)
+    box.AddGeometry(ring)
+    return box
+
+
+# Promote a geometry to the multi type of the given dimension, dropping parts of
+# other dimensions from a collection. Returns None if nothing is left.
+def promote(geom, dimension):
+    parts = []
+    if geom.GetGeometryCount() > 0 and ogr.GT_Flatten(geom.GetGeometryType()) not in (
+            ogr.wkbPolygon, ogr.wkbCurvePolygon):
+        for i in range(geom.GetGeometryCount()):
+            part = geom.GetGeometryRef(i)
+            if part.GetGeometryCount() > 0 and ogr.GT_Flatten(part.GetGeometryType()) not in (
+                    ogr.wkbPolygon, ogr.wkbCurvePolygon):
+                promoted = promote(part, dimension)
+                if promoted is not None:
+                    parts += [promoted.GetGeometryRef(j)
+                              for j in range(promoted.GetGeometryCount())]
+            elif part.GetDimension() == dimension and not part.IsEmpty():
+                parts.append(part)
+    elif geom.GetDimension() == dimension and not geom.IsEmpty():
+        parts.append(geom)
+
+    if not parts:
+        return None
+    multi = ogr.Geometry(MULTI_TYPES[dimension])
+    for part in parts:
+        multi.AddGeometry(part)
+    return multi
+
+
+class TrimClipper:
+
+    def __init__(self, trimGeom, grid_size=GRID_SIZE):
+        self.trim = trimGeom.Clone()
+        self.prepared = _prepare(self.trim)
+
+        # Trim geometry parts and their envelopes.
+        if self.trim.GetGeometryCount() > 0 and ogr.GT_Flatten(
+                self.trim.GetGeometryType()) in (ogr.wkbMultiPolygon, ogr.wkbGeometryCollection):
+            self.parts = [self.trim.GetGeometryRef(i).Clone()
+                          for i in range(self.trim.GetGeometryCount())]
+        else:
+            self.parts = [self.trim]
+        self.prepared_parts = [_prepare(part) for part in self.parts]
+        envelopes = np.array([part.GetEnvelope() for part in self.parts], dtype=np.float64)
+        self.part_minx, self.part_maxx, self.part_miny, self.part_maxy = envelopes.T
+
+        # Classification grid over the trim envelope.
+        self.minx, self.maxx, self.miny, self.maxy = self.trim.GetEnvelope()
+        self.grid_size = grid_size
+        self.cell_width = (self.maxx - self.minx) / grid_size or 1.0
+        self.cell_height = (self.maxy - self.miny) / grid_size or 1.0
+        self.cells = np.full((grid_size, grid_size), CROSSING, dtype=np.uint8)
+        for row in range(grid_size):
+            for col in range(grid_size):
+                box = _box(self.minx + col * self.cell_width,
+                           self.miny + row * self.cell_height,
+                           self.minx + (col + 1) * self.cell_width,
+                           self.miny + (row + 1) * self.cell_height)
+                if self.prepared.Contains(box):
+                    self.cells[row, col] = INSIDE
+                elif not self.prepared.Intersects(box):
+                    self.cells[row, col] = OUTSIDE
+
+        self.counts = {INSIDE: 0, OUTSIDE: 0, CROSSING: 0}
+
+    # Cells covered by an envelope, or None if it misses the trim envelope.
+    def _cells(self, minx, maxx, miny, maxy):
+        if maxx < self.minx or minx > self.maxx or maxy < self.miny or miny > self.maxy:
+            return None
+        if minx < self.minx or maxx > self.maxx or miny < self.miny or maxy > self.maxy:
+            return np.array([CROSSING], dtype=np.uint8)
+        last = self.grid_size - 1
+        col0 = min(int((minx - self.minx) / self.cell_width), last)
+        col1 = min(int((maxx - self.minx) / self.cell_width), last)
+        row0 = min(int((miny - self.miny) / self.cell_height), last)
+        row1 = min(int((maxy - self.miny) / self.cell_height), last)
+        return self.cells[row0:row1 + 1, col0:col1 + 1]
+
+    # Classify a geometry as INSIDE, OUTSIDE or CROSSING. Also returns the
+    # indexes of the parts it crosses.
+    def classify(self, geom):
+        minx, maxx, miny, maxy = geom.GetEnvelope()
+        cells = self._cells(minx, maxx, miny, maxy)
+        if cells is None or (cells == OUTSIDE).all():
+            return OUTSIDE, None
+        if (cells == INSIDE).all():
+            return INSIDE, None
+
+        candidates = np.flatnonzero(
+            (self.part_minx <= maxx) & (self.part_maxx >= minx) &
+            (self.part_miny <= maxy) & (self.part_maxy >= miny))
+        crossing = []
+        for i in candidates.tolist():
+            if self.prepared_parts[i].Contains(geom):
+                return INSIDE, None
+            if self.prepared_parts[i].Intersects(geom):
+                crossing.append(i)
+        if not crossing:
+            return OUTSIDE, None
+        return CROSSING, crossing
+
+    # Clip a geometry. Returns the geometry itself when it is inside, None when
+    # it is outside or nothing of its own dimension is left, otherwise the
+    # intersection promoted to the multi type of the geometry's dimension. A
+    # single point touching the trim is kept as it is, so point layers keep
+    # their type.
+    def clip(self, geom):
+        status, crossing = self.classify(geom)
+        self.counts[status] += 1
+        if status == INSIDE:
+            return geom
+        if status == CROSSING and ogr.GT_Flatten(geom.GetGeometryType()) == ogr.wkbPoint:
+            return geom
+        if status == OUTSIDE:
+            return None
+
+        if len(crossing) == 1:
+            clipped = geom.Intersection(self.parts[crossing[0]])
+        else:
+            clipped = geom.Intersection(self.trim)
+        if clipped is None:
+            return None
+        return promote(clipped, geom.GetDimension())
@@ -0,0 +1,165 @@
+# Base-36 code allocation.
+#
+# The example codes are the 46,656 three character codes 000 to ZZZ. The codes
+# table is filled with one INSERT ... SELECT over generate_series, and carries a
+# used flag with a partial index over the free codes. Clients reserve the next
+# N free codes with FOR UPDATE SKIP LOCKED, so concurrent clients each take
+# different rows instead of queueing behind one another's locks:
+#
+#   codealloc.create_codes(conn, 'example', 'codes')
+#   codes = pgdb.run('local', lambda conn: codealloc.reserve(conn, 10))
+#
+# A UsedBitmap, see load_bitmap, keeps the used codes in memory, one flag per
+# code, for gap lookups without a query.
+
+import numpy as np
+
+CHARS = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+CODE_LENGTH = 3
+CODE_COUNT = len(CHARS) ** CODE_LENGTH
+
+SCHEMA = 'example'
+TABLE = 'codes'
+
+
+# The code with index n, 0 is '000' and CODE_COUNT - 1 is 'ZZZ'.
+def code_at(n):
+    code = ''
+    for i in range(CODE_LENGTH):
+        n, m = divmod(n, len(CHARS))
+        code = CHARS[m] + code
+    return code
+
+
+def code_index(code):
+    n = 0
+    for c in code:
+        n = n * len(CHARS) + CHARS.index(c)
+    return n
+
+
+# The code after code, None after the last one.
+def next_code(code):
+    n = code_index(code) + 1
+    return code_at(n) if n < CODE_COUNT else None
+
+
+# SQL expression for the code of the integer expression n.
+def code_sql(n):
+    digits = []
+    for i in range(CODE_LENGTH - 1, -1, -1):
+        digits.append("substr('{chars}', ({n} / {div}) % {base} + 1, 1)".format(
+            chars=CHARS, n=n, div=len(CHARS) ** i, base=len(CHARS)))
+    return ' || '.join(digits)
+
+
+# Create the codes table and fill it with every code, gid is the code index
+# plus one. Replaces an existing table.
+def create_codes(conn, schema=SCHEMA, table=TABLE):
+    with conn.cursor() as curs:
+        curs.execute("""
+        DROP TABLE IF EXISTS {schema}.{table};
+        CREATE TABLE {schema}.{table}
+        (
+          gid serial NOT NULL,
+          code character(3),
+          used boolean NOT NULL DEFAULT false,
+          CONSTRAINT {table}_pkey PRIMARY KEY (gid)
+        );
+
+        INSERT INTO {schema}.{table} (gid, code)
+          SELECT n + 1, {code}
+          FROM generate_series(0, {last}) AS n;
+        SELECT setval(pg_get_serial_sequence('{schema}.{table}', 'gid'), {count});
+
+        CREATE UNIQUE INDEX {table}_code_idx ON {schema}.{table} (code);
+        CREATE INDEX {table}_free_idx ON {schema}.{table} (gid) WHERE NOT used;
+        ANALYZE {schema}.{table};
+        """.format(schema=schema, table=table, code=code_sql('n'),
+                   last=CODE_COUNT - 1, count=CODE_COUNT))
+
+
+# Reserve the next count free codes, in code order, skipping rows other
+# transactions hold. Returns the codes, fewer than count when the free codes
+# run out. The codes are held until the caller commits.
+def reserve(conn, count, schema=SCHEMA, table=TABLE):
+    with conn.cursor() as curs:
+        curs.execute("""
+        UPDATE {schema}.{table} AS c SET used = true
+        FROM (
+          SELECT gid FROM {schema}.{table}
+          WHERE NOT used
+          ORDER BY gid
+          LIMIT %s
+          FOR UPDATE SKIP LOCKED
+        ) AS free
+        WHERE c.gid = free.gid
+        RETURNING c.code
+        """.format(schema=schema, table=table), (count,))
+        return sorted(row[0] for row in curs.fetchall())
+
+
+# Return codes to the free pool.
+def release(conn, codes, schema=SCHEMA, table=TABLE):
+    with conn.cursor() as curs:
+        curs.execute("""
+        UPDATE {schema}.{table} SET used = false WHERE code = ANY(%s) AND used
+        """.format(schema=schema, table=table), (list(codes),))
+        return curs.rowcount
+
+
+# Mark the codes listed in another table as used, e.g. the example used table.
+def mark_used(conn, used_table, schema=SCHEMA, table=TABLE):
+    with conn.cursor() as curs:
+        curs.execute("""
+        UPDATE {schema}.{table} AS c SET used = true
+        FROM {schema}.{used_table} AS u
+        WHERE u.code = c.code AND NOT c.used
+        """.format(schema=schema, table=table, used_table=used_table))
+        return curs.rowcount
+
+
+# The used codes as one flag per code index.
+class UsedBitmap:
+
+    def __init__(self, used=()):
+        self.used = np.zeros(CODE_COUNT, dtype=bool)
+        self.mark(used)
+
+    def mark(self, codes):
+        self.used[[code_index(code) for code in codes]] = True
+
+    def clear(self, codes):
+        self.used[[code_index(code) for code in codes]] = False
+
+    def is_used(self, code):
+        return bool(self.used[code_index(code)])
+
+    # The first free code at or after code, None when there is none. argmin
+    # stops at the first False flag, without building an inverted copy.
+    def next_free(self, code=None):
+        start = code_index(code) if code is not None else 0
+        flags = self.used[start:]
+        if flags.size == 0:
+            return None
+        n = int(np.argmin(flags))
+        return None if flags[n] else code_at(start + n)
+
+    # Every free code, in code order.
+    def free_codes(self):
+        return [code_at(n) for n in np.flatnonzero(~self.used).tolist()]
+
+    # Number of used codes.
+    @property
+    def used_count(self):
+        return int(np.count_nonzero(self.used))
+
+
+# A bitmap of the used codes of a codes table.
+def load_bitmap(conn, schema=SCHEMA, table=TABLE):
+    bitmap = UsedBitmap()
+    with conn.cursor() as curs:
+        curs.execute('SELECT gid - 1 FROM {schema}.{table} WHERE used'.format(
+            schema=schema, table=table))
+        bitmap.used[np.array([row[0] for row in curs.fetchall()], dtype=np.int64)] = True
+    return bitmap
@@ -1,38 +1,21 @@
 
 import psycopg2
-import string
 import random
 import time
 
-DSN = 'dbname=postgis_scratch user=postgres host=localhost password=pg'
+import codealloc
+import pgdb
+
+DSN = pgdb.dsn('local')
 
 schema = 'example'
 codes_table = 'codes'
 used_table = 'used'
 
-CHARS = string.digits + string.ascii_uppercase
-
-def next_code(code):
-    d = 1
-    next = ''
-    for n in (2,1,0):
-        d, m = divmod(CHARS.index(code[n]) + d, 36)
-        next = CHARS[m] + next
-    return None if d == 1 else next
-
 with psycopg2.connect(DSN) as conn,  conn.cursor() as curs:
 
     qstr = """
 
-    DROP TABLE IF EXISTS {schema}.{codes_table};
-    CREATE TABLE {schema}.{codes_table}
-    (
-      gid serial NOT NULL,
-      code character(3),
-      CONSTRAINT {codes_table}_pkey PRIMARY KEY (gid)
-    )
-    WITH (OIDS=FALSE);
-
     DROP TABLE IF EXISTS {schema}.{used_table};
     CREATE TABLE {schema}.{used_table}
     (
@@ -45,22 +28,9 @@ with psycopg2.connect(DSN) as conn,  conn.cursor() as curs:
     """.format(schema=schema, codes_table=codes_table, used_table=used_table)
     curs.execute(qstr)
 
-    qstr = """
-    INSERT INTO {schema}.{codes_table} (code) VALUES
-    """.format(schema=schema, codes_table=codes_table)
-
+    # All 46,656 codes in one INSERT ... SELECT, see codealloc.
     startTime = time.time()
-
-    for c in [c2+c1 for c2 in CHARS for c1 in CHARS]:
-
-        codes = ",".join(["('{0}')".format(c+c0) for c0 in CHARS])
-
-        curs.execute(
-            'INSERT INTO {schema}.{codes_table} (code) VALUES {codes}'.format(
-                schema=schema, codes_table=codes_table,  codes=codes
-            )
-        )
-
+    codealloc.create_codes(conn, schema, codes_table)
     endTime = time.time()
     print('\ntime: {0:.3f} sec'.format(endTime - startTime))
 
@@ -76,22 +46,19 @@ with psycopg2.connect(DSN) as conn,  conn.cursor() as curs:
     )
     curs.execute(qstr)
 
-    qstr = """
-    SELECT code
-    FROM {schema}.{codes_table} c
-    LEFT JOIN {schema}.{used_table} u USING (code)
-    WHERE u.code IS NULL;
-
-    """.format(schema=schema, codes_table=codes_table, used_table=used_table)
-    curs.execute(qstr)
-    n = curs.rowcount
+    # Flag the used codes, the free ones are the gaps in a bitmap of the flags.
+    codealloc.mark_used(conn, used_table, schema, codes_table)
+    missing = codealloc.load_bitmap(conn, schema, codes_table).free_codes()
+    n = len(missing)
     print('missing codes: {0}'.format(
         'none found.' if n == 0 else str(n)
     ))
-    rows = curs.fetchall()
-    for rec in rows:
-        print('  {0}'.format(rec[0]))
+    for code in missing:
+        print('  {0}'.format(code))
 
+    # Reserve the free codes, concurrent clients would each get different ones.
+    reserved = codealloc.reserve(conn, 3, schema, codes_table)
+    print('reserved: ' + ', '.join(reserved))
 
     qstr = """
     DROP FUNCTION IF EXISTS example.next_code(char(3));
@@ -1,5 +1,15 @@
 
 -- Format an azimuth in radians as a bearing in decimal degrees.
+--
+-- A single SQL expression, so the planner inlines it into the calling query
+-- when the azimuth argument is a column or another cheap expression (an
+-- argument used more than once has to be cheap to inline), and PARALLEL SAFE.
+-- It is STABLE rather than IMMUTABLE because to_char is STABLE, and a function
+-- is only inlined when its body is no more volatile than its declaration.
+-- The arithmetic follows the former plpython3u version step for step, so the
+-- bearings are the same: math.degrees is x * (180 / pi), not degrees(x), and
+-- to_char rounds with the C library printf as Python's format does.
+-- ST_Azimuth returns NULL when given two identical points, NULL is taken as 0.
 
 DROP FUNCTION IF EXISTS ST_AsBearing(float, integer);
 
@@ -8,24 +18,39 @@ CREATE OR REPLACE FUNCTION ST_AsBearing(
   param_ndigits integer DEFAULT 0)
 RETURNS text AS
 $$
-import math
+SELECT
+  substr('NSSN',
+    (floor(coalesce(param_azimuth, 0.0) / (pi() / 2.0))
+      - 4 * floor(floor(coalesce(param_azimuth, 0.0) / (pi() / 2.0)) / 4))::integer + 1, 1)
+  || to_char(
+    asin(abs(sin(coalesce(param_azimuth, 0.0)))) * (180.0 / pi()),
+    'FM00' || CASE WHEN coalesce(param_ndigits, 0) > 0
+      THEN '.' || repeat('0', param_ndigits) ELSE '' END)
+  || substr('EEWW',
+    (floor(coalesce(param_azimuth, 0.0) / (pi() / 2.0))
+      - 4 * floor(floor(coalesce(param_azimuth, 0.0) / (pi() / 2.0)) / 4))::integer + 1, 1)
+$$ LANGUAGE sql STABLE PARALLEL SAFE
+;
 
-# ST_Azimuth return NULL when given tow identical points
-azimuth = param_azimuth if param_azimuth is not None else 0.0
-ndigits = param_ndigits if param_ndigits is not None else 0
+COMMENT ON FUNCTION ST_AsBearing(float, integer) IS
+  'args: azimuth, ndigits - Return text representation of azimuth as a bearing in decimal degrees.';
 
-quadrant = ('NE','SE','SW','NW')[int((azimuth // (math.pi/2.0)) % 4)]
-degrees = math.degrees(math.asin(abs(math.sin(azimuth))))
-width = ndigits + (2 if ndigits == 0 else 3)
-bearing = '{0:s}{1:0{2:d}.{3:d}f}{4:s}'.format(quadrant[0], degrees, width, ndigits, quadrant[1])
+-- Batch variant, the bearings of an array of azimuths in one call.
 
-return bearing
+DROP FUNCTION IF EXISTS ST_AsBearingArray(float[], integer);
 
-$$ LANGUAGE plpython3u IMMUTABLE
+CREATE OR REPLACE FUNCTION ST_AsBearingArray(
+  param_azimuths float[],
+  param_ndigits integer DEFAULT 0)
+RETURNS text[] AS
+$$
+SELECT coalesce(array_agg(ST_AsBearing(azimuth, param_ndigits) ORDER BY n), '{}')
+FROM unnest(param_azimuths) WITH ORDINALITY AS u (azimuth, n)
+$$ LANGUAGE sql STABLE PARALLEL SAFE
 ;
 
-COMMENT ON FUNCTION ST_AsBearing(float, integer) IS
-  'args: azimuth, ndigits - Return text representation of azimuth as a bearing in decimal degrees.';
+COMMENT ON FUNCTION ST_AsBearingArray(float[], integer) IS
+  'args: azimuths, ndigits - Return text representations of an array of azimuths as bearings in decimal degrees.';
 
 SELECT azimuth::numeric(5,2),
   ST_AsBearing(radians(azimuth)) AS bearing,
@@ -66,7 +91,7 @@ CREATE OR REPLACE FUNCTION ST_Similarity(
 RETURNS geometry AS
 $$
 SELECT ST_Affine(geom, a1, -b1, b1, a1, a0, b0)
-$$ LANGUAGE sql IMMUTABLE
+$$ LANGUAGE sql IMMUTABLE PARALLEL SAFE
 ;
 
 COMMENT ON FUNCTION ST_Similarity(geometry, float, float, float, float) IS
@@ -75,27 +100,59 @@ COMMENT ON FUNCTION ST_Similarity(geometry, float, float, float, float) IS
 
 DROP FUNCTION IF EXISTS ST_InverseSimilarity(geometry,  float, float, float, float);
 
+-- The inverse coefficients are written out in the expression rather than in
+-- CTEs, which the planner can't inline. The operations are those of the
+-- former CTE version, so the results are the same.
+--   idet = 1/(a1^2 + b1^2)
+--   ia0 = -idet*(a0*a1 + b0*b1)    ia1 = idet*a1
+--   ib0 = -idet*(a1*b0 - a0*b1)    ib1 = -idet*b1
+
 CREATE OR REPLACE FUNCTION ST_InverseSimilarity(
   geom geometry, a0 float, b0 float, a1 float, b1 float)
 RETURNS geometry AS
 $$
-WITH a AS (
-    SELECT 1.0/(a1^2 + b1^2) AS idet
-  ), b AS (
-    SELECT
-      -idet * ( a0*a1 + b0*b1) AS ia0,
-      -idet * (-a0*b1 + a1*b0) AS ib0,
-       idet *  a1 AS              ia1,
-       idet * -b1 AS              ib1
-    FROM a
-  )
-SELECT ST_Affine(geom, ia1, -ib1, ib1, ia1, ia0, ib0)
-FROM b
-$$ LANGUAGE sql IMMUTABLE;
+SELECT ST_Affine(geom,
+  (1.0/(a1^2 + b1^2)) * a1,
+  -((1.0/(a1^2 + b1^2)) * -b1),
+  (1.0/(a1^2 + b1^2)) * -b1,
+  (1.0/(a1^2 + b1^2)) * a1,
+  -(1.0/(a1^2 + b1^2)) * ( a0*a1 + b0*b1),
+  -(1.0/(a1^2 + b1^2)) * (-a0*b1 + a1*b0))
+$$ LANGUAGE sql IMMUTABLE PARALLEL SAFE;
 
 COMMENT ON FUNCTION ST_InverseSimilarity(geometry, float, float, float, float) IS
   'args: geom, a0, b0, a1, b1 - Applies inverse transform to uniformly scale, rotate and translate 2D geometry.';
 
+-- Batch variants, an array of geometries transformed in one call.
+
+DROP FUNCTION IF EXISTS ST_SimilarityArray(geometry[], float, float, float, float);
+
+CREATE OR REPLACE FUNCTION ST_SimilarityArray(
+  geoms geometry[], a0 float, b0 float, a1 float, b1 float)
+RETURNS geometry[] AS
+$$
+SELECT coalesce(array_agg(ST_Similarity(geom, a0, b0, a1, b1) ORDER BY n), '{}')
+FROM unnest(geoms) WITH ORDINALITY AS u (geom, n)
+$$ LANGUAGE sql IMMUTABLE PARALLEL SAFE
+;
+
+COMMENT ON FUNCTION ST_SimilarityArray(geometry[], float, float, float, float) IS
+  'args: geoms, a0, b0, a1, b1 - Applies transform to uniformly scale, rotate and translate an array of 2D geometries.';
+
+DROP FUNCTION IF EXISTS ST_InverseSimilarityArray(geometry[], float, float, float, float);
+
+CREATE OR REPLACE FUNCTION ST_InverseSimilarityArray(
+  geoms geometry[], a0 float, b0 float, a1 float, b1 float)
+RETURNS geometry[] AS
+$$
+SELECT coalesce(array_agg(ST_InverseSimilarity(geom, a0, b0, a1, b1) ORDER BY n), '{}')
+FROM unnest(geoms) WITH ORDINALITY AS u (geom, n)
+$$ LANGUAGE sql IMMUTABLE PARALLEL SAFE
+;
+
+COMMENT ON FUNCTION ST_InverseSimilarityArray(geometry[], float, float, float, float) IS
+  'args: geoms, a0, b0, a1, b1 - Applies inverse transform to uniformly scale, rotate and translate an array of 2D geometries.';
+
 WITH a AS (
     SELECT
       radians(-1.5) AS rotate,
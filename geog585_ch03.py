@@ -2,15 +2,13 @@
 # reproject the shapefile geometry from EPSG:4326 to EPSG:3857 and load resulting
 # layers into PostGIS tables in the geog585 schema.
 
-import ogr, osr
+import ogr
 import os
 from glob import glob
 
-ogr.UseExceptions()
-
-# PostGIS geometry type modifiers.
-def postgis_geom_type(type):
-    return 'Geometry' if type == 0 else ogr.GeometryTypeToName(type).replace(' ', '')
+import manifest
+import pgdb
+import shpingest
 
 src_dir = '../../Mapping/geog585/ch03/PhiladelphiaBaseLayers'
 src_srid = 4326
@@ -20,112 +18,89 @@ dest_srid = 3857
 
 trim_shapefile = 'clipFeature/city_limits.shp'
 
-DSN = 'PG: host=localhost dbname=postgis_scratch user=postgres password=pg'
-
-# SRS transform to project geometry: 4326 -> 3857
-src_srs = osr.SpatialReference()
-src_srs.ImportFromEPSG(src_srid)
-dest_srs = osr.SpatialReference()
-dest_srs.ImportFromEPSG(dest_srid)
-srsTransform = osr.CoordinateTransformation(src_srs, dest_srs)
-
-# Open a connection to PostgreSQL.
-destDS = ogr.Open(DSN, 1)
-
-# Driver for reading source shapefiles.
-srcDriver = ogr.GetDriverByName('ESRI Shapefile')
-os.chdir(src_dir)
-
-# Get trim geometry.
-trimDS = srcDriver.Open(trim_shapefile, 0)
-trimLayer = trimDS.GetLayer()
-trimFeature = trimLayer.GetFeature(0)
-trimGeom = trimFeature.GetGeometryRef()
-
-for shapefile in glob('*.shp'):
-
-    srcDS = srcDriver.Open(shapefile, 0)
-    srcLayer = srcDS.GetLayer()
-    srcLayer.SetSpatialFilter(trimGeom)
-
-    layer_name = srcLayer.GetName()
-    geom_type = postgis_geom_type(srcLayer.GetGeomType())
-    feature_count = srcLayer.GetFeatureCount()
-    print('{0}: {1} count = {2}'.format(layer_name, geom_type, feature_count))
-
-    # Common layer format.
-    qstr = """
-    DROP TABLE IF EXISTS {schema}.{layer};
-    CREATE TABLE {schema}.{layer} (
-      gid serial NOT NULL,
-      osm_id bigint,
-      name character varying(48),
-      type character varying(48),
-      geom geometry({geom_type}, {srid}),
-      CONSTRAINT {layer}_pkey PRIMARY KEY (gid))
-    WITH (OIDS=FALSE);
-    """.format(schema=dest_schema, layer=layer_name, geom_type=geom_type, srid=dest_srid)
-
-    # Special processing for specific layers.
-    if layer_name == 'roads':
-        qstr += """
-        ALTER TABLE {schema}.{layer}
-          ADD COLUMN ref character varying(48),
-          ADD COLUMN oneway integer,
-          ADD COLUMN bridge integer,
-          ALTER COLUMN geom SET DATA TYPE geometry(MultiLineString, {srid});
-        """.format(schema=dest_schema, layer=layer_name, srid=dest_srid)
-
-    elif layer_name == 'places':
-        qstr += """
-        ALTER TABLE {schema}.{layer}
-          ADD COLUMN population integer;
-        """.format(schema=dest_schema, layer=layer_name)
-
-    elif layer_name == 'waterways':
-        qstr += """
-        ALTER TABLE {schema}.{layer}
-          ADD COLUMN width integer;
-        """.format(schema=dest_schema, layer=layer_name)
-
-    destDS.ExecuteSQL(qstr)
-    destLayer = destDS.GetLayerByName(dest_schema + '.' + layer_name)
-    destFeatureDefn = destLayer.GetLayerDefn()
-
-    for srcFeature in srcLayer:
-        destFeature = ogr.Feature(destFeatureDefn)
-
-        # Common fields for all layers.
-        field_names = ['osm_id', 'name', 'type']
-
-        # Extra fields for specific layers.
-        if layer_name == 'roads':
-            field_names += ['ref', 'oneway', 'bridge']
-
-        elif layer_name == 'waterways':
-            field_names += ['width']
-
-        elif layer_name == 'places':
-            field_names += ['population']
-
-        for field in field_names:
-            destFeature.SetField(field, srcFeature.GetField(field))
-
-        geom = srcFeature.GetGeometryRef()
-        geom.Transform(srsTransform)
-
-        # Convert road geometry to MultiLineString.
-        if layer_name == 'roads':
-            geom = ogr.ForceToMultiLineString(geom)
-
-        destFeature.SetGeometry(geom)
-        destLayer.CreateFeature(destFeature)
-
-# Change road columns 'oneway' and 'bridge' to boolean.
-qstr = """
-ALTER TABLE {schema}.roads
-  ALTER oneway TYPE boolean USING oneway::boolean,
-  ALTER bridge TYPE boolean USING bridge::boolean;
-""".format(schema=dest_schema)
-destDS.ExecuteSQL(qstr)
-destDS = None
+DSN = pgdb.ogr_dsn('local')
+
+# How features are written to PostGIS:
+#   'feature' - one OGR CreateFeature (INSERT) per feature
+#   'copy'    - batched COPY of hex EWKB rows, see pgcopy.py
+LOAD_MODE = 'copy'
+
+# Clip features to the trim geometry. Otherwise every feature whose bounding
+# box touches it is loaded whole.
+CLIP = True
+
+# Load into UNLOGGED staging tables, then add the primary key and a GiST index,
+# ANALYZE and swap them in, see tableload.py. Otherwise load straight into
+# tables with their primary key.
+STAGED_LOAD = True
+
+# Record loads in the geog585.ingest_manifest table. Layers whose shapefiles
+# have not changed are skipped, and an interrupted 'copy' load resumes from its
+# last committed batch. Otherwise every layer is reloaded.
+USE_MANIFEST = True
+
+# Layers loaded at once, each by its own process with its own shapefile handle
+# and PostGIS connection. Use 1 to load the layers one after another.
+WORKERS = 4
+
+# Reprojection threads in each layer's read -> reproject -> write pipeline.
+TRANSFORM_WORKERS = 2
+
+
+def report(result, done, total):
+    if result.error is not None:
+        print('[{0}/{1}] {2}: FAILED {3}'.format(done, total, result.layer_name, result.error))
+    else:
+        print('[{0}/{1}] {2}: {3} rows in {4:.2f} sec, {5:,.0f} rows/s'.format(
+            done, total, result.layer_name, result.rows, result.elapsed, result.rows_per_sec))
+        if result.clip_counts is not None:
+            print('  clip: {inside} inside, {crossing} crossing, {outside} outside'.format(
+                **result.clip_counts))
+    if result.stages is not None:
+        for stage in result.stages:
+            print('  ' + stage)
+    if result.timings is not None:
+        print('  ' + ', '.join('{0} {1:.2f} sec'.format(name, seconds)
+                               for name, seconds in result.timings.items()))
+
+
+if __name__ == '__main__':
+
+    ogr.UseExceptions()
+
+    # Open a connection to PostgreSQL.
+    destDS = ogr.Open(DSN, 1)
+
+    # Driver for reading source shapefiles.
+    srcDriver = ogr.GetDriverByName('ESRI Shapefile')
+    os.chdir(src_dir)
+
+    # Get trim geometry.
+    trimDS = srcDriver.Open(trim_shapefile, 0)
+    trimLayer = trimDS.GetLayer()
+    trimFeature = trimLayer.GetFeature(0)
+    trimGeom = trimFeature.GetGeometryRef()
+
+    settings = shpingest.IngestSettings(
+        DSN, dest_schema, src_srid, dest_srid, LOAD_MODE, trimGeom.ExportToWkb(), CLIP,
+        STAGED_LOAD, USE_MANIFEST, TRANSFORM_WORKERS)
+    trimGeom = trimFeature = trimLayer = trimDS = None
+
+    # Create all the tables before loading any of them.
+    shapefiles = [os.path.abspath(shapefile) for shapefile in glob('*.shp')]
+    plans = shpingest.prepare_layers(destDS, shapefiles, settings)
+    for plan in plans:
+        if plan.action == manifest.LOAD:
+            print('{0}: {1} count = {2}'.format(plan.layer_name, plan.geom_type, plan.feature_count))
+        elif plan.action == manifest.RESUME:
+            print('{0}: resume after {1} features, {2} rows loaded'.format(
+                plan.layer_name, plan.source_offset, plan.rows_loaded))
+        else:
+            print('{0}: unchanged'.format(plan.layer_name))
+
+    results = shpingest.ingest_layers(plans, settings, WORKERS, report)
+    failed = [result.layer_name for result in results if result.error is not None]
+    destDS = None
+
+    if failed:
+        print('Failed layers: ' + ', '.join(failed))
@@ -21,136 +21,116 @@
 # to incorporate the interstate and recreation area criteria for extra credit. If you
 # do so correctly you will end up with 4 candidate cities.
 
-import psycopg2
-import psycopg2.extras
+import asyncio
 
-DSN = 'dbname=postgis_scratch user=postgres host=localhost password=pg'
-DSN_Z400 = 'dbname=postgis_scratch user=postgres host=z400 password=pg707'
+import pgcopy
+import pgdb
+import siteselect
 
-with psycopg2.connect(DSN) as conn, psycopg2.connect(DSN_Z400) as rconn:
-    with conn.cursor() as curs:
-        qstr = """
-        SELECT ci.name AS city, co.name AS county,
-            co.no_farms87::integer AS farms,
-            co.age_18_64::integer AS labor_pool,
-            ci.crime_inde::numeric(6,4) AS crime_index,
-            co.pop_sqmile::numeric(6,2) AS pop_density,
-            ci.university > 0 AS university,
-            miles_to_recreation, miles_to_interstate
-        FROM (
-          SELECT intco.gid AS county_gid, intci.gid AS city_gid,
-            min (
-              ST_Distance(ST_Transform(intci.geom, 2272), ST_Transform(rec.geom, 2272)) / 5280
-            )::numeric(6,2) AS miles_to_recreation,
-            min (
-              ST_Distance(ST_Transform(intci.geom, 2272), ST_Transform(ist.geom, 2272)) / 5280
-            )::numeric(6,2) AS miles_to_interstate
-          FROM geog897d.v_jb_candidate_counties AS intco
-            INNER JOIN geog897d.cities AS intci ON ST_Contains(intco.geom, intci.geom),
-            geog897d.rec_areas AS rec,
-            geog897d.interstates AS ist
-          GROUP BY county_gid, city_gid
-        ) AS a
-          INNER JOIN geog897d.cities AS ci ON ci.gid = city_gid
-          INNER JOIN geog897d.counties AS co on co.gid = county_gid
-        WHERE ci.crime_inde <= 0.02
-            AND ci.university > 0
-            -- AND miles_to_recreation <= 10
-            -- AND miles_to_interstate <= 20
-        ORDER BY miles_to_interstate
-        """
+# The extra credit criteria, in miles. None to report the distances only.
+MAX_RECREATION_MILES = None     # 10
+MAX_INTERSTATE_MILES = None     # 20
 
-        curs.execute(qstr)
-        rows = curs.fetchall()
-
-        for rec in rows:
-            city, county, farms, labor_pool, crime_index = rec[0:5]
-            pop_density, university, miles_to_recreation, miles_to_interstate = rec[5:9]
-            
-            print('{0:6.2f}: {1}'.format(miles_to_interstate, city))
-            
-        # Query roster data from local database.
-        qstr = """
-        SELECT first_name, last_name, postal_code
-        FROM geog897d.roster
-        """
-        curs.execute(qstr)
-        students = curs.fetchall()
-        
-        print()
-        print('SELECT: ' + str(curs.rowcount) + ' rows returned.')
-        
-        # Close local cursor and send roster data to remote database.
-        curs.close()
+ROSTER_DDL = """
+DROP SCHEMA IF EXISTS sample CASCADE;
 
-    with rconn.cursor() as rcurs:
+CREATE SCHEMA sample
+  AUTHORIZATION postgres;
 
-        qstr = """
-        DROP SCHEMA IF EXISTS sample CASCADE;
-        
-        CREATE SCHEMA sample
-          AUTHORIZATION postgres;
-          
-        CREATE TABLE sample.roster
-        (
-          gid serial NOT NULL,
-          first_name character varying(50),
-          last_name character varying(50),
-          postal_code character varying(6),
-          CONSTRAINT roster_pkey PRIMARY KEY (gid)
-        )
-        WITH (
-          OIDS=FALSE
-        );
-        
-        ALTER TABLE sample.roster
-          OWNER TO postgres;
+CREATE TABLE sample.roster
+(
+  gid serial NOT NULL,
+  first_name character varying(50),
+  last_name character varying(50),
+  postal_code character varying(6),
+  CONSTRAINT roster_pkey PRIMARY KEY (gid)
+)
+WITH (
+  OIDS=FALSE
+);
 
-        """
-        rcurs.execute(qstr)
-        
-        qstr = """
-        INSERT INTO sample.roster (first_name, last_name, postal_code)
-        VALUES (%s, %s, %s)
-        """
-        rcurs.executemany(qstr, students)
-        print('INSERT: ' + str(rcurs.rowcount) + ' rows effected.')
-        
-        # Done with remote database.
-        rcurs.close()
-        
-    # Use dictionary names for columns.
-    with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as curs:
-
-        # Charlie Mack - 93436
-        # Michael Mack - 93421
+ALTER TABLE sample.roster
+  OWNER TO postgres;
+"""
 
-        qstr = """
-        SELECT first_name AS first, last_name AS last, postal_code AS zip
-        FROM geog897d.roster WHERE postal_code LIKE '93%'
-        """
-        curs.execute(qstr)
-        rows = curs.fetchall()
-        students = rows
-        
-        print()
-        print('SELECT: ' + str(curs.rowcount) + ' rows returned.')
-        for rec in rows:
-            print(rec['first'] + ' ' + rec['last'] + ' - ' + rec['zip'])
+
+# Stream the roster from the local database to z400, COPY to COPY without
+# materializing the rows, see pgcopy.copy_table.
+def transfer_roster(conn):
+
+    def copy(rconn):
+        with rconn.cursor() as rcurs:
+            rcurs.execute(ROSTER_DDL)
+        return pgcopy.copy_table(conn, rconn, 'geog897d.roster', 'sample.roster',
+                                 columns=['first_name', 'last_name', 'postal_code'])
+
+    return pgdb.run('z400', copy)
+
+
+# Candidate cities with the distance to the nearest recreation area and
+# interstate, from indexed 2272 geometry columns, see siteselect.
+def select_sites(conn):
+    siteselect.prepare(conn)
+    sql, args = siteselect.selection_query(max_recreation_miles=MAX_RECREATION_MILES,
+                                           max_interstate_miles=MAX_INTERSTATE_MILES)
+    return list(pgdb.iter_query(conn, sql, args))
+
+
+# The site selection and the roster transfer are independent, run them
+# concurrently.
+async def select_and_transfer():
+    return await asyncio.gather(
+        pgdb.arun('local', select_sites),
+        pgdb.arun('local', transfer_roster))
+
+
+rows, roster_copy = asyncio.run(select_and_transfer())
+
+for rec in rows:
+    print('{0:6.2f}: {1}'.format(rec.miles_to_interstate, rec.city))
+
+print()
+print('COPY: ' + roster_copy.report())
+
+
+# Rows are records, columns are read by name.
+def update_roster(conn):
+
+    # Charlie Mack - 93436
+    # Michael Mack - 93421
+
+    qstr = """
+    SELECT first_name AS first, last_name AS last, postal_code AS zip
+    FROM geog897d.roster WHERE postal_code LIKE '93%'
+    """
+    students = list(pgdb.iter_query(conn, qstr))
+
+    print()
+    print('SELECT: ' + str(len(students)) + ' rows returned.')
+    for rec in students:
+        print(rec.first + ' ' + rec.last + ' - ' + rec.zip)
+
+    with conn.cursor() as curs:
 
         qstr = """
         DELETE FROM geog897d.roster WHERE postal_code LIKE '93%'
         """
         curs.execute(qstr)
-        
+
         print()
-        print('DELETE: ' + str(curs.rowcount) + ' rows effected.') 
-        
+        print('DELETE: ' + str(curs.rowcount) + ' rows effected.')
+
         qstr = """
         INSERT INTO geog897d.roster (first_name, last_name, postal_code)
         VALUES (%s, %s, %s)
         """
         curs.executemany(qstr, students)
 
-        print('INSERT: ' + str(curs.rowcount) + ' rows effected.') 
+        print('INSERT: ' + str(curs.rowcount) + ' rows effected.')
+
+
+pgdb.run('local', update_roster)
 
+print()
+print(pgdb.report())
+pgdb.close_all()
@@ -0,0 +1,236 @@
+# Streaming histograms and quantiles for raster bands.
+#
+# BandSketch is a block statistics accumulator (see blockstats.band_statistics)
+# that builds a histogram of a band one block at a time. Partial sketches from
+# parallel workers merge into the same result as a single serial pass, and the
+# memory used doesn't depend on the raster size.
+#
+# Integer bands up to 16 bits keep one exact count per value, at most 65,536
+# counts. Histograms and quantiles of these bands are exact.
+#
+# Other bands use a log-bucket quantile sketch (DDSketch, Masson et al. 2019).
+# Values are counted in buckets whose bounds grow by a factor of
+#   gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+# so every value in a bucket is within relative_accuracy of the bucket's
+# representative value. A quantile is the representative value of the bucket
+# holding the value of that rank, so it is within relative_accuracy of the true
+# quantile: with the default relative_accuracy of 0.01 a true median of 0.500
+# is reported between 0.495 and 0.505. Values closer to zero than MIN_VALUE are
+# counted as zero. The positive and negative buckets are each limited to
+# max_buckets. With the default 0.01 accuracy 2,048 buckets cover values from
+# 1e-9 to more than 1e8, so the limit is not reached by ordinary data. Past the
+# limit the smallest magnitude buckets are merged and only quantiles falling in
+# them lose accuracy.
+#
+# The quantile of fraction q is the value at 0-based rank floor(q * (n - 1)) of
+# the n valid pixels sorted in increasing order.
+
+import functools
+import numpy as np
+
+import blockstats
+
+DEFAULT_RELATIVE_ACCURACY = 0.01
+DEFAULT_MAX_BUCKETS = 2048
+
+# Magnitudes below this are counted as zero by the sketch.
+MIN_VALUE = 1e-9
+
+
+# Bucket counts indexed by integer key, stored as a dense array from an offset.
+class _Buckets:
+
+    def __init__(self):
+        self.offset = 0
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    # Add counts for a range of keys starting at offset.
+    def add(self, offset, counts):
+        if counts.size == 0:
+            return
+        if self.counts.size == 0:
+            self.offset, self.counts = offset, counts.astype(np.int64)
+            return
+        lo = min(self.offset, offset)
+        hi = max(self.offset + self.counts.size, offset + counts.size)
+        if lo != self.offset or hi != self.offset + self.counts.size:
+            grown = np.zeros(hi - lo, dtype=np.int64)
+            grown[self.offset - lo:self.offset - lo + self.counts.size] = self.counts
+            self.offset, self.counts = lo, grown
+        self.counts[offset - self.offset:offset - self.offset + counts.size] += counts
+
+    # Add one count per key.
+    def add_keys(self, keys):
+        if keys.size:
+            lo = int(keys.min())
+            self.add(lo, np.bincount(keys - lo))
+
+    # Merge the lowest keys into one bucket so no more than max_buckets remain.
+    def collapse(self, max_buckets):
+        nonzero = np.flatnonzero(self.counts)
+        if nonzero.size == 0:
+            self.offset, self.counts = 0, np.zeros(0, dtype=np.int64)
+            return
+        self.offset += int(nonzero[0])
+        self.counts = self.counts[nonzero[0]:nonzero[-1] + 1]
+        excess = self.counts.size - max_buckets
+        if excess > 0:
+            self.counts[excess] += self.counts[:excess].sum()
+            self.counts = self.counts[excess:]
+            self.offset += excess
+
+    # Keys of the buckets holding counts and the counts.
+    def items(self):
+        nonzero = np.flatnonzero(self.counts)
+        return nonzero + self.offset, self.counts[nonzero]
+
+
+# Histogram and quantile accumulator for one band.
+class BandSketch:
+
+    def __init__(self, relative_accuracy=DEFAULT_RELATIVE_ACCURACY,
+                 max_buckets=DEFAULT_MAX_BUCKETS):
+        self.relative_accuracy = relative_accuracy
+        self.max_buckets = max_buckets
+        self.gamma = (1.0 + relative_accuracy) / (1.0 - relative_accuracy)
+        self.exact = None
+        self.count = 0
+        self.nodata = 0
+        self.zero = 0
+        self.values = _Buckets()
+        self.positive = _Buckets()
+        self.negative = _Buckets()
+
+    # Add a block of data. Pixels equal to nodata_value and non-finite values
+    # are counted as nodata.
+    def update(self, data, nodata_value=None):
+        self.count += data.size
+
+        if nodata_value is not None:
+            if np.isnan(nodata_value):
+                valid = ~np.isnan(data)
+            else:
+                valid = np.not_equal(data, nodata_value)
+            if data.dtype.kind == 'f':
+                valid &= np.isfinite(data)
+        elif data.dtype.kind == 'f':
+            valid = np.isfinite(data)
+        else:
+            valid = None
+
+        if valid is not None:
+            data = data[valid]
+            self.nodata += valid.size - data.size
+
+        if self.exact is None:
+            self.exact = data.dtype.kind in 'ui' and data.dtype.itemsize <= 2
+        if data.size == 0:
+            return
+
+        if self.exact:
+            data = data.ravel().astype(np.intp)
+            lo = int(data.min())
+            self.values.add(lo, np.bincount(data - lo))
+            return
+
+        data = data.ravel().astype(np.float64)
+        log_gamma = np.log(self.gamma)
+        magnitude = np.abs(data)
+        small = magnitude < MIN_VALUE
+        self.zero += int(np.count_nonzero(small))
+
+        keys = np.ceil(np.log(magnitude[~small]) / log_gamma).astype(np.int64)
+        negative = data[~small] < 0
+        self.positive.add_keys(keys[~negative])
+        self.negative.add_keys(keys[negative])
+        self.positive.collapse(self.max_buckets)
+        self.negative.collapse(self.max_buckets)
+
+    # Combine the partial sketch from another accumulator into this one.
+    def merge(self, other):
+        if self.exact is None:
+            self.exact = other.exact
+        self.count += other.count
+        self.nodata += other.nodata
+        self.zero += other.zero
+        self.values.add(other.values.offset, other.values.counts)
+        self.positive.add(other.positive.offset, other.positive.counts)
+        self.negative.add(other.negative.offset, other.negative.counts)
+        self.positive.collapse(self.max_buckets)
+        self.negative.collapse(self.max_buckets)
+        return self
+
+    # Number of pixels counted in the histogram.
+    @property
+    def valid(self):
+        return self.count - self.nodata
+
+    # Distinct values (or bucket values) in increasing order and their counts.
+    def distribution(self):
+        if self.exact:
+            return self.values.items()
+
+        pos_keys, pos_counts = self.positive.items()
+        neg_keys, neg_counts = self.negative.items()
+        scale = 2.0 / (1.0 + self.gamma)
+        values = np.concatenate((
+            -scale * self.gamma ** neg_keys[::-1].astype(np.float64),
+            [0.0] if self.zero else [],
+            scale * self.gamma ** pos_keys.astype(np.float64)))
+        counts = np.concatenate((
+            neg_counts[::-1], [self.zero] if self.zero else [], pos_counts)).astype(np.int64)
+        return values, counts
+
+    # Value of quantile q (0 to 1), or a list of values for a sequence of q.
+    def quantile(self, q):
+        values, counts = self.distribution()
+        if counts.size == 0:
+            return None
+        q = np.asarray(q, dtype=np.float64)
+        ranks = np.floor(q * (counts.sum() - 1)).astype(np.int64)
+        result = values[np.searchsorted(np.cumsum(counts), ranks, side='right')]
+        return result.tolist()
+
+    # Percentile clip range for a contrast stretch, e.g. (2, 98). (None, None)
+    # when the band has no valid pixels.
+    def clip_range(self, lower=2.0, upper=98.0):
+        values = self.quantile([lower / 100.0, upper / 100.0])
+        return (None, None) if values is None else tuple(values)
+
+    # Histogram counts and bin edges like numpy.histogram. The default range is
+    # the minimum and maximum value. Exact for integer bands, approximate (each
+    # value placed by its bucket value) for the sketch.
+    def histogram(self, bins=256, range=None):
+        values, counts = self.distribution()
+        if range is None and counts.size:
+            range = (values[0], values[-1])
+        return np.histogram(values, bins=bins, range=range, weights=counts)
+
+
+# BandStats and BandSketch of one band filled from the same blocks, so summary
+# statistics and percentiles take a single pass over the raster.
+class BandSummary:
+
+    def __init__(self, relative_accuracy=DEFAULT_RELATIVE_ACCURACY,
+                 max_buckets=DEFAULT_MAX_BUCKETS):
+        self.stats = blockstats.BandStats()
+        self.sketch = BandSketch(relative_accuracy, max_buckets)
+
+    def update(self, data, nodata_value=None):
+        self.stats.update(data, nodata_value)
+        self.sketch.update(data, nodata_value)
+
+    def merge(self, other):
+        self.stats.merge(other.stats)
+        self.sketch.merge(other.sketch)
+        return self
+
+
+# Histograms for the bands in a raster file. Returns a dict of BandSketch keyed
+# by band number. Other keyword arguments are passed to
+# blockstats.band_statistics.
+def band_histograms(rasterfile, relative_accuracy=DEFAULT_RELATIVE_ACCURACY,
+                    max_buckets=DEFAULT_MAX_BUCKETS, **kwargs):
+    accumulator = functools.partial(
+        BandSketch, relative_accuracy=relative_accuracy, max_buckets=max_buckets)
+    return blockstats.band_statistics(rasterfile, accumulator=accumulator, **kwargs)
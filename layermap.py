@@ -0,0 +1,98 @@
+# Declarative layer mappings.
+#
+# A LayerMapping describes the table a source layer is loaded into: its
+# columns, where each column's value comes from in the source layer, how the
+# value is coerced on the way (integer to boolean, ...) and the geometry type
+# features are promoted to. From it the loaders generate the table DDL and
+# compile a FieldMap once per layer, which copies a feature's values by field
+# index instead of looking fields up by name on every feature.
+#
+#   roads = LayerMapping([
+#       Column('osm_id', 'bigint'),
+#       Column('oneway', 'boolean', coerce=to_boolean),
+#   ], geometry_type=ogr.wkbMultiLineString)
+
+import ogr
+
+
+# Integer flag to boolean, keeping nulls.
+def to_boolean(value):
+    return None if value is None else bool(value)
+
+
+# A destination column. source is the source field name, default the column
+# name. coerce is called with every source value, nulls included, and must be
+# a module level function so mappings can be sent to worker processes.
+class Column:
+
+    def __init__(self, name, sql_type, source=None, coerce=None):
+        self.name = name
+        self.sql_type = sql_type
+        self.source = source if source is not None else name
+        self.coerce = coerce
+
+
+class LayerMapping:
+
+    def __init__(self, columns, geometry_type=None):
+        self.columns = list(columns)
+        self.geometry_type = geometry_type
+
+    @property
+    def column_names(self):
+        return [column.name for column in self.columns]
+
+    # OGR geometry type of the table for a source layer geometry type. With
+    # multi set, line and polygon types are promoted to their multi types.
+    # Points are left alone, clipping can't split a point.
+    def table_geom_type(self, src_type, multi=False):
+        type = self.geometry_type if self.geometry_type is not None else src_type
+        if multi and ogr.GT_Flatten(type) in (ogr.wkbLineString, ogr.wkbPolygon):
+            type = ogr.GT_GetCollection(type)
+        return type
+
+    # Column definitions of the table, without constraints.
+    def column_ddl(self, geom_type, srid):
+        return (['gid serial NOT NULL'] +
+                ['{0} {1}'.format(column.name, column.sql_type) for column in self.columns] +
+                ['geom geometry({0}, {1})'.format(postgis_geom_type(geom_type), srid)])
+
+    # DDL to (re)create the table. The primary key is part of the table.
+    def table_ddl(self, schema, table, geom_type, srid):
+        return """
+        DROP TABLE IF EXISTS {schema}.{table};
+        CREATE TABLE {schema}.{table} (
+          {columns},
+          CONSTRAINT {table}_pkey PRIMARY KEY (gid))
+        WITH (OIDS=FALSE);
+        """.format(schema=schema, table=table,
+                   columns=',\n          '.join(self.column_ddl(geom_type, srid)))
+
+    # Compile the field index map for a source layer definition.
+    def compile(self, srcDefn):
+        indexes = []
+        for column in self.columns:
+            index = srcDefn.GetFieldIndex(column.source)
+            if index < 0:
+                raise KeyError('source field {0} not found for column {1}'.format(
+                    column.source, column.name))
+            indexes.append(index)
+        return FieldMap(indexes, [column.coerce for column in self.columns])
+
+
+# Source field indexes and coercions for the columns of a mapping, in column
+# order.
+class FieldMap:
+
+    def __init__(self, indexes, coercions):
+        self.fields = list(zip(indexes, coercions))
+
+    # Column values for a source feature.
+    def values(self, feature):
+        return [feature.GetField(index) if coerce is None else coerce(feature.GetField(index))
+                for index, coerce in self.fields]
+
+
+# PostGIS geometry type modifiers.
+def postgis_geom_type(type):
+    return 'Geometry' if type == 0 else ogr.GeometryTypeToName(type).replace(' ', '')
@@ -0,0 +1,185 @@
+# Ingest manifest.
+#
+# A table in PostGIS recording, for each loaded table, the source file it was
+# loaded from (size, mtime and a content hash over the shapefile and its
+# sidecar files), a key for the load settings, the rows loaded so far, how far
+# into the source the load got, and whether it completed. With it an importer
+# can skip tables whose source has not changed and resume an interrupted load
+# from its last committed batch.
+#
+# Size and mtime are checked first. The source is only hashed when they
+# differ, or to record a new load, so an unchanged source is never read.
+#
+#   manifest = Manifest(conn, 'geog585')
+#   action, entry = manifest.plan('roads', 'roads_load', shapefile, settings_key)
+#   if action == manifest.LOAD:
+#       ... create the table ...
+#       manifest.begin('roads', shapefile, settings_key)
+#   ... load, recording progress with progress_sql in each batch transaction ...
+#   manifest.complete('roads', rows)
+
+import hashlib
+import os
+
+MANIFEST_TABLE = 'ingest_manifest'
+
+# Shapefile sidecar extensions included in the fingerprint.
+SOURCE_EXTENSIONS = ('.shp', '.shx', '.dbf', '.prj', '.cpg')
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Plan actions.
+SKIP = 'skip'
+RESUME = 'resume'
+LOAD = 'load'
+
+
+# Files making up a shapefile.
+def source_files(shapefile):
+    base = os.path.splitext(shapefile)[0]
+    return [base + ext for ext in SOURCE_EXTENSIONS if os.path.exists(base + ext)]
+
+
+# Total size and latest mtime of a shapefile's files.
+def source_stat(shapefile):
+    stats = [os.stat(filename) for filename in source_files(shapefile)]
+    return sum(st.st_size for st in stats), max(st.st_mtime for st in stats)
+
+
+# SHA-256 of a shapefile's files.
+def source_hash(shapefile):
+    digest = hashlib.sha256()
+    for filename in source_files(shapefile):
+        digest.update(os.path.basename(filename).encode())
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+# SQL recording the progress of a load, run with (rows_loaded, source_offset,
+# table_name) in the transaction that commits each batch.
+def progress_sql(schema, manifest_table=MANIFEST_TABLE):
+    return """
+    UPDATE {schema}.{manifest}
+      SET rows_loaded = %s, source_offset = %s, updated = now()
+      WHERE table_name = %s;
+    """.format(schema=schema, manifest=manifest_table)
+
+
+class ManifestEntry:
+
+    def __init__(self, table_name, source, size, mtime, hash, settings_key, rows_loaded,
+                 source_offset, complete):
+        self.table_name = table_name
+        self.source = source
+        self.size = size
+        self.mtime = mtime
+        self.hash = hash
+        self.settings_key = settings_key
+        self.rows_loaded = rows_loaded
+        self.source_offset = source_offset
+        self.complete = complete
+
+
+class Manifest:
+
+    # conn is a psycopg2 connection. The manifest table is created if needed.
+    def __init__(self, conn, schema, table=MANIFEST_TABLE):
+        self.conn = conn
+        self.schema = schema
+        self.table = table
+
+        self._execute("""
+        CREATE TABLE IF NOT EXISTS {schema}.{manifest} (
+          table_name text NOT NULL,
+          source text,
+          size bigint,
+          mtime double precision,
+          hash text,
+          settings_key text,
+          rows_loaded bigint NOT NULL DEFAULT 0,
+          source_offset bigint NOT NULL DEFAULT 0,
+          complete boolean NOT NULL DEFAULT false,
+          updated timestamp with time zone NOT NULL DEFAULT now(),
+          CONSTRAINT {manifest}_pkey PRIMARY KEY (table_name));
+        """)
+
+    def _execute(self, sql, args=None):
+        with self.conn.cursor() as curs:
+            curs.execute(sql.format(schema=self.schema, manifest=self.table), args)
+            rows = curs.fetchall() if curs.description is not None else None
+        self.conn.commit()
+        return rows
+
+    def get(self, table_name):
+        rows = self._execute("""
+        SELECT table_name, source, size, mtime, hash, settings_key, rows_loaded,
+          source_offset, complete
+        FROM {schema}.{manifest} WHERE table_name = %s;
+        """, (table_name,))
+        return ManifestEntry(*rows[0]) if rows else None
+
+    # Rows in a table, or None if it does not exist.
+    def _table_rows(self, table_name):
+        rows = self._execute('SELECT to_regclass(%s) IS NOT NULL',
+                             ('{0}.{1}'.format(self.schema, table_name),))
+        if not rows[0][0]:
+            return None
+        return self._execute('SELECT count(*) FROM {schema}.' + table_name)[0][0]
+
+    # Decide what to do with a table. load_table is the table rows are loaded
+    # into, the staging table for staged loads. Returns (action, entry):
+    #
+    #   SKIP   - the source is unchanged, the load completed and table_name
+    #            still holds the rows it loaded
+    #   RESUME - the source is unchanged and load_table holds exactly the rows
+    #            of an interrupted load, continue from entry.source_offset
+    #   LOAD   - (re)load from the start, including a completed load whose
+    #            table has since been dropped or changed
+    def plan(self, table_name, load_table, shapefile, settings_key):
+        entry = self.get(table_name)
+        if entry is None or entry.settings_key != settings_key:
+            return LOAD, entry
+
+        size, mtime = source_stat(shapefile)
+        if (entry.size, entry.mtime) != (size, mtime):
+            if source_hash(shapefile) != entry.hash:
+                return LOAD, entry
+
+            # Touched but unchanged.
+            self._execute("""
+            UPDATE {schema}.{manifest} SET size = %s, mtime = %s WHERE table_name = %s;
+            """, (size, mtime, table_name))
+
+        if entry.complete:
+            if self._table_rows(table_name) != entry.rows_loaded:
+                return LOAD, entry
+            return SKIP, entry
+        if self._table_rows(load_table) != entry.rows_loaded:
+            return LOAD, entry
+        return RESUME, entry
+
+    # Record the start of a load from the beginning of a source.
+    def begin(self, table_name, shapefile, settings_key):
+        size, mtime = source_stat(shapefile)
+        self._execute("""
+        INSERT INTO {schema}.{manifest} (table_name, source, size, mtime, hash, settings_key)
+          VALUES (%s, %s, %s, %s, %s, %s)
+        ON CONFLICT (table_name) DO UPDATE SET
+          source = EXCLUDED.source, size = EXCLUDED.size, mtime = EXCLUDED.mtime,
+          hash = EXCLUDED.hash, settings_key = EXCLUDED.settings_key,
+          rows_loaded = 0, source_offset = 0, complete = false, updated = now();
+        """, (table_name, os.path.abspath(shapefile), size, mtime, source_hash(shapefile),
+              settings_key))
+
+    def complete(self, table_name, rows_loaded):
+        self._execute("""
+        UPDATE {schema}.{manifest}
+          SET rows_loaded = %s, complete = true, updated = now()
+          WHERE table_name = %s;
+        """, (rows_loaded, table_name))
+
+    # Forget a table, so the next run loads it from the start.
+    def reset(self, table_name):
+        self._execute('DELETE FROM {schema}.{manifest} WHERE table_name = %s;', (table_name,))
@@ -0,0 +1,281 @@
+# Bulk loading with COPY.
+#
+# Stream rows into a PostgreSQL table with COPY ... FROM STDIN in the text
+# format instead of one INSERT per feature. Geometry is sent as hex EWKB, which
+# PostGIS accepts as text input for a geometry column. Rows are buffered and
+# each batch is copied and committed in its own transaction, so a failed load
+# keeps every batch before the failure.
+
+import io
+import queue
+import struct
+import threading
+import time
+
+import ogr
+
+COPY_BATCH_ROWS = 10000
+
+# EWKB flag for an embedded SRID.
+EWKB_SRID_FLAG = 0x20000000
+
+
+# Hex EWKB of an OGR geometry with an SRID.
+def ewkb_hex(geom, srid):
+    wkb = geom.ExportToWkb(ogr.wkbNDR)
+    geom_type = struct.unpack('<I', wkb[1:5])[0]
+    return (wkb[0:1] + struct.pack('<II', geom_type | EWKB_SRID_FLAG, srid) + wkb[5:]).hex()
+
+
+# Format a value for the COPY text format.
+def copy_text(value):
+    if value is None:
+        return '\\N'
+    if value is True or value is False:
+        return 't' if value else 'f'
+    if isinstance(value, str):
+        return value.replace('\\', '\\\\').replace('\t', '\\t') \
+            .replace('\n', '\\n').replace('\r', '\\r')
+    return str(value)
+
+
+# Buffered COPY into a table. Call add() for each row and close() at the end.
+# With batch_rows None, batches are only copied by explicit flush() calls.
+# before_commit is called with the cursor and the total rows copied after each
+# batch, in the batch's transaction, e.g. to record load progress.
+class CopyLoader:
+
+    def __init__(self, conn, table, columns, batch_rows=COPY_BATCH_ROWS, before_commit=None):
+        self.conn = conn
+        self.sql = 'COPY {0} ({1}) FROM STDIN'.format(table, ', '.join(columns))
+        self.batch_rows = batch_rows
+        self.before_commit = before_commit
+        self.buffer = io.StringIO()
+        self.pending = 0
+        self.rows = 0
+        self.batches = 0
+        self.elapsed = None
+        self.startTime = time.time()
+
+    # Add a row, a sequence of values in column order.
+    def add(self, row):
+        self.buffer.write('\t'.join([copy_text(value) for value in row]))
+        self.buffer.write('\n')
+        self.pending += 1
+        if self.batch_rows is not None and self.pending >= self.batch_rows:
+            self.flush()
+
+    # Copy and commit the buffered rows.
+    def flush(self):
+        if self.pending == 0:
+            return
+        self.buffer.seek(0)
+        with self.conn.cursor() as curs:
+            curs.copy_expert(self.sql, self.buffer)
+            if self.before_commit is not None:
+                self.before_commit(curs, self.rows + self.pending)
+        self.conn.commit()
+
+        self.rows += self.pending
+        self.batches += 1
+        self.pending = 0
+        self.buffer = io.StringIO()
+
+    # Flush the remaining rows. Returns the number of rows loaded.
+    def close(self):
+        self.flush()
+        self.elapsed = time.time() - self.startTime
+        return self.rows
+
+    @property
+    def rows_per_sec(self):
+        elapsed = self.elapsed if self.elapsed is not None else time.time() - self.startTime
+        return self.rows / elapsed if elapsed > 0 else 0.0
+
+
+# Table to table copy between two connections.
+#
+# The source is read with COPY ... TO STDOUT on a thread and piped straight
+# into COPY ... FROM STDIN on the destination through a bounded buffer of
+# COPY_PIPE_CHUNKS chunks, so memory stays flat however large the table is and
+# no row becomes a Python object. Geometry columns travel as hex EWKB in the
+# text format, or as PostGIS binary in the binary format.
+
+COPY_PIPE_CHUNKS = 64
+
+# Seconds between checks for a failed copy while blocked on the pipe.
+PIPE_POLL_INTERVAL = 0.1
+
+
+class CopyAborted(Exception):
+    pass
+
+
+# Bounded pipe between the two sides of a copy. psycopg2 calls write() for
+# COPY TO and read() for COPY FROM, a short read is fine and an empty read
+# ends the COPY.
+class _CopyPipe:
+
+    def __init__(self, max_chunks=COPY_PIPE_CHUNKS):
+        self.chunks = queue.Queue(max_chunks)
+        self.chunk = b''
+        self.eof = False
+        self.aborted = threading.Event()
+        self.error = None
+        self.bytes = 0
+        self.newlines = 0
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.bytes += len(data)
+        self.newlines += data.count(b'\n')
+        self._put(data)
+        return len(data)
+
+    def _put(self, item):
+        while True:
+            if self.aborted.is_set():
+                raise CopyAborted('copy destination failed')
+            try:
+                self.chunks.put(item, timeout=PIPE_POLL_INTERVAL)
+                return
+            except queue.Full:
+                pass
+
+    def read(self, size=-1):
+        if not self.chunk and not self.eof:
+            item = self.chunks.get()
+            if item is None:
+                self.eof = True
+            elif isinstance(item, BaseException):
+                self.eof = True
+                raise item
+            else:
+                self.chunk = item
+        if size is None or size < 0:
+            size = len(self.chunk)
+        data, self.chunk = self.chunk[:size], self.chunk[size:]
+        return data
+
+    # End of the source, or the exception that ended it.
+    def close(self, error=None):
+        try:
+            self._put(error)
+        except CopyAborted:
+            pass
+
+    def abort(self):
+        self.aborted.set()
+
+
+# Result of a copy_table.
+class CopyStats:
+
+    def __init__(self, rows, bytes, elapsed):
+        self.rows = rows
+        self.bytes = bytes
+        self.elapsed = elapsed
+
+    @property
+    def rows_per_sec(self):
+        return self.rows / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def bytes_per_sec(self):
+        return self.bytes / self.elapsed if self.elapsed > 0 else 0.0
+
+    def report(self):
+        return '{0} rows, {1:,.0f} bytes in {2:.2f} sec, {3:,.0f} rows/s, {4:,.1f} MB/s'.format(
+            self.rows, self.bytes, self.elapsed, self.rows_per_sec,
+            self.bytes_per_sec / (1024.0 * 1024.0))
+
+
+# Column definitions and primary key columns of a table, from the catalog.
+# Types come from format_type, so geometry columns keep their type and SRID.
+def table_columns(conn, table):
+    with conn.cursor() as curs:
+        curs.execute("""
+        SELECT a.attname, format_type(a.atttypid, a.atttypmod), a.attnotnull
+        FROM pg_attribute AS a
+        WHERE a.attrelid = %s::regclass AND a.attnum > 0 AND NOT a.attisdropped
+        ORDER BY a.attnum
+        """, (table,))
+        columns = curs.fetchall()
+
+        curs.execute("""
+        SELECT a.attname
+        FROM pg_index AS i
+          INNER JOIN pg_attribute AS a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+        WHERE i.indrelid = %s::regclass AND i.indisprimary
+        ORDER BY array_position(i.indkey::smallint[], a.attnum)
+        """, (table,))
+        primary_key = [row[0] for row in curs.fetchall()]
+    return columns, primary_key
+
+
+# Copy a table, or the result of a query, from src_conn to dst_table on
+# dst_conn. Returns CopyStats. The destination is committed, the source
+# transaction is left to the caller.
+#
+#   columns     - columns to copy, default all. With src_query, the columns
+#                 of dst_table the query result goes into.
+#   src_query   - copy the result of this query instead of src_table
+#   replicate   - (re)create dst_table from src_table's definition first, the
+#                 primary key is added after the rows are copied
+#   binary      - use the binary COPY format, both sides must have the same
+#                 column types
+def copy_table(src_conn, dst_conn, src_table, dst_table, columns=None, src_query=None,
+               replicate=False, binary=False, max_chunks=COPY_PIPE_CHUNKS):
+    column_list = ' ({0})'.format(', '.join(columns)) if columns else ''
+    options = ' WITH (FORMAT binary)' if binary else ''
+    if src_query is not None:
+        copy_out = 'COPY ({0}) TO STDOUT{1}'.format(src_query, options)
+    else:
+        copy_out = 'COPY {0}{1} TO STDOUT{2}'.format(src_table, column_list, options)
+    copy_in = 'COPY {0}{1} FROM STDIN{2}'.format(dst_table, column_list, options)
+
+    startTime = time.time()
+
+    primary_key = []
+    if replicate:
+        src_columns, primary_key = table_columns(src_conn, src_table)
+        if columns:
+            src_columns = [column for column in src_columns if column[0] in columns]
+            primary_key = [name for name in primary_key if name in columns]
+        with dst_conn.cursor() as curs:
+            curs.execute('DROP TABLE IF EXISTS {0}; CREATE TABLE {0} ({1});'.format(
+                dst_table, ', '.join('{0} {1}{2}'.format(name, type, ' NOT NULL' if notnull else '')
+                                     for name, type, notnull in src_columns)))
+
+    pipe = _CopyPipe(max_chunks)
+
+    def copy_from_source():
+        try:
+            with src_conn.cursor() as curs:
+                curs.copy_expert(copy_out, pipe)
+        except BaseException as e:
+            pipe.close(e)
+        else:
+            pipe.close()
+
+    reader = threading.Thread(target=copy_from_source, name='copy-table-source', daemon=True)
+    reader.start()
+    try:
+        with dst_conn.cursor() as curs:
+            curs.copy_expert(copy_in, pipe)
+            rows = curs.rowcount
+            if primary_key:
+                curs.execute('ALTER TABLE {0} ADD PRIMARY KEY ({1})'.format(
+                    dst_table, ', '.join(primary_key)))
+        dst_conn.commit()
+    except BaseException:
+        pipe.abort()
+        dst_conn.rollback()
+        raise
+    finally:
+        reader.join()
+
+    if rows is None or rows < 0:
+        rows = pipe.newlines if not binary else 0
+    return CopyStats(rows, pipe.bytes, time.time() - startTime)
@@ -0,0 +1,301 @@
+# Shared database access.
+#
+# Named DSN profiles, a connection pool per profile, and blocking and asyncio
+# query APIs on top of them. The pools block when all their connections are in
+# use, and record how long callers waited for a connection and how long each
+# query took, for tuning pool sizes.
+#
+#   rows = pgdb.query('local', 'SELECT name FROM geog897d.cities')
+#
+#   async def main():
+#       cities, count = await asyncio.gather(
+#           pgdb.aquery('local', 'SELECT ...'),
+#           pgdb.arun('z400', lambda conn: ...))
+#
+#   print(pgdb.report())
+#
+# Large results are streamed from named server-side cursors, ITERSIZE rows per
+# round trip, as compact records (tuples with attribute access) or gathered
+# into one NumPy array per column:
+#
+#   for city in pgdb.stream('local', 'SELECT gid, name, pop2000 FROM geog897d.cities'):
+#       print(city.name, city.pop2000)
+#
+#   cols = pgdb.columns('local', 'SELECT pop2000, crime_inde FROM geog897d.cities')
+#   cols['pop2000'].mean()
+#
+# A profile's DSN can be overridden with a PGDB_<NAME> environment variable,
+# e.g. PGDB_Z400='dbname=postgis_scratch host=10.0.0.4 user=postgres'.
+
+import asyncio
+import itertools
+import numpy as np
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.pool
+
+PROFILES = {
+    'local': 'dbname=postgis_scratch user=postgres host=localhost password=pg',
+    'z400': 'dbname=postgis_scratch user=postgres host=z400 password=pg707',
+}
+
+POOL_MIN = 1
+POOL_MAX = 4
+
+# Rows fetched per round trip by server-side cursors.
+ITERSIZE = 2000
+
+
+# libpq DSN of a profile.
+def dsn(profile):
+    env = os.environ.get('PGDB_' + profile.upper())
+    if env:
+        return env
+    if profile not in PROFILES:
+        raise KeyError('unknown database profile ' + profile)
+    return PROFILES[profile]
+
+
+# OGR 'PG:' connection string of a profile.
+def ogr_dsn(profile):
+    return 'PG: ' + dsn(profile)
+
+
+def add_profile(profile, profile_dsn):
+    PROFILES[profile] = profile_dsn
+
+
+# Count, total and maximum of a timing in seconds.
+class Timing:
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, seconds):
+        with self.lock:
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def report(self):
+        return '{0} x mean {1:.2f} ms, max {2:.2f} ms'.format(
+            self.count, self.mean * 1000, self.max * 1000)
+
+
+# A blocking connection pool for one profile. psycopg2's pool raises when it is
+# exhausted, a semaphore makes callers wait for a connection instead.
+class Pool:
+
+    def __init__(self, profile, minconn=POOL_MIN, maxconn=POOL_MAX):
+        self.profile = profile
+        self.maxconn = maxconn
+        self.pool = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn, dsn(profile))
+        self.available = threading.Semaphore(maxconn)
+        self.wait = Timing()
+        self.latency = Timing()
+
+    # A pooled connection. The transaction is committed when the block
+    # completes and rolled back on an exception.
+    @contextmanager
+    def connection(self):
+        startTime = time.time()
+        self.available.acquire()
+        self.wait.add(time.time() - startTime)
+        try:
+            conn = self.pool.getconn()
+            try:
+                yield conn
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            finally:
+                self.pool.putconn(conn)
+        finally:
+            self.available.release()
+
+    # Run fn(conn) with a pooled connection, timed as one query.
+    def run(self, fn):
+        with self.connection() as conn:
+            startTime = time.time()
+            try:
+                return fn(conn)
+            finally:
+                self.latency.add(time.time() - startTime)
+
+    def query(self, sql, args=None):
+        def fetch(conn):
+            with conn.cursor() as curs:
+                curs.execute(sql, args)
+                return curs.fetchall() if curs.description is not None else curs.rowcount
+        return self.run(fetch)
+
+    def close(self):
+        self.pool.closeall()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+_executor = None
+
+_record_types = {}
+_cursor_ids = itertools.count()
+
+
+# Record class for a list of column names: a namedtuple, so a row costs no
+# more than a plain tuple and fields are read by name or position. Names that
+# are not identifiers are renamed _0, _1, ...
+def record_type(names):
+    names = tuple(names)
+    if names not in _record_types:
+        _record_types[names] = namedtuple('Record', names, rename=True)
+    return _record_types[names]
+
+
+# Stream the rows of a query from a named server-side cursor on conn, itersize
+# rows per round trip. Yields records, or plain tuples with records=False.
+# Only itersize rows are held at a time. conn must not be in autocommit mode.
+def iter_query(conn, sql, args=None, itersize=ITERSIZE, records=True):
+    with conn.cursor(name='pgdb_{0}'.format(next(_cursor_ids))) as curs:
+        curs.itersize = itersize
+        curs.execute(sql, args)
+        Record = None
+        new = tuple.__new__
+        for row in curs:
+            if not records:
+                yield row
+                continue
+            if Record is None:
+                Record = record_type([column[0] for column in curs.description])
+            yield new(Record, row)
+
+
+# Read the result of a query into a dict of column name: NumPy array, streaming
+# itersize rows at a time. dtypes maps column names to dtypes, other columns
+# get the dtype NumPy infers, object for text, numeric or null values.
+def iter_columns(conn, sql, args=None, itersize=ITERSIZE, dtypes=None):
+    dtypes = dtypes or {}
+    with conn.cursor(name='pgdb_{0}'.format(next(_cursor_ids))) as curs:
+        curs.itersize = itersize
+        curs.execute(sql, args)
+        names = None
+        chunks = None
+        while True:
+            rows = curs.fetchmany(itersize)
+            if names is None:
+                names = [column[0] for column in curs.description]
+                chunks = [[] for name in names]
+            if not rows:
+                break
+            for i, values in enumerate(zip(*rows)):
+                chunks[i].append(np.array(values, dtype=dtypes.get(names[i])))
+
+    columns = {}
+    for name, parts in zip(names, chunks):
+        if not parts:
+            columns[name] = np.array([], dtype=dtypes.get(name, object))
+        else:
+            try:
+                columns[name] = np.concatenate(parts)
+            except TypeError:
+                columns[name] = np.concatenate([part.astype(object) for part in parts])
+    return columns
+
+
+# The pool for a profile, created on first use.
+def get_pool(profile, minconn=POOL_MIN, maxconn=POOL_MAX):
+    with _pools_lock:
+        if profile not in _pools:
+            _pools[profile] = Pool(profile, minconn, maxconn)
+        return _pools[profile]
+
+
+# Run a query on a profile. Returns the rows, or the row count for statements
+# without a result.
+def query(profile, sql, args=None):
+    return get_pool(profile).query(sql, args)
+
+
+# Run fn(conn) with a connection from a profile's pool.
+def run(profile, fn):
+    return get_pool(profile).run(fn)
+
+
+# Stream the rows of a query on a profile, see iter_query. The pooled
+# connection is held until the iteration finishes.
+def stream(profile, sql, args=None, itersize=ITERSIZE, records=True):
+    pool = get_pool(profile)
+    with pool.connection() as conn:
+        startTime = time.time()
+        try:
+            for row in iter_query(conn, sql, args, itersize, records):
+                yield row
+        finally:
+            pool.latency.add(time.time() - startTime)
+
+
+# Columns of a query on a profile, see iter_columns.
+def columns(profile, sql, args=None, itersize=ITERSIZE, dtypes=None):
+    return run(profile, lambda conn: iter_columns(conn, sql, args, itersize, dtypes))
+
+
+def _get_executor():
+    global _executor
+    with _pools_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=max(POOL_MAX * max(1, len(PROFILES)), 4),
+                thread_name_prefix='pgdb')
+        return _executor
+
+
+# asyncio versions of query and run. The blocking calls run on a shared thread
+# pool, so queries against different servers, or on different connections of
+# one pool, proceed concurrently.
+async def aquery(profile, sql, args=None):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), query, profile, sql, args)
+
+
+async def arun(profile, fn):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), run, profile, fn)
+
+
+# Connection wait and query latency per profile.
+def stats():
+    return {profile: {'wait': pool.wait, 'latency': pool.latency}
+            for profile, pool in _pools.items()}
+
+
+def report():
+    lines = []
+    for profile, pool in _pools.items():
+        lines.append('{0}: pool wait {1}; query {2}'.format(
+            profile, pool.wait.report(), pool.latency.report()))
+    return '\n'.join(lines)
+
+
+# Close all pools and the thread pool.
+def close_all():
+    global _executor
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
+        if _executor is not None:
+            _executor.shutdown()
+            _executor = None
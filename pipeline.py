@@ -0,0 +1,232 @@
+# Bounded streaming pipeline.
+#
+# Run a reader, a pool of transform workers and a writer concurrently,
+# connected by bounded queues:
+#
+#   source thread -> [queue] -> transform threads -> [queue] -> sink (caller)
+#
+# A full queue blocks the stage feeding it, so at most QUEUE_SIZE items wait
+# between two stages. Items reach the sink in source order: results that finish
+# ahead of a slow item wait in a reorder buffer, and the reader also waits for a
+# slot in a window of 2 * QUEUE_SIZE + workers items between the source and the
+# sink, so a stalled item can't let the buffer grow and memory stays flat
+# however long the source is. Each stage records its throughput, the time
+# it spent working and waiting, and the depth of its input queue, so the
+# bottleneck is the stage that is busy while the others wait on it.
+#
+#   metrics = pipeline.run(batches, transform_batch, write_batch, workers=2)
+#   for stage in metrics:
+#       print(stage.report())
+#
+# The stages are threads. This pays off when the stages spend their time in
+# GDAL, PROJ or libpq calls that release the GIL.
+
+import queue
+import threading
+import time
+
+QUEUE_SIZE = 4
+
+# Seconds between checks for a stopped pipeline while blocked on a queue.
+POLL_INTERVAL = 0.1
+
+_DONE = object()
+
+
+class StageMetrics:
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.busy = 0.0
+        self.wait_in = 0.0
+        self.wait_out = 0.0
+        self.depth_sum = 0
+        self.depth_max = 0
+        self.depth_samples = 0
+        self.elapsed = 0.0
+        self.lock = threading.Lock()
+
+    def sample_depth(self, depth):
+        self.depth_sum += depth
+        self.depth_samples += 1
+        self.depth_max = max(self.depth_max, depth)
+
+    # Merge the metrics of another thread of the same stage.
+    def merge(self, other):
+        with self.lock:
+            self.items += other.items
+            self.busy += other.busy
+            self.wait_in += other.wait_in
+            self.wait_out += other.wait_out
+            self.depth_sum += other.depth_sum
+            self.depth_samples += other.depth_samples
+            self.depth_max = max(self.depth_max, other.depth_max)
+
+    @property
+    def items_per_sec(self):
+        return self.items / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def depth_mean(self):
+        return self.depth_sum / self.depth_samples if self.depth_samples else 0.0
+
+    def report(self):
+        line = '{0}: {1} items, {2:,.1f} items/s, busy {3:.2f} sec, wait in {4:.2f} sec, ' \
+               'wait out {5:.2f} sec'.format(self.name, self.items, self.items_per_sec,
+                                             self.busy, self.wait_in, self.wait_out)
+        if self.depth_samples:
+            line += ', input queue mean {0:.1f} max {1}'.format(self.depth_mean, self.depth_max)
+        return line
+
+
+class _Stopped(Exception):
+    pass
+
+
+def _put(q, item, stop, metrics):
+    startTime = time.time()
+    while True:
+        if stop.is_set():
+            raise _Stopped()
+        try:
+            q.put(item, timeout=POLL_INTERVAL)
+            break
+        except queue.Full:
+            pass
+    metrics.wait_out += time.time() - startTime
+
+
+# Wait for a slot in the in-flight window.
+def _acquire(window, stop, metrics):
+    startTime = time.time()
+    while not window.acquire(timeout=POLL_INTERVAL):
+        if stop.is_set():
+            raise _Stopped()
+    metrics.wait_out += time.time() - startTime
+
+
+def _get(q, stop, metrics):
+    startTime = time.time()
+    while True:
+        if stop.is_set():
+            raise _Stopped()
+        try:
+            metrics.sample_depth(q.qsize())
+            item = q.get(timeout=POLL_INTERVAL)
+            break
+        except queue.Empty:
+            pass
+    metrics.wait_in += time.time() - startTime
+    return item
+
+
+# Run source items through transform on workers threads and pass the results to
+# sink in source order, on the calling thread. Returns [StageMetrics] for the
+# reader, transform and writer stages. An exception in any stage stops the
+# pipeline and is raised here.
+def run(source, transform, sink, workers=2, queue_size=QUEUE_SIZE):
+    workers = max(1, workers)
+    in_queue = queue.Queue(queue_size)
+    out_queue = queue.Queue(queue_size)
+    stop = threading.Event()
+    errors = []
+
+    # Items read and not yet passed to the sink.
+    window = threading.Semaphore(2 * queue_size + workers)
+
+    reader = StageMetrics('read')
+    transformer = StageMetrics('transform')
+    writer = StageMetrics('write')
+
+    def read():
+        try:
+            iterator = iter(source)
+            seq = 0
+            while True:
+                startTime = time.time()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    reader.busy += time.time() - startTime
+                _acquire(window, stop, reader)
+                _put(in_queue, (seq, item), stop, reader)
+                reader.items += 1
+                seq += 1
+            for i in range(workers):
+                _put(in_queue, _DONE, stop, reader)
+        except _Stopped:
+            pass
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+
+    def work():
+        metrics = StageMetrics('transform')
+        try:
+            while True:
+                item = _get(in_queue, stop, metrics)
+                if item is _DONE:
+                    break
+                seq, value = item
+                startTime = time.time()
+                result = transform(value)
+                metrics.busy += time.time() - startTime
+                metrics.items += 1
+                _put(out_queue, (seq, result), stop, metrics)
+            _put(out_queue, _DONE, stop, metrics)
+        except _Stopped:
+            pass
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            transformer.merge(metrics)
+
+    startTime = time.time()
+    threads = [threading.Thread(target=read, name='pipeline-read', daemon=True)]
+    threads += [threading.Thread(target=work, name='pipeline-transform-{0}'.format(i),
+                                 daemon=True) for i in range(workers)]
+    for thread in threads:
+        thread.start()
+
+    # Results arrive out of order from the workers, hold them until their turn.
+    pending = {}
+    next_seq = 0
+    finished = 0
+    try:
+        while finished < workers:
+            item = _get(out_queue, stop, writer)
+            if item is _DONE:
+                finished += 1
+                continue
+            seq, result = item
+            pending[seq] = result
+            while next_seq in pending:
+                sinkTime = time.time()
+                sink(pending.pop(next_seq))
+                window.release()
+                writer.busy += time.time() - sinkTime
+                writer.items += 1
+                next_seq += 1
+
+    except _Stopped:
+        pass
+    except BaseException as e:
+        errors.append(e)
+        stop.set()
+    finally:
+        if errors:
+            stop.set()
+        for thread in threads:
+            thread.join()
+
+    elapsed = time.time() - startTime
+    for metrics in (reader, transformer, writer):
+        metrics.elapsed = elapsed
+
+    if errors:
+        raise errors[0]
+    return [reader, transformer, writer]
@@ -0,0 +1,369 @@
+# In-process proximity engine for the geog897d site selection.
+#
+# The candidate cities, recreation areas and interstates are streamed once from
+# PostGIS as WKB, in the EPSG:2272 columns siteselect.prepare adds, and held in
+# STR-tree spatial indexes. The distance from every candidate to its nearest
+# recreation area and interstate is then computed in one vectorized pass, so
+# changing the mile thresholds costs a NumPy comparison instead of another
+# query:
+#
+#   engine = pgdb.run('local', proximity.load)
+#   rows = engine.select(max_recreation_miles=10, max_interstate_miles=20)
+#   counts = engine.sweep(range(0, 21), range(0, 41, 2))
+#
+# Distances are the same planar ST_Distance PostGIS computes on the 2272
+# geometries, rounded the way the numeric(6,2) casts of siteselect round them,
+# so select returns the rows of siteselect.selection_query.
+#
+# shapely 2 is used for the trees and distances when it is installed. Without
+# it the layers are broken into segments, packed into STR nodes and searched
+# with NumPy.
+
+import numpy as np
+import struct
+from decimal import Decimal, ROUND_HALF_UP
+
+import pgdb
+import siteselect
+
+try:
+    import shapely
+except ImportError:
+    shapely = None
+
+SCHEMA = siteselect.SCHEMA
+SRID = siteselect.SRID
+FEET_PER_MILE = siteselect.FEET_PER_MILE
+
+# Segments per STR node when searching without shapely.
+NODE_SIZE = 64
+
+# Nodes searched per step of a nearest neighbour search.
+NODE_BATCH = 8
+
+# Columns added to siteselect's candidates query, the point coordinates.
+CANDIDATE_COLUMNS = ('ST_X(ST_GeometryN(ci.geom_{0}, 1)) AS x'.format(SRID),
+                     'ST_Y(ST_GeometryN(ci.geom_{0}, 1)) AS y'.format(SRID))
+
+LAYER_QUERY = """
+SELECT ST_AsBinary(geom_{srid}) AS wkb FROM {schema}.{table} WHERE geom_{srid} IS NOT NULL
+"""
+
+RESULT_COLUMNS = ('city', 'county', 'farms', 'labor_pool', 'crime_index', 'pop_density',
+                  'university', 'miles_to_recreation', 'miles_to_interstate')
+
+
+# Miles rounded as PostgreSQL rounds (feet / 5280)::numeric(6,2): the double
+# is converted to numeric with 15 significant digits, then rounded half away
+# from zero. None where there is no distance.
+def round_miles(feet):
+    cents = Decimal('0.01')
+    return [Decimal('{0:.15g}'.format(value / FEET_PER_MILE)).quantize(cents, ROUND_HALF_UP)
+            if np.isfinite(value) else None
+            for value in np.asarray(feet, dtype=np.float64).tolist()]
+
+
+# Append (coordinates, is_ring) for each coordinate sequence of a WKB geometry
+# starting at pos. Returns the position after the geometry.
+def _wkb_parts(wkb, pos, parts):
+    endian = '<' if wkb[pos] == 1 else '>'
+    geom_type = struct.unpack_from(endian + 'I', wkb, pos + 1)[0]
+    pos += 5
+
+    flat = geom_type & 0x0fffffff
+    has_z = bool(geom_type & 0x80000000) or 1000 <= flat < 2000 or 3000 <= flat < 4000
+    has_m = bool(geom_type & 0x40000000) or 2000 <= flat < 4000
+    dims = 2 + has_z + has_m
+    base = flat % 1000
+
+    def coords(pos, count):
+        values = np.frombuffer(wkb, dtype=endian + 'f8', count=count * dims, offset=pos)
+        return values.reshape(count, dims)[:, :2].astype(np.float64), pos + 8 * dims * count
+
+    if base == 1:
+        xy, pos = coords(pos, 1)
+        parts.append((xy, False))
+        return pos
+
+    if base == 2:
+        count = struct.unpack_from(endian + 'I', wkb, pos)[0]
+        xy, pos = coords(pos + 4, count)
+        parts.append((xy, False))
+        return pos
+
+    if base == 3:
+        rings = struct.unpack_from(endian + 'I', wkb, pos)[0]
+        pos += 4
+        for i in range(rings):
+            count = struct.unpack_from(endian + 'I', wkb, pos)[0]
+            xy, pos = coords(pos + 4, count)
+            parts.append((xy, True))
+        return pos
+
+    if base in (4, 5, 6, 7):
+        count = struct.unpack_from(endian + 'I', wkb, pos)[0]
+        pos += 4
+        for i in range(count):
+            pos = _wkb_parts(wkb, pos, parts)
+        return pos
+
+    raise ValueError('unsupported WKB geometry type {0}'.format(geom_type))
+
+
+# Distance from the point (px, py) to each segment.
+def _segment_distance(px, py, x0, y0, x1, y1):
+    dx = x1 - x0
+    dy = y1 - y0
+    length2 = dx * dx + dy * dy
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = ((px - x0) * dx + (py - y0) * dy) / length2
+    t = np.where(length2 > 0, np.clip(t, 0.0, 1.0), 0.0)
+    return np.hypot(x0 + t * dx - px, y0 + t * dy - py)
+
+
+# The features of one layer in an STR tree of their segments.
+class _SegmentTree:
+
+    def __init__(self, wkbs):
+        x0, y0, x1, y1, feature, ring = [], [], [], [], [], []
+        for i, wkb in enumerate(wkbs):
+            parts = []
+            _wkb_parts(bytes(wkb), 0, parts)
+            for xy, is_ring in parts:
+                if len(xy) == 0:
+                    continue
+                start = xy if len(xy) == 1 else xy[:-1]
+                end = xy if len(xy) == 1 else xy[1:]
+                x0.append(start[:, 0])
+                y0.append(start[:, 1])
+                x1.append(end[:, 0])
+                y1.append(end[:, 1])
+                feature.append(np.full(len(start), i, dtype=np.int64))
+                ring.append(np.full(len(start), is_ring))
+
+        self.features = len(wkbs)
+        if not feature:
+            self.x0 = self.y0 = self.x1 = self.y1 = np.empty(0)
+            self.feature = np.empty(0, dtype=np.int64)
+            self.ring = np.empty(0, dtype=bool)
+        else:
+            self.x0, self.y0 = np.concatenate(x0), np.concatenate(y0)
+            self.x1, self.y1 = np.concatenate(x1), np.concatenate(y1)
+            self.feature = np.concatenate(feature)
+            self.ring = np.concatenate(ring)
+
+        # Segments in feature order, with the bounds of each feature, for the
+        # point in polygon tests.
+        self.feature_start = np.searchsorted(self.feature, np.arange(self.features + 1))
+        xmin = np.minimum(self.x0, self.x1)
+        xmax = np.maximum(self.x0, self.x1)
+        ymin = np.minimum(self.y0, self.y1)
+        ymax = np.maximum(self.y0, self.y1)
+        has_segments = np.diff(self.feature_start) > 0
+        self.areas = np.zeros(self.features, dtype=bool)
+        np.logical_or.at(self.areas, self.feature, self.ring)
+        self.fxmin = np.full(self.features, np.inf)
+        self.fymin = np.full(self.features, np.inf)
+        self.fxmax = np.full(self.features, -np.inf)
+        self.fymax = np.full(self.features, -np.inf)
+        np.minimum.at(self.fxmin, self.feature, xmin)
+        np.minimum.at(self.fymin, self.feature, ymin)
+        np.maximum.at(self.fxmax, self.feature, xmax)
+        np.maximum.at(self.fymax, self.feature, ymax)
+        self.areas &= has_segments
+
+        # Sort-tile-recursive packing: slices by x, then runs of NODE_SIZE
+        # segments by y within each slice.
+        count = len(self.feature)
+        nodes = -(-count // NODE_SIZE)
+        slices = max(1, int(np.ceil(np.sqrt(nodes))))
+        cx = (xmin + xmax) / 2
+        cy = (ymin + ymax) / 2
+        by_x = np.argsort(cx, kind='stable')
+        per_slice = slices * NODE_SIZE
+        order = np.concatenate([s[np.argsort(cy[s], kind='stable')]
+                                for s in np.array_split(by_x, max(1, -(-count // per_slice)))]) \
+            if count else by_x
+        self.order = order
+        self.sx0, self.sy0 = self.x0[order], self.y0[order]
+        self.sx1, self.sy1 = self.x1[order], self.y1[order]
+        self.sfeature = self.feature[order]
+
+        starts = np.arange(0, count, NODE_SIZE)
+        self.node_start = starts
+        self.node_end = np.minimum(starts + NODE_SIZE, count)
+        if count:
+            self.nxmin = np.minimum.reduceat(xmin[order], starts)
+            self.nymin = np.minimum.reduceat(ymin[order], starts)
+            self.nxmax = np.maximum.reduceat(xmax[order], starts)
+            self.nymax = np.maximum.reduceat(ymax[order], starts)
+        else:
+            self.nxmin = self.nymin = self.nxmax = self.nymax = np.empty(0)
+
+    # Indexes of the area features that contain the point, by even-odd ring
+    # crossings.
+    def _containing(self, px, py):
+        hits = np.flatnonzero(self.areas & (self.fxmin <= px) & (px <= self.fxmax) &
+                              (self.fymin <= py) & (py <= self.fymax))
+        inside = []
+        for i in hits.tolist():
+            s = slice(self.feature_start[i], self.feature_start[i + 1])
+            x0, y0, x1, y1 = self.x0[s], self.y0[s], self.x1[s], self.y1[s]
+            crosses = self.ring[s] & ((y0 > py) != (y1 > py))
+            with np.errstate(invalid='ignore', divide='ignore'):
+                xcross = x0 + (py - y0) * (x1 - x0) / (y1 - y0)
+            if np.count_nonzero(crosses & (px < xcross)) % 2:
+                inside.append(i)
+        return inside
+
+    def _node_bound(self, px, py):
+        dx = np.maximum(np.maximum(self.nxmin - px, px - self.nxmax), 0.0)
+        dy = np.maximum(np.maximum(self.nymin - py, py - self.nymax), 0.0)
+        return np.hypot(dx, dy)
+
+    def nearest_distance(self, xs, ys):
+        out = np.full(len(xs), np.inf)
+        if not len(self.feature):
+            return out
+        for n, (px, py) in enumerate(zip(xs.tolist(), ys.tolist())):
+            if self._containing(px, py):
+                out[n] = 0.0
+                continue
+            bound = self._node_bound(px, py)
+            order = np.argsort(bound)
+            best = np.inf
+            for b in range(0, len(order), NODE_BATCH):
+                nodes = order[b:b + NODE_BATCH]
+                if bound[nodes[0]] > best:
+                    break
+                index = np.concatenate([np.arange(self.node_start[i], self.node_end[i])
+                                        for i in nodes.tolist()])
+                best = min(best, _segment_distance(px, py, self.sx0[index], self.sy0[index],
+                                                   self.sx1[index], self.sy1[index]).min())
+            out[n] = best
+        return out
+
+    def count_within(self, xs, ys, distance):
+        out = np.zeros(len(xs), dtype=np.int64)
+        if not len(self.feature):
+            return out
+        for n, (px, py) in enumerate(zip(xs.tolist(), ys.tolist())):
+            found = set(self._containing(px, py))
+            nodes = np.flatnonzero(self._node_bound(px, py) <= distance)
+            if len(nodes):
+                index = np.concatenate([np.arange(self.node_start[i], self.node_end[i])
+                                        for i in nodes.tolist()])
+                near = _segment_distance(px, py, self.sx0[index], self.sy0[index],
+                                         self.sx1[index], self.sy1[index]) <= distance
+                found.update(self.sfeature[index[near]].tolist())
+            out[n] = len(found)
+        return out
+
+
+# The features of one layer in a shapely STRtree.
+class _ShapelyTree:
+
+    def __init__(self, wkbs):
+        self.geoms = shapely.from_wkb([bytes(wkb) for wkb in wkbs])
+        self.tree = shapely.STRtree(self.geoms)
+
+    def nearest_distance(self, xs, ys):
+        out = np.full(len(xs), np.inf)
+        if not len(self.geoms) or not len(xs):
+            return out
+        (points, features), distances = self.tree.query_nearest(
+            shapely.points(xs, ys), return_distance=True, all_matches=False)
+        out[points] = distances
+        return out
+
+    def count_within(self, xs, ys, distance):
+        if not len(self.geoms) or not len(xs):
+            return np.zeros(len(xs), dtype=np.int64)
+        points, features = self.tree.query(shapely.points(xs, ys), predicate='dwithin',
+                                           distance=distance)
+        return np.bincount(points, minlength=len(xs))
+
+
+# A spatial index over one layer. Answers distance questions for arrays of
+# point coordinates.
+class LayerIndex:
+
+    def __init__(self, name, wkbs):
+        self.name = name
+        self.features = len(wkbs)
+        self.tree = _ShapelyTree(wkbs) if shapely is not None else _SegmentTree(wkbs)
+
+    # Distance from each point to the nearest feature, inf for an empty layer.
+    def nearest_distance(self, xs, ys):
+        return self.tree.nearest_distance(np.asarray(xs, dtype=np.float64),
+                                          np.asarray(ys, dtype=np.float64))
+
+    # Number of features within distance of each point.
+    def count_within(self, xs, ys, distance):
+        return self.tree.count_within(np.asarray(xs, dtype=np.float64),
+                                      np.asarray(ys, dtype=np.float64), distance)
+
+
+class ProximityEngine:
+
+    def __init__(self, candidates, rec_areas, interstates):
+        self.candidates = candidates
+        self.rec_areas = rec_areas
+        self.interstates = interstates
+        xs, ys = candidates['x'], candidates['y']
+        self.feet_to_recreation = rec_areas.nearest_distance(xs, ys)
+        self.feet_to_interstate = interstates.nearest_distance(xs, ys)
+
+        # Reported miles, and the same values as floats for threshold tests.
+        self.miles_to_recreation = round_miles(self.feet_to_recreation)
+        self.miles_to_interstate = round_miles(self.feet_to_interstate)
+        self.recreation = np.array(self.miles_to_recreation, dtype=np.float64)
+        self.interstate = np.array(self.miles_to_interstate, dtype=np.float64)
+        self.recreation[np.isnan(self.recreation)] = np.inf
+        self.interstate[np.isnan(self.interstate)] = np.inf
+
+    def __len__(self):
+        return len(self.recreation)
+
+    # Which candidates pass the mile criteria, None disables a criterion. As in
+    # the query, candidates need a recreation area and an interstate.
+    def mask(self, max_recreation_miles=None, max_interstate_miles=None):
+        mask = np.isfinite(self.recreation) & np.isfinite(self.interstate)
+        if max_recreation_miles is not None:
+            mask &= self.recreation <= max_recreation_miles
+        if max_interstate_miles is not None:
+            mask &= self.interstate <= max_interstate_miles
+        return mask
+
+    # The rows of siteselect.selection_query for the same criteria, as records,
+    # ordered by miles to the interstate.
+    def select(self, max_recreation_miles=None, max_interstate_miles=None):
+        Record = pgdb.record_type(RESULT_COLUMNS)
+        columns = [self.candidates[name].tolist() for name in RESULT_COLUMNS[:-2]]
+        rows = list(zip(*columns, self.miles_to_recreation, self.miles_to_interstate))
+        keep = np.flatnonzero(self.mask(max_recreation_miles, max_interstate_miles)).tolist()
+        keep.sort(key=lambda i: (self.interstate[i], rows[i][0]))
+        return [Record(*rows[i]) for i in keep]
+
+    # Number of passing candidates for every pair of thresholds, an array of
+    # len(recreation_miles) x len(interstate_miles).
+    def sweep(self, recreation_miles, interstate_miles):
+        rec = np.asarray(list(recreation_miles), dtype=np.float64)
+        ist = np.asarray(list(interstate_miles), dtype=np.float64)
+        rec_ok = self.recreation[None, :] <= rec[:, None]
+        ist_ok = self.interstate[None, :] <= ist[:, None]
+        return rec_ok.astype(np.int64) @ ist_ok.T.astype(np.int64)
+
+
+def _layer(conn, schema, table):
+    sql = LAYER_QUERY.format(schema=schema, table=table, srid=SRID)
+    return LayerIndex(table, [row[0] for row in pgdb.iter_query(conn, sql, records=False)])
+
+
+# Stream the candidates and layers of a schema prepared by siteselect.prepare
+# and build the engine.
+def load(conn, schema=SCHEMA):
+    candidates = pgdb.iter_columns(conn, siteselect.candidates_query(schema, CANDIDATE_COLUMNS),
+                                   dtypes={'x': np.float64, 'y': np.float64})
+    return ProximityEngine(candidates, _layer(conn, schema, 'rec_areas'),
+                           _layer(conn, schema, 'interstates'))
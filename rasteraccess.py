@@ -0,0 +1,133 @@
+# Raster access.
+#
+# Read windows of raster bands as numpy arrays, either as memory-mapped views of
+# the file or through GDAL. A GeoTIFF is mapped with numpy.memmap when it is
+# uncompressed, untiled (one strip spans the full raster width) and its strips
+# are stored back to back, so each band is a plain (rows, cols) array in the
+# file. Windows of a mapped band are read-only views, no data is copied until it
+# is used and the OS page cache does the I/O. Any other layout, including HFA
+# files, is read through GDAL band.ReadAsArray.
+
+import gdal_array
+import numpy as np
+import os
+
+
+# Reader for the bands of an open dataset.
+class RasterReader:
+
+    def __init__(self, ds, use_mmap=True):
+        self.ds = ds
+        self.arrays = map_bands(ds) if use_mmap else None
+
+    # True when the bands are memory mapped.
+    @property
+    def mapped(self):
+        return self.arrays is not None
+
+    # Whole band n as a memory-mapped array, or None when the file isn't mapped.
+    def band_array(self, n):
+        return self.arrays[n] if self.arrays is not None else None
+
+    # Window of band n. Mapped windows are read-only views of the file.
+    def read(self, n, xoff, yoff, xsize, ysize):
+        if self.arrays is not None:
+            return self.arrays[n][yoff:yoff + ysize, xoff:xoff + xsize]
+        return self.ds.GetRasterBand(n).ReadAsArray(xoff, yoff, xsize, ysize)
+
+
+# Memory map the bands of a dataset. Returns a dict of read-only (rows, cols)
+# arrays keyed by band number, or None when the file layout can't be mapped.
+def map_bands(ds):
+    layout = mappable_layout(ds)
+    if layout is None:
+        return None
+
+    path, offset, dtype, interleave = layout
+    cols, rows, bands = ds.RasterXSize, ds.RasterYSize, ds.RasterCount
+
+    if interleave == 'PIXEL':
+        data = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(rows, cols, bands))
+        return {n: data[:, :, n - 1] for n in range(1, bands + 1)}
+
+    return {
+        n: np.memmap(path, dtype=dtype, mode='r', offset=band_offset, shape=(rows, cols))
+        for n, band_offset in offset.items()
+    }
+
+
+# Check whether a dataset can be memory mapped. Returns (path, offset, dtype,
+# interleave) or None. For BAND interleave offset is a dict of file offsets
+# keyed by band number.
+def mappable_layout(ds):
+    path = ds.GetDescription()
+    if ds.GetDriver().ShortName != 'GTiff' or not os.path.isfile(path):
+        return None
+
+    if ds.GetMetadataItem('COMPRESSION', 'IMAGE_STRUCTURE') is not None:
+        return None
+    interleave = ds.GetMetadataItem('INTERLEAVE', 'IMAGE_STRUCTURE') or 'BAND'
+    if interleave not in ('PIXEL', 'BAND') or ds.RasterCount == 0:
+        return None
+
+    cols, rows, bands = ds.RasterXSize, ds.RasterYSize, ds.RasterCount
+    band_types = set(ds.GetRasterBand(n).DataType for n in range(1, bands + 1))
+    if len(band_types) != 1:
+        return None
+
+    dtype = np.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(band_types.pop()))
+    if dtype.kind not in 'uif':
+        return None
+
+    # Sub-byte and odd bit depths are packed.
+    band = ds.GetRasterBand(1)
+    nbits = band.GetMetadataItem('NBITS', 'IMAGE_STRUCTURE')
+    if nbits is not None and int(nbits) != dtype.itemsize * 8:
+        return None
+
+    with open(path, 'rb') as f:
+        byte_order = f.read(2)
+    if byte_order == b'II':
+        dtype = dtype.newbyteorder('<')
+    elif byte_order == b'MM':
+        dtype = dtype.newbyteorder('>')
+    else:
+        return None
+
+    row_bytes = cols * dtype.itemsize * (bands if interleave == 'PIXEL' else 1)
+    band_list = [1] if interleave == 'PIXEL' else range(1, bands + 1)
+
+    offsets = {}
+    for n in band_list:
+        offset = _contiguous_strips(ds.GetRasterBand(n), cols, rows, row_bytes)
+        if offset is None:
+            return None
+        offsets[n] = offset
+
+    if interleave == 'PIXEL':
+        return path, offsets[1], dtype, interleave
+    return path, offsets, dtype, interleave
+
+
+# File offset of the first strip of a band when the band is untiled and its
+# strips are stored back to back, otherwise None.
+def _contiguous_strips(band, cols, rows, row_bytes):
+    xblock, yblock = band.GetBlockSize()
+    if xblock != cols:
+        return None
+
+    first = None
+    for k in range((rows + yblock - 1) // yblock):
+        offset = band.GetMetadataItem('BLOCK_OFFSET_0_{0}'.format(k), 'TIFF')
+        size = band.GetMetadataItem('BLOCK_SIZE_0_{0}'.format(k), 'TIFF')
+        if offset is None or size is None:
+            return None
+
+        offset, size = int(offset), int(size)
+        if first is None:
+            first = offset
+        strip_rows = min(yblock, rows - k * yblock)
+        if offset != first + k * yblock * row_bytes or size < strip_rows * row_bytes:
+            return None
+
+    return first
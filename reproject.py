@@ -0,0 +1,154 @@
+# Batched coordinate reprojection.
+#
+# Reproject many geometries with one TransformPoints call instead of calling
+# Transform on each geometry. Geometries are passed as WKB. The coordinates of
+# every geometry in a batch are gathered with numpy from byte offsets found by
+# walking the WKB headers, transformed together, and written back into copies
+# of the WKB, so the rebuilt geometries keep their exact structure. Geometry
+# types the walker does not handle (curves, TINs) fall back to Transform.
+#
+#   wkbs = [geom.ExportToWkb() for geom in geoms]
+#   wkbs = reproject.transform_wkbs(wkbs, 4326, 3857)
+
+import ogr, osr
+import numpy as np
+import struct
+import threading
+
+# Features gathered per TransformPoints call by the loaders.
+BATCH_SIZE = 2000
+
+# Coordinate transformations keyed by (source SRID, target SRID), per thread
+# since a CoordinateTransformation can't be shared between threads.
+_local = threading.local()
+
+
+# Cached coordinate transformation between two EPSG codes. Returns
+# (transform, target spatial reference).
+def get_transform(src_srid, dst_srid):
+    _transforms = _local.__dict__.setdefault('transforms', {})
+    key = (src_srid, dst_srid)
+    if key not in _transforms:
+        src_srs = osr.SpatialReference()
+        src_srs.ImportFromEPSG(src_srid)
+        dst_srs = osr.SpatialReference()
+        dst_srs.ImportFromEPSG(dst_srid)
+        _transforms[key] = (osr.CoordinateTransformation(src_srs, dst_srs), dst_srs)
+    return _transforms[key]
+
+
+# Walk a WKB geometry starting at pos and append a (byte offset, point count,
+# dimensions, has_z) run for each coordinate sequence. Returns the position
+# after the geometry, or raises ValueError for unsupported types.
+def _coord_runs(wkb, pos, runs):
+    endian = '<' if wkb[pos] == 1 else '>'
+    if endian != '<':
+        raise ValueError('big endian WKB')
+    geom_type = struct.unpack_from('<I', wkb, pos + 1)[0]
+    pos += 5
+
+    # Old style 2.5D flag or ISO Z/M/ZM type codes.
+    flat = geom_type & 0x0fffffff
+    has_z = bool(geom_type & 0x80000000) or 1000 <= flat < 2000 or 3000 <= flat < 4000
+    has_m = 2000 <= flat < 4000 or bool(geom_type & 0x40000000)
+    dims = 2 + has_z + has_m
+    base = flat % 1000
+
+    if base == 1:
+        runs.append((pos, 1, dims, has_z))
+        return pos + 8 * dims
+
+    if base == 2:
+        count = struct.unpack_from('<I', wkb, pos)[0]
+        runs.append((pos + 4, count, dims, has_z))
+        return pos + 4 + 8 * dims * count
+
+    if base == 3:
+        rings = struct.unpack_from('<I', wkb, pos)[0]
+        pos += 4
+        for i in range(rings):
+            count = struct.unpack_from('<I', wkb, pos)[0]
+            runs.append((pos + 4, count, dims, has_z))
+            pos += 4 + 8 * dims * count
+        return pos
+
+    if base in (4, 5, 6, 7):
+        parts = struct.unpack_from('<I', wkb, pos)[0]
+        pos += 4
+        for i in range(parts):
+            pos = _coord_runs(wkb, pos, runs)
+        return pos
+
+    raise ValueError('unsupported WKB geometry type {0}'.format(geom_type))
+
+
+# Reproject a sequence of WKB geometries from src_srid to dst_srid with a single
+# TransformPoints call. Returns a list of WKB bytes in the same order.
+def transform_wkbs(wkbs, src_srid, dst_srid):
+    transform, dst_srs = get_transform(src_srid, dst_srid)
+
+    buf = bytearray()
+    spans = []
+    runs = []
+    fallback = {}
+    for i, wkb in enumerate(wkbs):
+        wkb = bytes(wkb)
+        if wkb[0] != 1:
+            geom = ogr.CreateGeometryFromWkb(wkb)
+            wkb = geom.ExportToWkb(ogr.wkbNDR)
+        geom_runs = []
+        try:
+            _coord_runs(wkb, 0, geom_runs)
+        except ValueError:
+            geom = ogr.CreateGeometryFromWkb(wkb)
+            geom.Transform(transform)
+            fallback[i] = geom.ExportToWkb(ogr.wkbNDR)
+            continue
+        start = len(buf)
+        buf += wkb
+        spans.append((i, start, len(buf)))
+        runs += [(start + offset, count, dims, has_z) for offset, count, dims, has_z in geom_runs]
+
+    runs = [run for run in runs if run[1] > 0]
+    if runs:
+        offsets = np.array([run[0] for run in runs], dtype=np.int64)
+        counts = np.array([run[1] for run in runs], dtype=np.int64)
+        dims = np.array([run[2] for run in runs], dtype=np.int64)
+        has_z = np.array([run[3] for run in runs], dtype=bool)
+
+        # Byte offset of every point, and whether it carries a Z value.
+        first = np.repeat(np.cumsum(counts) - counts, counts)
+        point = np.arange(counts.sum()) - first
+        point_offsets = np.repeat(offsets, counts) + point * 8 * np.repeat(dims, counts)
+        point_z = np.repeat(has_z, counts)
+
+        data = np.frombuffer(buf, dtype=np.uint8)
+        xy_index = point_offsets[:, None] + np.arange(16)
+        coords = np.zeros((len(point_offsets), 3))
+        coords[:, :2] = data[xy_index].view('<f8')
+        z_index = point_offsets[point_z][:, None] + np.arange(16, 24)
+        coords[point_z, 2] = data[z_index].view('<f8').ravel()
+
+        result = np.array(transform.TransformPoints(coords.tolist()), dtype=np.float64)
+
+        data[xy_index] = np.ascontiguousarray(result[:, :2]).view(np.uint8)
+        data[z_index] = np.ascontiguousarray(result[point_z, 2:3]).view(np.uint8)
+
+    out = [None] * len(wkbs)
+    for i, start, end in spans:
+        out[i] = bytes(buf[start:end])
+    for i, wkb in fallback.items():
+        out[i] = wkb
+    return out
+
+
+# Reproject a sequence of OGR geometries. Returns new geometries with the
+# target spatial reference assigned, the inputs are not modified.
+def transform_geometries(geoms, src_srid, dst_srid):
+    transform, dst_srs = get_transform(src_srid, dst_srid)
+    out = []
+    for wkb in transform_wkbs([geom.ExportToWkb(ogr.wkbNDR) for geom in geoms], src_srid, dst_srid):
+        geom = ogr.CreateGeometryFromWkb(wkb)
+        geom.AssignSpatialReference(dst_srs)
+        out.append(geom)
+    return out
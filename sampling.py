@@ -0,0 +1,124 @@
+# Point sampling.
+#
+# Sample raster band values at many pixel offsets. Sites are sorted by the
+# raster block they fall in and each touched block is read once for all the
+# bands, the values for all the sites in the block are gathered with numpy
+# fancy indexing.
+# Blocks holding a small cluster of sites are read with a window just covering
+# the cluster instead of the whole block.
+
+import gdal_array
+import numpy as np
+
+import rasteraccess
+import utils
+
+# Read a window around the sites in a block instead of the whole block when the
+# window is no more than this fraction of the block area.
+WINDOW_FRACTION = 0.25
+
+
+# Group pixel offsets by raster block and plan the reads needed to sample them.
+# Returns a list of ((xoff, yoff, xsize, ysize), site_indices) for the sites
+# inside the raster, in block order.
+def plan_reads(cols, rows, raster_size, block_size, window_fraction=WINDOW_FRACTION):
+    xsize, ysize = raster_size
+    xblock, yblock = block_size
+    cols = np.asarray(cols, dtype=np.int64)
+    rows = np.asarray(rows, dtype=np.int64)
+
+    inside = np.flatnonzero((cols >= 0) & (cols < xsize) & (rows >= 0) & (rows < ysize))
+    if inside.size == 0:
+        return []
+
+    nxblocks = (xsize + xblock - 1) // xblock
+    block_key = (rows[inside] // yblock) * nxblocks + cols[inside] // xblock
+    order = np.argsort(block_key, kind='stable')
+    inside, block_key = inside[order], block_key[order]
+
+    reads = []
+    for sites in np.split(inside, np.flatnonzero(np.diff(block_key)) + 1):
+        c, r = cols[sites], rows[sites]
+        bxoff = (c[0] // xblock) * xblock
+        byoff = (r[0] // yblock) * yblock
+        bxsize = min(xblock, xsize - bxoff)
+        bysize = min(yblock, ysize - byoff)
+
+        cmin, cmax = int(c.min()), int(c.max())
+        rmin, rmax = int(r.min()), int(r.max())
+        wxsize, wysize = cmax - cmin + 1, rmax - rmin + 1
+
+        if wxsize * wysize <= window_fraction * bxsize * bysize:
+            window = (cmin, rmin, wxsize, wysize)
+        else:
+            window = (int(bxoff), int(byoff), int(bxsize), int(bysize))
+        reads.append((window, sites))
+
+    return reads
+
+
+# Sample bands of a dataset at arrays of pixel offsets (cols, rows). Returns an
+# array of shape (number of sites, number of bands). Sites outside the raster
+# are set to fill_value. Memory-mapped files (see rasteraccess) are indexed
+# directly. Otherwise, when a BlockCache is given whole blocks are read through
+# the cache.
+def sample_offsets(ds, cols, rows, band_list=None, fill_value=0,
+                   window_fraction=WINDOW_FRACTION, cache=None, use_mmap=True):
+    if band_list is None:
+        band_list = list(range(1, ds.RasterCount + 1))
+
+    bands = [ds.GetRasterBand(n) for n in band_list]
+    block_size = bands[0].GetBlockSize()
+
+    # Cached reads are whole blocks, which needs the same layout in every band.
+    if cache is not None:
+        if all(band.GetBlockSize() == block_size for band in bands):
+            window_fraction = 0
+        else:
+            cache = None
+
+    dtype = np.result_type(*[
+        gdal_array.GDALTypeCodeToNumericTypeCode(band.DataType) for band in bands])
+    buf_type = gdal_array.NumericTypeCodeToGDALTypeCode(dtype)
+
+    cols = np.asarray(cols, dtype=np.int64)
+    rows = np.asarray(rows, dtype=np.int64)
+    values = np.full((cols.size, len(bands)), fill_value, dtype=dtype)
+
+    # Gather straight from mapped bands, in block order for locality.
+    reader = rasteraccess.RasterReader(ds, use_mmap)
+    if reader.mapped:
+        for window, sites in plan_reads(
+                cols, rows, (ds.RasterXSize, ds.RasterYSize), block_size, 0):
+            for i, n in enumerate(band_list):
+                values[sites, i] = reader.band_array(n)[rows[sites], cols[sites]]
+        return values
+
+    reads = plan_reads(
+        cols, rows, (ds.RasterXSize, ds.RasterYSize), block_size, window_fraction)
+
+    xblock, yblock = block_size
+    for (xoff, yoff, xsize, ysize), sites in reads:
+        r = rows[sites] - yoff
+        c = cols[sites] - xoff
+        if cache is None:
+            data = ds.ReadAsArray(xoff, yoff, xsize, ysize, band_list=band_list,
+                                  buf_type=buf_type)
+            if data.ndim == 2:
+                data = data[np.newaxis]
+            values[sites] = data[:, r, c].T
+        else:
+            for i, n in enumerate(band_list):
+                data = cache.read_block(ds, n, xoff // xblock, yoff // yblock)
+                values[sites, i] = data[r, c]
+
+    return values
+
+
+# Sample bands of a dataset at arrays of georeferenced coordinates (x, y) using
+# the full dataset GeoTransform. See sample_offsets.
+def sample_coords(ds, x, y, band_list=None, fill_value=0,
+                  window_fraction=WINDOW_FRACTION, cache=None, use_mmap=True):
+    cols, rows = utils.GeoTransform(ds.GetGeoTransform()).offsets(x, y)
+    return sample_offsets(
+        ds, cols, rows, band_list, fill_value, window_fraction, cache, use_mmap)
@@ -0,0 +1,440 @@
+# Shapefile ingest into PostGIS.
+#
+# Table DDL and feature loading for the geog585_ch03 importer. The tables for
+# all layers are created up front by prepare_layers, then each layer is loaded
+# by load_layer which opens its own shapefile handle and PostGIS connection.
+# ingest_layers runs load_layer for many layers, one after another or in a pool
+# of worker processes. A layer that fails is reported without affecting the
+# layers loaded by other workers, and emptied unless a manifest lets the next
+# run resume it.
+
+import hashlib
+import ogr
+import psycopg2
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import clip
+import layermap
+import manifest
+import pgcopy
+import pipeline
+import reproject
+import tableload
+
+
+# Settings shared by every layer of an ingest.
+#
+#   dsn          - OGR 'PG:' connection string
+#   dest_schema  - destination schema
+#   src_srid     - source shapefile SRID
+#   dest_srid    - destination table SRID
+#   load_mode    - 'copy' or 'feature', see geog585_ch03.py
+#   trim_wkb     - WKB of the trim geometry in the source SRS, or None
+#   clip         - clip features to the trim geometry, see clip.py, otherwise
+#                  load every feature whose bounding box touches it
+#   staged       - load into UNLOGGED staging tables which are indexed,
+#                  analyzed and swapped in after loading, see tableload.py
+#   manifest     - record loads in the dest_schema ingest manifest, skip
+#                  unchanged layers and resume interrupted ones, see manifest.py
+#   transform_workers - reprojection threads between each layer's reader and
+#                  writer, see pipeline.py
+class IngestSettings:
+
+    def __init__(self, dsn, dest_schema, src_srid, dest_srid, load_mode='copy', trim_wkb=None,
+                 clip=False, staged=False, manifest=False, transform_workers=2):
+        self.dsn = dsn
+        self.dest_schema = dest_schema
+        self.src_srid = src_srid
+        self.dest_srid = dest_srid
+        self.load_mode = load_mode
+        self.trim_wkb = trim_wkb
+        self.clip = clip and trim_wkb is not None
+        self.staged = staged
+        self.manifest = manifest
+        self.transform_workers = transform_workers
+
+    # libpq connection string for psycopg2.
+    @property
+    def pg_dsn(self):
+        return self.dsn[len('PG:'):].strip() if self.dsn.startswith('PG:') else self.dsn
+
+    # Manifest key for the settings that change what is loaded from a source.
+    @property
+    def settings_key(self):
+        trim = hashlib.sha1(self.trim_wkb).hexdigest() if self.trim_wkb is not None else ''
+        return '{0}:{1}:{2}:{3}'.format(self.src_srid, self.dest_srid, int(self.clip), trim)
+
+
+# Outcome of loading one layer.
+class LayerResult:
+
+    def __init__(self, shapefile, layer_name, rows=0, elapsed=0.0, error=None, clip_counts=None):
+        self.shapefile = shapefile
+        self.layer_name = layer_name
+        self.rows = rows
+        self.elapsed = elapsed
+        self.error = error
+        self.clip_counts = clip_counts
+        self.timings = None
+        self.total_rows = rows
+        self.stages = None
+
+    @property
+    def rows_per_sec(self):
+        return self.rows / self.elapsed if self.elapsed > 0 else 0.0
+
+
+# Table layout of the Philadelphia base layers. Layers without a mapping get
+# the common columns.
+COMMON_COLUMNS = [
+    layermap.Column('osm_id', 'bigint'),
+    layermap.Column('name', 'character varying(48)'),
+    layermap.Column('type', 'character varying(48)'),
+]
+
+LAYER_MAPPINGS = {
+    'roads': layermap.LayerMapping(COMMON_COLUMNS + [
+        layermap.Column('ref', 'character varying(48)'),
+        layermap.Column('oneway', 'boolean', coerce=layermap.to_boolean),
+        layermap.Column('bridge', 'boolean', coerce=layermap.to_boolean),
+    ], geometry_type=ogr.wkbMultiLineString),
+    'places': layermap.LayerMapping(COMMON_COLUMNS + [
+        layermap.Column('population', 'integer'),
+    ]),
+    'waterways': layermap.LayerMapping(COMMON_COLUMNS + [
+        layermap.Column('width', 'integer'),
+    ]),
+}
+
+DEFAULT_MAPPING = layermap.LayerMapping(COMMON_COLUMNS)
+
+
+def layer_mapping(layer_name):
+    return LAYER_MAPPINGS.get(layer_name, DEFAULT_MAPPING)
+
+
+# Open a shapefile layer with the trim spatial filter applied.
+def open_source_layer(shapefile, settings):
+    srcDS = ogr.GetDriverByName('ESRI Shapefile').Open(shapefile, 0)
+    if srcDS is None:
+        raise IOError("Can't open shapefile " + shapefile)
+    srcLayer = srcDS.GetLayer()
+    if settings.trim_wkb is not None:
+        srcLayer.SetSpatialFilter(ogr.CreateGeometryFromWkb(settings.trim_wkb))
+    return srcDS, srcLayer
+
+
+# Read a layer in batches of (column values, WKB) for each feature. Geometry is
+# exported to WKB as it is read, OGR geometry references do not outlive their
+# feature. With a clipper, features outside the trim geometry are skipped and
+# crossing features are replaced by their clipped geometry. The first
+# source_offset features are skipped. Yields (batch, source features read).
+def feature_batches(srcLayer, field_map, batch_size, clipper=None, source_offset=0):
+    batch = []
+    position = 0
+    for srcFeature in srcLayer:
+        position += 1
+        if position <= source_offset:
+            continue
+        geom = srcFeature.GetGeometryRef()
+        if clipper is not None:
+            geom = clipper.clip(geom)
+            if geom is None:
+                continue
+        batch.append((field_map.values(srcFeature), geom.ExportToWkb(ogr.wkbNDR)))
+        if len(batch) >= batch_size:
+            yield batch, position
+            batch = []
+    yield batch, position
+
+
+# OGR geometry type of the table for a layer. Clipping can split lines and
+# polygons, so clipped line and polygon layers are promoted to multi types.
+def layer_geom_type(srcLayer, mapping, settings):
+    return mapping.table_geom_type(srcLayer.GetGeomType(), settings.clip)
+
+
+# Table features of a layer are loaded into.
+def load_table_name(layer_name, settings):
+    return tableload.staging_name(layer_name) if settings.staged else layer_name
+
+
+# Create the destination table for a shapefile, the staging table when staged.
+# Returns (layer_name, geom_type, feature_count).
+def create_layer_table(destDS, shapefile, settings):
+    srcDS, srcLayer = open_source_layer(shapefile, settings)
+    layer_name = srcLayer.GetName()
+    mapping = layer_mapping(layer_name)
+    geom_type = layer_geom_type(srcLayer, mapping, settings)
+    feature_count = srcLayer.GetFeatureCount()
+    srcLayer = srcDS = None
+
+    if settings.staged:
+        conn = psycopg2.connect(settings.pg_dsn)
+        try:
+            tableload.TableLoad(conn, settings.dest_schema, layer_name).create(
+                mapping.column_ddl(geom_type, settings.dest_srid))
+        finally:
+            conn.close()
+    else:
+        destDS.ExecuteSQL(mapping.table_ddl(
+            settings.dest_schema, layer_name, geom_type, settings.dest_srid))
+    return layer_name, layermap.postgis_geom_type(geom_type), feature_count
+
+
+# What to do with a source layer, see prepare_layers.
+class LayerPlan:
+
+    def __init__(self, shapefile, layer_name, geom_type, feature_count, action=manifest.LOAD,
+                 source_offset=0, rows_loaded=0):
+        self.shapefile = shapefile
+        self.layer_name = layer_name
+        self.geom_type = geom_type
+        self.feature_count = feature_count
+        self.action = action
+        self.source_offset = source_offset
+        self.rows_loaded = rows_loaded
+
+
+# Plan the load of a list of shapefiles and create the tables of the layers to
+# load from the start. Returns a list of LayerPlans. Without a manifest every
+# layer is loaded. With one, layers with unchanged sources are skipped or
+# resumed, see manifest.Manifest.plan.
+def prepare_layers(destDS, shapefiles, settings):
+    conn = psycopg2.connect(settings.pg_dsn) if settings.manifest else None
+    try:
+        manifestDB = manifest.Manifest(conn, settings.dest_schema) if conn is not None else None
+
+        plans = []
+        for shapefile in shapefiles:
+            srcDS, srcLayer = open_source_layer(shapefile, settings)
+            layer_name = srcLayer.GetName()
+            srcLayer = srcDS = None
+
+            action, entry = manifest.LOAD, None
+            if manifestDB is not None:
+                action, entry = manifestDB.plan(layer_name, load_table_name(layer_name, settings),
+                                                shapefile, settings.settings_key)
+
+            if action == manifest.LOAD:
+                layer_name, geom_type, feature_count = create_layer_table(
+                    destDS, shapefile, settings)
+                if manifestDB is not None:
+                    manifestDB.begin(layer_name, shapefile, settings.settings_key)
+                plans.append(LayerPlan(shapefile, layer_name, geom_type, feature_count))
+            else:
+                plans.append(LayerPlan(shapefile, layer_name, None, None, action,
+                                       entry.source_offset, entry.rows_loaded))
+        return plans
+
+    finally:
+        if conn is not None:
+            conn.close()
+
+
+# Load the features of a shapefile into its table. Runs in a worker process, so
+# it opens its own shapefile handle and PostGIS connection. Returns a LayerResult.
+#
+# Within the layer, reading (and clipping), reprojection and writing overlap as
+# the stages of a bounded pipeline: the source is read on one thread, batches
+# are reprojected by settings.transform_workers threads and written in order
+# on this one.
+#
+# With a manifest, COPY batches are committed on feature batch boundaries along
+# with the rows loaded and source features read, and a load resumes after
+# source_offset features with rows_loaded rows already in the table.
+def load_layer(shapefile, layer_name, settings, source_offset=0, rows_loaded=0):
+    ogr.UseExceptions()
+
+    srcDS, srcLayer = open_source_layer(shapefile, settings)
+    table = settings.dest_schema + '.' + load_table_name(layer_name, settings)
+    mapping = layer_mapping(layer_name)
+    field_map = mapping.compile(srcLayer.GetLayerDefn())
+    geom_type = layer_geom_type(srcLayer, mapping, settings)
+    promote = geom_type != 0 and geom_type != srcLayer.GetGeomType()
+
+    clipper = None
+    if settings.clip:
+        clipper = clip.TrimClipper(ogr.CreateGeometryFromWkb(settings.trim_wkb))
+
+    # Source features read up to the current batch.
+    position = [source_offset]
+
+    def record_progress(curs, rows):
+        curs.execute(manifest.progress_sql(settings.dest_schema),
+                     (rows_loaded + rows, position[0], layer_name))
+
+    if settings.load_mode == 'copy':
+        conn = psycopg2.connect(settings.pg_dsn)
+        if settings.manifest:
+            loader = pgcopy.CopyLoader(conn, table, mapping.column_names + ['geom'],
+                                       batch_rows=None, before_commit=record_progress)
+        else:
+            loader = pgcopy.CopyLoader(conn, table, mapping.column_names + ['geom'])
+    else:
+        destDS = ogr.Open(settings.dsn, 1)
+        destLayer = destDS.GetLayerByName(table)
+        destFeatureDefn = destLayer.GetLayerDefn()
+        dest_indexes = [destFeatureDefn.GetFieldIndex(name) for name in mapping.column_names]
+
+    # Transform stage: reproject a batch and promote its geometry to the table
+    # type, roads to MultiLineString.
+    def transform_batch(item):
+        batch, read = item
+        wkbs = reproject.transform_wkbs(
+            [wkb for row, wkb in batch], settings.src_srid, settings.dest_srid)
+
+        rows = []
+        for (row, src_wkb), wkb in zip(batch, wkbs):
+            geom = ogr.CreateGeometryFromWkb(wkb)
+            if promote:
+                geom = ogr.ForceTo(geom, geom_type)
+
+            if settings.load_mode == 'copy':
+                rows.append(row + [pgcopy.ewkb_hex(geom, settings.dest_srid)])
+            else:
+                rows.append((row, geom.ExportToWkb()))
+        return rows, read
+
+    row_count = 0
+
+    # Write stage, on this thread.
+    def write_batch(item):
+        nonlocal row_count
+        rows, read = item
+
+        if settings.load_mode == 'copy':
+            for row in rows:
+                loader.add(row)
+
+        else:
+            for row, wkb in rows:
+                destFeature = ogr.Feature(destFeatureDefn)
+                for index, value in zip(dest_indexes, row):
+                    if value is not None:
+                        destFeature.SetField(index, value)
+
+                destFeature.SetGeometry(ogr.CreateGeometryFromWkb(wkb))
+                destLayer.CreateFeature(destFeature)
+
+        row_count += len(rows)
+        position[0] = read
+        if settings.load_mode == 'copy' and loader.batch_rows is None and \
+                loader.pending >= pgcopy.COPY_BATCH_ROWS:
+            loader.flush()
+
+    startTime = time.time()
+
+    try:
+        batches = feature_batches(
+            srcLayer, field_map, reproject.BATCH_SIZE, clipper, source_offset)
+        stages = pipeline.run(batches, transform_batch, write_batch, settings.transform_workers)
+
+        if settings.load_mode == 'copy':
+            loader.close()
+
+    finally:
+        if settings.load_mode == 'copy':
+            conn.close()
+        destLayer = destDS = srcLayer = srcDS = None
+
+    clip_counts = None
+    if clipper is not None:
+        clip_counts = {'inside': clipper.counts[clip.INSIDE],
+                       'crossing': clipper.counts[clip.CROSSING],
+                       'outside': clipper.counts[clip.OUTSIDE]}
+    result = LayerResult(shapefile, layer_name, row_count, time.time() - startTime,
+                         clip_counts=clip_counts)
+    result.total_rows = rows_loaded + row_count
+    result.stages = [stage.report() for stage in stages]
+    return result
+
+
+# Empty the table of a layer that failed to load.
+def truncate_layer(settings, layer_name):
+    conn = psycopg2.connect(settings.pg_dsn)
+    try:
+        with conn, conn.cursor() as curs:
+            curs.execute('TRUNCATE {0}.{1}'.format(settings.dest_schema, layer_name))
+    finally:
+        conn.close()
+
+
+# Load the LayerPlans from prepare_layers, skipped layers are left alone. With
+# more than one worker the layers are loaded by a process pool. Staged layers
+# are indexed and swapped in by this process as each one completes. A layer
+# that fails is emptied, unless there is a manifest to resume it from. progress
+# is called with each LayerResult as it completes. Returns the list of
+# LayerResults.
+def ingest_layers(plans, settings, workers=1, progress=None):
+    layers = [(plan.shapefile, plan.layer_name, plan.source_offset, plan.rows_loaded)
+              for plan in plans if plan.action != manifest.SKIP]
+    results = []
+
+    conn = psycopg2.connect(settings.pg_dsn) if settings.staged or settings.manifest else None
+    manifestDB = manifest.Manifest(conn, settings.dest_schema) if settings.manifest else None
+
+    # Index and swap in a staged layer, or drop its staging table on failure. A
+    # staging table that couldn't be swapped in is kept, with its manifest
+    # entry, so the next run resumes at the swap.
+    def finish_staged(result):
+        load = tableload.TableLoad(conn, settings.dest_schema, result.layer_name)
+        load.timings['load'] = result.elapsed
+        try:
+            load.finish()
+        except tableload.SwapError as e:
+            result.error = str(e)
+        except Exception as e:
+            result.error = repr(e)
+            load.abort()
+            if manifestDB is not None:
+                manifestDB.reset(result.layer_name)
+        result.timings = load.timings
+
+    def done(result):
+        if result.error is not None:
+            # With a manifest, keep the committed batches for the next run.
+            if manifestDB is None:
+                if settings.staged:
+                    tableload.TableLoad(conn, settings.dest_schema, result.layer_name).abort()
+                else:
+                    truncate_layer(settings, result.layer_name)
+        else:
+            if settings.staged:
+                finish_staged(result)
+            if manifestDB is not None and result.error is None:
+                manifestDB.complete(result.layer_name, result.total_rows)
+        results.append(result)
+        if progress is not None:
+            progress(result, len(results), len(layers))
+
+    try:
+        if workers <= 1:
+            for shapefile, layer_name, source_offset, rows_loaded in layers:
+                try:
+                    result = load_layer(shapefile, layer_name, settings, source_offset, rows_loaded)
+                except Exception as e:
+                    result = LayerResult(shapefile, layer_name, error=repr(e))
+                done(result)
+            return results
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(load_layer, shapefile, layer_name, settings,
+                                source_offset, rows_loaded): (shapefile, layer_name)
+                for shapefile, layer_name, source_offset, rows_loaded in layers
+            }
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except Exception as e:
+                    shapefile, layer_name = futures[future]
+                    result = LayerResult(shapefile, layer_name, error=repr(e))
+                done(result)
+
+    finally:
+        if conn is not None:
+            conn.close()
+
+    return results
@@ -0,0 +1,173 @@
+# Jen and Barry site selection, index driven.
+#
+# The original query cross joins every candidate city with every recreation
+# area and interstate, transforming both geometries to EPSG:2272 for each pair
+# and keeping min(ST_Distance). Here the 2272 geometry is a stored generated
+# column with a GiST index on each layer, kept current by PostgreSQL, and each
+# city finds its nearest recreation area and interstate with a LATERAL KNN
+# (<->) lookup that walks the index. When the recreation or interstate mile
+# criteria are enabled, cities are first filtered with index-assisted
+# ST_DWithin tests, so the nearest neighbour lookups only run for cities that
+# can pass.
+#
+#   siteselect.prepare(conn)
+#   curs.execute(*siteselect.selection_query(max_recreation_miles=10))
+
+SCHEMA = 'geog897d'
+SRID = 2272
+FEET_PER_MILE = 5280
+
+# Distances are reported in miles rounded to two places.
+ROUNDING_MILES = 0.005
+
+# Layers that get a projected geometry column, and those that also get an
+# index on their source geometry for the county/city containment join.
+PROJECTED_TABLES = ('cities', 'rec_areas', 'interstates')
+INDEXED_TABLES = ('cities', 'counties')
+
+
+# The original query, kept as the reference for bench_siteselect.py.
+ORIGINAL_QUERY = """
+SELECT ci.name AS city, co.name AS county,
+    co.no_farms87::integer AS farms,
+    co.age_18_64::integer AS labor_pool,
+    ci.crime_inde::numeric(6,4) AS crime_index,
+    co.pop_sqmile::numeric(6,2) AS pop_density,
+    ci.university > 0 AS university,
+    miles_to_recreation, miles_to_interstate
+FROM (
+  SELECT intco.gid AS county_gid, intci.gid AS city_gid,
+    min (
+      ST_Distance(ST_Transform(intci.geom, 2272), ST_Transform(rec.geom, 2272)) / 5280
+    )::numeric(6,2) AS miles_to_recreation,
+    min (
+      ST_Distance(ST_Transform(intci.geom, 2272), ST_Transform(ist.geom, 2272)) / 5280
+    )::numeric(6,2) AS miles_to_interstate
+  FROM {schema}.v_jb_candidate_counties AS intco
+    INNER JOIN {schema}.cities AS intci ON ST_Contains(intco.geom, intci.geom),
+    {schema}.rec_areas AS rec,
+    {schema}.interstates AS ist
+  GROUP BY county_gid, city_gid
+) AS a
+  INNER JOIN {schema}.cities AS ci ON ci.gid = city_gid
+  INNER JOIN {schema}.counties AS co on co.gid = county_gid
+WHERE ci.crime_inde <= 0.02
+    AND ci.university > 0
+    {criteria}
+ORDER BY miles_to_interstate
+"""
+
+
+# Cities in the candidate counties that meet the crime and university
+# criteria, with the columns of the report. Shared by selection_query and the
+# proximity engine, see candidates_query.
+CANDIDATES_QUERY = """
+SELECT ci.name AS city, co.name AS county,
+    co.no_farms87::integer AS farms,
+    co.age_18_64::integer AS labor_pool,
+    ci.crime_inde::numeric(6,4) AS crime_index,
+    co.pop_sqmile::numeric(6,2) AS pop_density,
+    ci.university > 0 AS university{columns}
+FROM {schema}.v_jb_candidate_counties AS intco
+  INNER JOIN {schema}.cities AS ci ON ST_Contains(intco.geom, ci.geom)
+  INNER JOIN {schema}.counties AS co ON co.gid = intco.gid
+WHERE ci.crime_inde <= 0.02
+    AND ci.university > 0{filters}
+"""
+
+
+# The candidate cities query with extra output columns and extra WHERE terms,
+# each starting with AND, as SQL expressions over ci (cities) and co
+# (counties).
+def candidates_query(schema=SCHEMA, columns=(), filters=()):
+    return CANDIDATES_QUERY.format(
+        schema=schema, columns=''.join(',\n    ' + column for column in columns),
+        filters=''.join('\n    ' + term for term in filters))
+
+
+# Add the stored geom_2272 columns and the GiST indexes, then ANALYZE. Safe to
+# run again, existing columns and indexes are kept.
+def prepare(conn, schema=SCHEMA):
+    with conn.cursor() as curs:
+        for table in PROJECTED_TABLES:
+            curs.execute("""
+            ALTER TABLE {schema}.{table}
+              ADD COLUMN IF NOT EXISTS geom_{srid} geometry(Geometry, {srid})
+              GENERATED ALWAYS AS (ST_Transform(geom, {srid})) STORED;
+            CREATE INDEX IF NOT EXISTS {table}_geom_{srid}_idx
+              ON {schema}.{table} USING GIST (geom_{srid});
+            """.format(schema=schema, table=table, srid=SRID))
+
+        for table in INDEXED_TABLES:
+            curs.execute("""
+            CREATE INDEX IF NOT EXISTS {table}_geom_idx ON {schema}.{table} USING GIST (geom);
+            """.format(schema=schema, table=table))
+
+        for table in set(PROJECTED_TABLES + INDEXED_TABLES):
+            curs.execute('ANALYZE {schema}.{table}'.format(schema=schema, table=table))
+    conn.commit()
+
+
+# The index driven selection query. Returns (sql, args) for cursor.execute.
+# With max_recreation_miles or max_interstate_miles, cities farther than that
+# from every recreation area or interstate are dropped. The ST_DWithin
+# pre-filters use the threshold plus the rounding of the reported miles, the
+# criteria themselves are applied to the rounded miles as in the original.
+def selection_query(schema=SCHEMA, max_recreation_miles=None, max_interstate_miles=None):
+    prefilters = []
+    criteria = []
+    prefilter_args = []
+    criteria_args = []
+    if max_recreation_miles is not None:
+        prefilters.append("""AND EXISTS (
+      SELECT 1 FROM {schema}.rec_areas AS r
+      WHERE ST_DWithin(ci.geom_{srid}, r.geom_{srid}, %s))""")
+        criteria.append('(rec.dist / {feet_per_mile})::numeric(6,2) <= %s')
+        prefilter_args.append((max_recreation_miles + ROUNDING_MILES) * FEET_PER_MILE)
+        criteria_args.append(max_recreation_miles)
+    if max_interstate_miles is not None:
+        prefilters.append("""AND EXISTS (
+      SELECT 1 FROM {schema}.interstates AS i
+      WHERE ST_DWithin(ci.geom_{srid}, i.geom_{srid}, %s))""")
+        criteria.append('(ist.dist / {feet_per_mile})::numeric(6,2) <= %s')
+        prefilter_args.append((max_interstate_miles + ROUNDING_MILES) * FEET_PER_MILE)
+        criteria_args.append(max_interstate_miles)
+
+    candidates = candidates_query(
+        schema, ['ci.geom_{0} AS geom'.format(SRID)],
+        [term.format(schema=schema, srid=SRID) for term in prefilters])
+
+    sql = """
+    SELECT c.city, c.county, c.farms, c.labor_pool, c.crime_index, c.pop_density,
+        c.university,
+        (rec.dist / {feet_per_mile})::numeric(6,2) AS miles_to_recreation,
+        (ist.dist / {feet_per_mile})::numeric(6,2) AS miles_to_interstate
+    FROM ({candidates}) AS c
+      CROSS JOIN LATERAL (
+        SELECT ST_Distance(c.geom, r.geom_{srid}) AS dist
+        FROM {schema}.rec_areas AS r
+        ORDER BY c.geom <-> r.geom_{srid}
+        LIMIT 1
+      ) AS rec
+      CROSS JOIN LATERAL (
+        SELECT ST_Distance(c.geom, i.geom_{srid}) AS dist
+        FROM {schema}.interstates AS i
+        ORDER BY c.geom <-> i.geom_{srid}
+        LIMIT 1
+      ) AS ist
+    """ + ('WHERE ' + '\n      AND '.join(criteria) if criteria else '') + """
+    ORDER BY miles_to_interstate
+    """
+    sql = sql.format(schema=schema, srid=SRID, feet_per_mile=FEET_PER_MILE,
+                     candidates=candidates)
+    return sql, prefilter_args + criteria_args
+
+
+# The original query with the same criteria, for comparison.
+def original_query(schema=SCHEMA, max_recreation_miles=None, max_interstate_miles=None):
+    criteria = []
+    if max_recreation_miles is not None:
+        criteria.append('AND miles_to_recreation <= {0}'.format(float(max_recreation_miles)))
+    if max_interstate_miles is not None:
+        criteria.append('AND miles_to_interstate <= {0}'.format(float(max_interstate_miles)))
+    return ORIGINAL_QUERY.format(schema=schema, criteria='\n    '.join(criteria)), []
@@ -0,0 +1,186 @@
+# Load-optimized table lifecycle.
+#
+# Bulk load a table without paying for index maintenance and WAL on every row,
+# and leave it indexed and analyzed:
+#
+#   1. create an UNLOGGED staging table with no indexes
+#   2. bulk load it (COPY or INSERTs, on any connection)
+#   3. SET LOGGED, add the primary key and a GiST index on the geometry
+#   4. ANALYZE
+#   5. swap it in for the target table in one transaction
+#
+# Until the swap, readers keep seeing the old target table, and a failed load
+# only has to drop the staging table. Each phase is timed.
+#
+# The old target table is dropped by the swap, so views or foreign keys that
+# depend on it block the swap. They are checked for first, and a swap that
+# can't be made raises SwapError, leaving the target table as it was and the
+# loaded staging table in place. Indexing is skipped for indexes the staging
+# table already has, so finish can be run again once the dependents are gone.
+#
+#   load = tableload.TableLoad(conn, 'usu', 'sites')
+#   load.create(['gid serial NOT NULL', 'site_id integer', 'geom geometry(Point, 32612)'])
+#   with load.phase('load'):
+#       ... load rows into load.qualified_staging ...
+#   load.finish()
+
+import time
+from contextlib import contextmanager
+
+# Staging table name suffix.
+STAGING_SUFFIX = '_load'
+
+
+# Views and foreign keys of other tables depending on a table.
+DEPENDENTS_QUERY = """
+SELECT DISTINCT 'view ' || r.ev_class::regclass::text
+FROM pg_depend AS d
+JOIN pg_rewrite AS r ON r.oid = d.objid
+WHERE d.classid = 'pg_rewrite'::regclass
+  AND d.refclassid = 'pg_class'::regclass
+  AND d.refobjid = to_regclass(%(table)s)
+  AND r.ev_class <> d.refobjid
+UNION
+SELECT 'foreign key ' || conname || ' on ' || conrelid::regclass::text
+FROM pg_constraint
+WHERE contype = 'f'
+  AND confrelid = to_regclass(%(table)s)
+  AND conrelid <> confrelid
+ORDER BY 1
+"""
+
+
+# The staging table could not be swapped in. It is kept, loaded and indexed.
+class SwapError(Exception):
+    pass
+
+
+def staging_name(table):
+    return table + STAGING_SUFFIX
+
+
+class TableLoad:
+
+    # conn is a psycopg2 connection used for the DDL, each phase is committed.
+    #
+    #   primary_key - primary key column, None for no key
+    #   geom_column - geometry column for the GiST index, None for no index
+    #   logged      - make the table logged before it is swapped in, otherwise
+    #                 it stays UNLOGGED (faster, but emptied after a crash)
+    def __init__(self, conn, schema, table, primary_key='gid', geom_column='geom', logged=True):
+        self.conn = conn
+        self.schema = schema
+        self.table = table
+        self.staging = staging_name(table)
+        self.primary_key = primary_key
+        self.geom_column = geom_column
+        self.logged = logged
+        self.timings = {}
+
+    @property
+    def qualified_table(self):
+        return '{0}.{1}'.format(self.schema, self.table)
+
+    @property
+    def qualified_staging(self):
+        return '{0}.{1}'.format(self.schema, self.staging)
+
+    # Time a phase, recorded in timings in seconds.
+    @contextmanager
+    def phase(self, name):
+        startTime = time.time()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + time.time() - startTime
+
+    def _execute(self, sql):
+        with self.conn.cursor() as curs:
+            curs.execute(sql)
+        self.conn.commit()
+
+    def _exists(self, name):
+        with self.conn.cursor() as curs:
+            curs.execute('SELECT to_regclass(%s) IS NOT NULL', ('{0}.{1}'.format(self.schema, name),))
+            exists = curs.fetchone()[0]
+        self.conn.commit()
+        return exists
+
+    # Views and foreign keys depending on the target table.
+    def dependents(self):
+        with self.conn.cursor() as curs:
+            curs.execute(DEPENDENTS_QUERY, {'table': self.qualified_table})
+            names = [row[0] for row in curs.fetchall()]
+        self.conn.commit()
+        return names
+
+    # Create the staging table from a list of column definitions.
+    def create(self, columns):
+        with self.phase('create'):
+            self._execute("""
+            DROP TABLE IF EXISTS {staging};
+            CREATE UNLOGGED TABLE {staging} (
+              {columns});
+            """.format(staging=self.qualified_staging, columns=',\n              '.join(columns)))
+
+    # Index, analyze and swap in the loaded staging table. Raises SwapError
+    # when the target table can't be replaced.
+    def finish(self):
+        if self.logged:
+            with self.phase('set logged'):
+                self._execute('ALTER TABLE {0} SET LOGGED'.format(self.qualified_staging))
+
+        if self.primary_key is not None and not self._exists(self.staging + '_pkey'):
+            with self.phase('primary key'):
+                self._execute('ALTER TABLE {0} ADD CONSTRAINT {1}_pkey PRIMARY KEY ({2})'.format(
+                    self.qualified_staging, self.staging, self.primary_key))
+
+        if self.geom_column is not None and \
+                not self._exists('{0}_{1}_idx'.format(self.staging, self.geom_column)):
+            with self.phase('spatial index'):
+                self._execute('CREATE INDEX {0}_{1}_idx ON {2} USING GIST ({1})'.format(
+                    self.staging, self.geom_column, self.qualified_staging))
+
+        with self.phase('analyze'):
+            self._execute('ANALYZE {0}'.format(self.qualified_staging))
+
+        # Swap in one transaction, the staging indexes and sequence take the
+        # target's names.
+        qstr = """
+        DROP TABLE IF EXISTS {schema}.{table};
+        ALTER TABLE {schema}.{staging} RENAME TO {table};
+        """
+        if self.primary_key is not None:
+            qstr += """
+            ALTER INDEX {schema}.{staging}_pkey RENAME TO {table}_pkey;
+            ALTER SEQUENCE IF EXISTS {schema}.{staging}_{pkey}_seq RENAME TO {table}_{pkey}_seq;
+            """
+        if self.geom_column is not None:
+            qstr += """
+            ALTER INDEX {schema}.{staging}_{geom}_idx RENAME TO {table}_{geom}_idx;
+            """
+        with self.phase('swap'):
+            dependents = self.dependents()
+            if dependents:
+                raise SwapError('{0} is kept, {1} has dependents: {2}'.format(
+                    self.qualified_staging, self.qualified_table, ', '.join(dependents)))
+            try:
+                self._execute(qstr.format(schema=self.schema, table=self.table,
+                                          staging=self.staging, pkey=self.primary_key,
+                                          geom=self.geom_column))
+            except Exception as e:
+                self.conn.rollback()
+                raise SwapError('{0} is kept, swap failed: {1}'.format(
+                    self.qualified_staging, e)) from e
+
+        return self.timings
+
+    # Drop the staging table after a failed load.
+    def abort(self):
+        self.conn.rollback()
+        self._execute('DROP TABLE IF EXISTS {0}'.format(self.qualified_staging))
+
+    # Phase timings as one line.
+    def report(self):
+        return ', '.join('{0} {1:.2f} sec'.format(name, seconds)
+                         for name, seconds in self.timings.items())
@@ -5,8 +5,14 @@
 
 import gdal, ogr
 from gdalconst import *
+import numpy as np
+import psycopg2
 import time
 import utils
+import sampling
+import manifest
+import pgdb
+import tableload
 
 ogr.UseExceptions()
 
@@ -17,7 +23,15 @@ sites_schema = 'usu'
 sites_layername = 'sites'
 sites_srid = 32612
 
-DSN = 'PG: host=localhost dbname=postgis_scratch user=postgres password=pg'
+DSN = pgdb.ogr_dsn('local')
+
+# Load the sites into an UNLOGGED staging table, then add the primary key and
+# a GiST index, ANALYZE and swap it in, see tableload.py.
+STAGED_LOAD = True
+
+# Record the sites import in the usu.ingest_manifest table and skip it when
+# sites.shp has not changed, see manifest.py.
+USE_MANIFEST = True
 
 # Open a connection to PostgreSQL.
 pgDS = ogr.Open(DSN, 1)
@@ -29,33 +43,80 @@ if sitesDS is None:
     print('Can''t open shapefile ' + sites_shapefile)
     exit(1)
 
-# Create a PostGIS table to hold the sites data.
-qstr = """
-    DROP TABLE IF EXISTS {schema}.{layer};
-    CREATE TABLE {schema}.{layer} (
-      gid serial NOT NULL,
-      site_id integer,
-      cover character varying(48),
-      geom geometry({geomtype}, {srid}),
-      CONSTRAINT {layer}_pkey PRIMARY KEY (gid))
-    WITH (OIDS=FALSE);
-    """.format(schema=sites_schema, layer=sites_layername, geomtype='Point', srid=sites_srid)
-pgDS.ExecuteSQL(qstr)
-
-# Copy features from the sites shapefile to the PostGIS table.
-pgLayer = pgDS.GetLayerByName(sites_schema + '.' + sites_layername)
-pgFeatureDefn = pgLayer.GetLayerDefn()
-
-for feat in sitesDS.GetLayer():
-    pgFeature = ogr.Feature(pgFeatureDefn)
-    pgFeature.SetField('site_id', feat.GetField('id'))
-    pgFeature.SetField('cover', feat.GetField('cover'))
-    pgFeature.SetGeometry(feat.GetGeometryRef())
-
-    pgLayer.CreateFeature(pgFeature)
+conn = psycopg2.connect(pgdb.dsn('local'))
+
+# Skip the sites import when the shapefile has not changed since the last
+# complete load. The import is small, an interrupted one is loaded again.
+load_sites = True
+if USE_MANIFEST:
+    sitesManifest = manifest.Manifest(conn, sites_schema)
+    sites_key = str(sites_srid)
+    action, entry = sitesManifest.plan(
+        sites_layername,
+        tableload.staging_name(sites_layername) if STAGED_LOAD else sites_layername,
+        sites_shapefile, sites_key)
+    load_sites = action != manifest.SKIP
+
+if load_sites:
+
+    # Create a PostGIS table to hold the sites data.
+    if STAGED_LOAD:
+        sitesLoad = tableload.TableLoad(conn, sites_schema, sites_layername)
+        sitesLoad.create([
+            'gid serial NOT NULL',
+            'site_id integer',
+            'cover character varying(48)',
+            'geom geometry({geomtype}, {srid})'.format(geomtype='Point', srid=sites_srid)])
+        load_layername = sitesLoad.staging
+
+    else:
+        qstr = """
+            DROP TABLE IF EXISTS {schema}.{layer};
+            CREATE TABLE {schema}.{layer} (
+              gid serial NOT NULL,
+              site_id integer,
+              cover character varying(48),
+              geom geometry({geomtype}, {srid}),
+              CONSTRAINT {layer}_pkey PRIMARY KEY (gid))
+            WITH (OIDS=FALSE);
+            """.format(schema=sites_schema, layer=sites_layername, geomtype='Point', srid=sites_srid)
+        pgDS.ExecuteSQL(qstr)
+        load_layername = sites_layername
+
+    if USE_MANIFEST:
+        sitesManifest.begin(sites_layername, sites_shapefile, sites_key)
+
+    # Copy features from the sites shapefile to the PostGIS table.
+    pgLayer = pgDS.GetLayerByName(sites_schema + '.' + load_layername)
+    pgFeatureDefn = pgLayer.GetLayerDefn()
+
+    loadTime = time.time()
+    site_count = 0
+    for feat in sitesDS.GetLayer():
+        pgFeature = ogr.Feature(pgFeatureDefn)
+        pgFeature.SetField('site_id', feat.GetField('id'))
+        pgFeature.SetField('cover', feat.GetField('cover'))
+        pgFeature.SetGeometry(feat.GetGeometryRef())
+
+        pgLayer.CreateFeature(pgFeature)
+        site_count += 1
+    pgLayer = pgFeatureDefn = None
+
+    # Index, analyze and swap in the sites table.
+    if STAGED_LOAD:
+        sitesLoad.timings['load'] = time.time() - loadTime
+        sitesLoad.finish()
+        print('\nSites load: ' + sitesLoad.report())
+
+    if USE_MANIFEST:
+        sitesManifest.complete(sites_layername, site_count)
+
+else:
+    print('\nSites unchanged, not reloaded.')
 
 # Done with the shapefile.
 shpDriver = sitesDS = None
+conn.close()
 
 # Register the raster driver and open the data source.
 rastDriver = gdal.GetDriverByName('HFA')
@@ -107,41 +168,62 @@ for feat in pgLayer:
         'cover'   : feat.GetField('cover'),
         'dist_km' : feat.GetField('dist_km'),
         'bearing' : feat.GetField('bearing'),
-        'offset'  : utils.get_raster_offset(coords, geotransform),
         'data'    : [],
     })
 pgDS.ReleaseResultSet(pgLayer)
 
+# Pixel offsets for all the sites, using the full affine GeoTransform.
+xfm = utils.GeoTransform(geotransform)
+site_coords = np.array([site['coords'] for site in sites], dtype=np.float64).reshape(-1, 2)
+site_cols, site_rows = xfm.offsets(site_coords[:, 0], site_coords[:, 1])
+for site, offset in zip(sites, zip(site_cols.tolist(), site_rows.tolist())):
+    site['offset'] = offset
+
 startTime = time.time()
 
-READ_ENTIRE_BAND = False
+# How to read the pixel values:
+#   'pixel' - one ReadAsArray call per site per band
+#   'band'  - read each entire band into memory
+#   'block' - read each block holding a site once, see sampling.py
+READ_MODE = 'block'
 
-if READ_ENTIRE_BAND:
+if READ_MODE == 'band':
     print('\nReading entire band ...')
-else:
+elif READ_MODE == 'pixel':
     print('\nReading one pixel at a time ...')
+else:
+    print('\nReading blocks holding sites ...')
 
-for n in (1,2,3):
+if READ_MODE == 'block':
 
-    band = ds.GetRasterBand(n)
+    # Read the blocks holding sites for all three bands.
+    values = sampling.sample_offsets(ds, site_cols, site_rows, band_list=[1, 2, 3])
+    for site, data in zip(sites, values.tolist()):
+        site['data'] = data
 
-    if (READ_ENTIRE_BAND):
+else:
 
-        # Read entire band into an array.
-        data = band.ReadAsArray(0, 0, cols, rows)
-        for site in sites:
-            col, row = site['offset']
-            site['data'].append(data[row, col])
+    for n in (1,2,3):
 
-    else:
+        band = ds.GetRasterBand(n)
+
+        if READ_MODE == 'band':
+
+            # Read entire band into an array.
+            data = band.ReadAsArray(0, 0, cols, rows)
+            for site in sites:
+                col, row = site['offset']
+                site['data'].append(data[row, col])
+
+        else:
 
-        # Read one pixel at a time.
-        for site in sites:
-            xoff, yoff = site['offset']
-            data = band.ReadAsArray(xoff, yoff, 1, 1)
-            site['data'].append(data[0, 0])
+            # Read one pixel at a time.
+            for site in sites:
+                xoff, yoff = site['offset']
+                data = band.ReadAsArray(xoff, yoff, 1, 1)
+                site['data'].append(data[0, 0])
 
-    band = data = None
+        band = data = None
 
 
 print('\n<id>: <northing>, <easting>, <bearing> <distance>: <cover> = (<b1>, <b2>, <b3>).')
@@ -6,8 +6,9 @@
 
 import gdal
 from gdalconst import *
-import numpy as np
 import time
+import blockstats
+import histograms
 
 gdal.UseExceptions()
 
@@ -15,6 +16,18 @@ rasterfile = 'data/usu04/aster.img'
 # rasterfile = 'data/usu04/usgs-hoopa.tif'
 # rasterfile = 'data/usu04/naip-stapp.tif'
 
+# Worker pool size, None for one worker per CPU. Process pools re-import this
+# script in each worker on platforms that spawn, so threads are the default.
+WORKERS = None
+USE_PROCESSES = False
+
+# Exclude the band nodata value from the statistics.
+IGNORE_NODATA = False
+
+# Report percentiles and the 2%-98% stretch clip range, built from the same
+# block reads as the statistics.
+REPORT_PERCENTILES = True
+
 # Register the raster driver and open the data source.
 # rastDriver = gdal.GetDriverByName('HFA')
 gdal.AllRegister()
@@ -41,41 +54,48 @@ for n in range(1, bands+1):
 
 startTime = time.time()
 
-# Initialize arrays for the data and stats lists.
-data  = [None for n in range(bands+1)]
-stats = [None for n in range(bands+1)]
-for n in range(1, bands+1):
-    stats[n] = {'sum': 0.0, 'nonzero': 0}
-
-# Read all bands a block at a time.
-for yoff in range(0, rows, yblock):
-    for xoff in range(0, cols, xblock):
-
-        xsize = min(cols - xoff, xblock)
-        ysize = min(rows - yoff, yblock)
-
-        for n in range(1, bands+1):
-            band = ds.GetRasterBand(n)
-            data[n] = band.ReadAsArray(xoff, yoff, xsize, ysize)
+# Read all bands a block at a time. The block grid is split across a pool of
+# WORKERS threads (or processes) and the partial results are merged per band.
+# With percentiles each block feeds both the statistics and the histogram.
+summaries = blockstats.band_statistics(
+    rasterfile, workers=WORKERS, processes=USE_PROCESSES, ignore_nodata=IGNORE_NODATA,
+    accumulator=histograms.BandSummary if REPORT_PERCENTILES else blockstats.BandStats)
 
-        # One block from each band is loaded.
-        for n in range(1, bands+1):
-            stats[n]['sum'] += data[n].astype(np.float).sum()
-            stats[n]['nonzero'] += np.greater(data[n], 0).sum()
+if REPORT_PERCENTILES:
+    stats = {n: summary.stats for n, summary in summaries.items()}
+    sketches = {n: summary.sketch for n, summary in summaries.items()}
+else:
+    stats = summaries
 
-band = data = None
+# Two decimal places, n/a for a statistic a band without valid pixels lacks.
+def format_value(value):
+    return 'n/a' if value is None else '{0:.2f}'.format(value)
 
 pixel_count = rows * cols
 fmt = 'Band {0}: Sum={1:,.0f}  Pixels={2:,d}  NonZeroPixels={3:,d}  ' \
-    + 'Mean={4:.2f}  NonZeroMean={5:.2f}'
+    + 'Mean={4:.2f}  NonZeroMean={5}'
+fmt2 = '        Min={0}  Max={1}  StdDev={2}  NoDataPixels={3:,d}'
 
 print()
 for n in range(1, bands+1):
     print(fmt.format(
-        n, stats[n]['sum'], pixel_count, stats[n]['nonzero'],
-        stats[n]['sum'] / pixel_count,
-        stats[n]['sum'] / stats[n]['nonzero']
+        n, stats[n].sum, pixel_count, stats[n].nonzero,
+        stats[n].sum / pixel_count,
+        format_value(stats[n].sum / stats[n].nonzero if stats[n].nonzero else None)
     ))
+    print(fmt2.format(
+        'n/a' if stats[n].min is None else stats[n].min,
+        'n/a' if stats[n].max is None else stats[n].max,
+        format_value(stats[n].std), stats[n].nodata))
+
+if REPORT_PERCENTILES:
+    fmt = 'Band {0}: P1={1}  P25={2}  Median={3}  P75={4}  P99={5}  Clip(2%-98%)={6}-{7}'
+
+    print()
+    for n in range(1, bands+1):
+        percentiles = sketches[n].quantile([0.01, 0.25, 0.5, 0.75, 0.99]) or [None] * 5
+        values = percentiles + list(sketches[n].clip_range(2, 98))
+        print(fmt.format(n, *[format_value(value) for value in values]))
 
 endTime = time.time()
 print('\ntime: {0:.3f} sec'.format(endTime - startTime))
@@ -5,8 +5,9 @@
 import gdal
 from gdalconst import *
 import numpy as np
-import numpy.ma as ma
 import time
+import bandmath
+import blockwriter
 
 gdal.UseExceptions()
 
@@ -15,6 +16,7 @@ DST_RASTERFILE = 'data/usu04/aster-ndvi.img'
 
 DST_DATA_TYPE = np.float32
 NO_DATA_VALUE = -99
+OVERVIEW_LIST = [2, 4, 8, 16, 32, 64, 128]
 
 # Register the raster driver and open the source data.
 gdal.AllRegister()
@@ -53,88 +55,38 @@ dstDS = driver.Create(DST_RASTERFILE, cols, rows, 1, GDT_Float32)
 if dstDS is None:
     print('Can''t open destination raster file ' + DST_RASTERFILE)
     exit(1)
-dstBand = dstDS.GetRasterBand(1)
 
-startTime = time.time()
-
-# Initialize an array for the data.
-data  = [None for n in range(src_bands + 1)]
-
-valid_count = 0
-ndvi_sum = 0.0
-
-no_valid = some_valid = all_valid = 0
-
-# Read all bands a block at a time.
-for yoff in range(0, rows, yblock):
-    for xoff in range(0, cols, xblock):
-
-        xsize = min(cols - xoff, xblock)
-        ysize = min(rows - yoff, yblock)
-        block_size  = xsize * ysize
-
-        # Read blocks from bands 2 & 3.
-        for n in (2,3):
-            srcBand = srcDS.GetRasterBand(n)
-            data[n] = srcBand.ReadAsArray(xoff, yoff, xsize, ysize).astype(DST_DATA_TYPE)
-
-        nir = data[3]
-        red = data[2]
-
-        # NDVI denominator.
-        b = nir + red
-
-        # Mask for divide by zero.
-        mask = np.equal(b, 0)
-        masked = np.count_nonzero(mask)
-        unmasked = block_size - masked
-
-        # Calculate ndvi = (nir - red) / (nir + red)
-        if unmasked == 0:
-            # No valid data in this block.
-            ndvi = np.full((ysize, xsize), NO_DATA_VALUE)
-            no_valid += 1
-
-        elif masked > 0:
-            # Some valid data, use a masked array.
-            a = ma.array(nir-red, mask=mask, fill_value=NO_DATA_VALUE)
-            ndvi = a/b
-            valid_count += unmasked
-            ndvi_sum += ndvi.sum()
-            ndvi = ndvi.filled()
-            some_valid += 1
-
-        else:
-            # All data in the block is valid.
-            a = nir-red
-            ndvi = a/b
-            valid_count += block_size
-            ndvi_sum += ndvi.sum()
-            all_valid += 1
+# Statistics and overviews are computed as the blocks are written.
+dstDS.SetGeoTransform(geotransform)
+dstDS.SetProjection(projection)
+gdal.SetConfigOption('HFA_USE_RRD', 'YES')
+dstBand = blockwriter.BlockWriter(dstDS, 1, NO_DATA_VALUE, OVERVIEW_LIST)
 
-        dstBand.WriteArray(ndvi, xoff, yoff)
+startTime = time.time()
 
-srcBand = data = None
+# Calculate ndvi = (nir - red) / (nir + red) from bands 3 & 2 a block at a time.
+# Pixels where nir + red is zero are set to NO_DATA_VALUE.
+result = bandmath.band_math(
+    SRC_RASTERFILE, dstBand, bandmath.NDVI, {'red': 2, 'nir': 3}, NO_DATA_VALUE,
+    nodata_policy=bandmath.NODATA_IGNORE, work_type=DST_DATA_TYPE)
 
-# Finish up with the output raster.
-dstBand.SetNoDataValue(NO_DATA_VALUE)
-dstBand.FlushCache()
-dstBand.GetStatistics(0, 1)
+srcBand = None
 
-dstDS.SetGeoTransform(geotransform)
-dstDS.SetProjection(projection)
-gdal.SetConfigOption('HFA_USE_RRD', 'YES')
-dstDS.BuildOverviews(overviewlist=[2, 4, 8, 16, 32, 64, 128])
+# Finish up with the output raster, set the statistics and write the last
+# overview rows.
+dstBand.close()
+dstBand = None
 
 pixel_count = rows * cols
 
-print('\nValid blocks: NONE={0}  SOME={1}  ALL={2}'.format(no_valid, some_valid, all_valid))
+print('\nValid blocks: NONE={0}  SOME={1}  ALL={2}'.format(
+    result.no_valid, result.some_valid, result.all_valid))
 
 print('\nValid Pixels/Total Pixels: {0:,d}/{1:,d}  ({2:.0f}%)'.format(
-    valid_count, pixel_count, 100.0 * valid_count / pixel_count
+    result.valid_count, pixel_count, 100.0 * result.valid_count / pixel_count
 ))
 
-print('\nNDVI mean: {0:.3f}'.format(ndvi_sum / valid_count))
+print('\nNDVI mean: {0:.3f}'.format(result.mean))
 
 endTime = time.time()
 print('\ntime: {0:.3f} sec'.format(endTime - startTime))
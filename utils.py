@@ -1,15 +1,109 @@
-
 import gdal
+import numpy as np
+import os
 
 # Calculate x/y pixel offset from a coordinate (x,y) and GeoTransform.
 def get_raster_offset(coord, geoxfm):
-    xoff = int((coord[0] - geoxfm[0]) / geoxfm[1])
-    yoff = int((coord[1] - geoxfm[3]) / geoxfm[5])
-    return xoff, yoff
+    col, row = GeoTransform(geoxfm).offsets(coord[0], coord[1])
+    return int(col), int(row)
 
 # Calculate x/y pixel coordinate from an offset (x,y) and GeoTransform.
 def get_raster_coord(offset, geoxfm):
-    x = offset[0] * geoxfm[1] + geoxfm[0]
-    y = offset[1] * geoxfm[5] + geoxfm[3]
-    return x, y
+    x, y = GeoTransform(geoxfm).coords(offset[0], offset[1])
+    return float(x), float(y)
+
+# Six term affine GeoTransform and its precomputed inverse. Coordinates and
+# offsets may be scalars or numpy arrays of any shape. Pixel positions are
+# computed from coordinates relative to the origin, folding the origin into the
+# inverse loses precision to cancellation, and north up transforms divide by
+# the pixel size as get_raster_offset always has, so pixel edges land exactly.
+#
+#   x = g0 + col * g1 + row * g2
+#   y = g3 + col * g4 + row * g5
+class GeoTransform:
+
+    def __init__(self, geoxfm):
+        g0, g1, g2, g3, g4, g5 = [float(g) for g in geoxfm]
+        det = g1 * g5 - g2 * g4
+        if det == 0.0:
+            raise ValueError('GeoTransform is not invertible: ' + str(tuple(geoxfm)))
+
+        i1, i2 = g5 / det, -g2 / det
+        i4, i5 = -g4 / det, g1 / det
+
+        self.forward = (g0, g1, g2, g3, g4, g5)
+        self.inverse = (i1, i2, i4, i5)
+
+    # True when the raster is north up with no rotation terms.
+    @property
+    def north_up(self):
+        return self.forward[2] == 0.0 and self.forward[4] == 0.0
+
+    # Fractional pixel/line position of coordinates.
+    def pixels(self, x, y):
+        g0, g1, g2, g3, g4, g5 = self.forward
+        dx = np.asarray(x, dtype=np.float64) - g0
+        dy = np.asarray(y, dtype=np.float64) - g3
+        if self.north_up:
+            return dx / g1, dy / g5
+        i1, i2, i4, i5 = self.inverse
+        return i1 * dx + i2 * dy, i4 * dx + i5 * dy
+
+    # Integer pixel/line offsets of the pixels holding coordinates.
+    def offsets(self, x, y):
+        col, row = self.pixels(x, y)
+        return np.floor(col).astype(np.int64), np.floor(row).astype(np.int64)
+
+    # Coordinates of pixel/line offsets, the top-left pixel corner or the center.
+    def coords(self, col, row, center=False):
+        g0, g1, g2, g3, g4, g5 = self.forward
+        col = np.asarray(col, dtype=np.float64)
+        row = np.asarray(row, dtype=np.float64)
+        if center:
+            col, row = col + 0.5, row + 0.5
+        return g0 + col * g1 + row * g2, g3 + col * g4 + row * g5
+
+    # Pixel window (xoff, yoff, xsize, ysize) covering a bounding box
+    # (xmin, ymin, xmax, ymax) clipped to the raster size (cols, rows). When
+    # block_size (xblock, yblock) is given the window is expanded to whole blocks.
+    # Returns None when the box misses the raster.
+    def window(self, bbox, raster_size, block_size=None):
+        xmin, ymin, xmax, ymax = bbox
+        col, row = self.pixels([xmin, xmax, xmin, xmax], [ymin, ymin, ymax, ymax])
+
+        cols, rows = raster_size
+        xoff = max(int(np.floor(col.min())), 0)
+        yoff = max(int(np.floor(row.min())), 0)
+        xend = min(int(np.ceil(col.max())), cols)
+        yend = min(int(np.ceil(row.max())), rows)
+
+        if block_size is not None:
+            xblock, yblock = block_size
+            xoff, yoff = (xoff // xblock) * xblock, (yoff // yblock) * yblock
+            xend = min(-(-xend // xblock) * xblock, cols)
+            yend = min(-(-yend // yblock) * yblock, rows)
+
+        if xend <= xoff or yend <= yoff:
+            return None
+        return xoff, yoff, xend - xoff, yend - yoff
+
+# Generate (xoff, yoff, xsize, ysize) windows covering a raster one block at a time.
+def block_windows(cols, rows, xblock, yblock):
+    for yoff in range(0, rows, yblock):
+        for xoff in range(0, cols, xblock):
+            yield xoff, yoff, min(cols - xoff, xblock), min(rows - yoff, yblock)
+
+# Default worker count for a thread or process pool.
+def worker_count(workers=None):
+    return workers if workers else (os.cpu_count() or 1)
 
+# Split a list into n contiguous runs of nearly equal length.
+def split_runs(items, n):
+    n = max(1, min(n, len(items)))
+    size, extra = divmod(len(items), n)
+    runs, start = [], 0
+    for i in range(n):
+        end = start + size + (1 if i < extra else 0)
+        runs.append(items[start:end])
+        start = end
+    return runs
@@ -0,0 +1,235 @@
+# Zonal statistics over PostGIS polygons.
+#
+# Aggregate raster band values per polygon zone. Zones come from a query run on
+# the same OGR 'PG:' connection the scripts use, and each zone's bounding box is
+# turned into a block-aligned pixel window. Only blocks touched by some zone are
+# read, each once. For every zone crossing a block a mask of the pixels whose
+# centers fall inside the zone is rasterized for that block, unless the zone
+# contains the whole block. The blocks are split into runs handled by a thread
+# pool, and a zone's statistics are yielded as soon as all of its blocks are
+# done, so results can be streamed to a table while later zones are still being
+# processed.
+#
+# Zone geometry must be in the raster's coordinate system, transform it in the
+# query if needed:
+#
+#   zones = zonalstats.read_zones(pgDS, '''
+#       SELECT gid, ST_Transform(geom, 32612) AS geom FROM usu.zones''', 'gid')
+#   results = zonalstats.zonal_statistics(rasterfile, zones)
+#   zonalstats.write_zone_table(pgDS, 'usu', 'zone_stats', results, [1])
+
+import gdal
+import ogr
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+
+import blockstats
+import utils
+
+# Block runs queued per worker.
+TASKS_PER_WORKER = 4
+
+# Rows inserted per transaction by write_zone_table.
+INSERT_BATCH_SIZE = 1000
+
+
+# Read zones from a query. Returns a list of (zone_id, wkb, envelope) where
+# envelope is OGR's (minx, maxx, miny, maxy).
+def read_zones(pgDS, sql, id_field):
+    zones = []
+    layer = pgDS.ExecuteSQL(sql)
+    for feat in layer:
+        geom = feat.GetGeometryRef()
+        if geom is None or geom.IsEmpty():
+            continue
+        zones.append((feat.GetField(id_field), geom.ExportToWkb(), geom.GetEnvelope()))
+    pgDS.ReleaseResultSet(layer)
+    return zones
+
+
+# Blocks touched by each zone. Returns a dict of (xoff, yoff, xsize, ysize)
+# block window: [zone index], in block order.
+def zone_blocks(zones, xfm, raster_size, block_size):
+    cols, rows = raster_size
+    xblock, yblock = block_size
+    blocks = defaultdict(list)
+    for i, (zone_id, wkb, (minx, maxx, miny, maxy)) in enumerate(zones):
+        window = xfm.window((minx, miny, maxx, maxy), raster_size, block_size)
+        if window is None:
+            continue
+        xoff, yoff, xsize, ysize = window
+        for by in range(yoff, yoff + ysize, yblock):
+            for bx in range(xoff, xoff + xsize, xblock):
+                blocks[(bx, by, min(xblock, cols - bx), min(yblock, rows - by))].append(i)
+    return dict(sorted(blocks.items(), key=lambda item: (item[0][1], item[0][0])))
+
+
+# Mask of the block pixels with centers inside a zone, or None when the zone
+# contains the whole block.
+def _zone_mask(geom, window, xfm, memDriver):
+    xoff, yoff, xsize, ysize = window
+    x, y = xfm.coords([xoff, xoff + xsize, xoff + xsize, xoff, xoff],
+                      [yoff, yoff, yoff + ysize, yoff + ysize, yoff])
+    ring = ogr.Geometry(ogr.wkbLinearRing)
+    for px, py in zip(x.tolist(), y.tolist()):
+        ring.AddPoint_2D(px, py)
+    block_geom = ogr.Geometry(ogr.wkbPolygon)
+    block_geom.AddGeometry(ring)
+    if geom.Contains(block_geom):
+        return None
+
+    g0, g1, g2, g3, g4, g5 = xfm.forward
+    maskDS = memDriver.Create('', xsize, ysize, 1, gdal.GDT_Byte)
+    maskDS.SetGeoTransform((
+        g0 + xoff * g1 + yoff * g2, g1, g2, g3 + xoff * g4 + yoff * g5, g4, g5))
+
+    vectorDS = ogr.GetDriverByName('Memory').CreateDataSource('')
+    layer = vectorDS.CreateLayer('zone', geom_type=geom.GetGeometryType())
+    feat = ogr.Feature(layer.GetLayerDefn())
+    feat.SetGeometry(geom)
+    layer.CreateFeature(feat)
+
+    gdal.RasterizeLayer(maskDS, [1], layer, burn_values=[1])
+    mask = maskDS.GetRasterBand(1).ReadAsArray().astype(bool)
+    maskDS = vectorDS = None
+    return mask
+
+
+# Pool task: accumulate zone statistics for a run of blocks. Returns a dict of
+# zone index: [BandStats per band].
+def _zone_task(rasterfile, band_list, nodata_values, blocks, zone_wkbs):
+    ds = gdal.Open(rasterfile, gdal.GA_ReadOnly)
+    if ds is None:
+        raise IOError("Can't open raster data file " + rasterfile)
+
+    xfm = utils.GeoTransform(ds.GetGeoTransform())
+    memDriver = gdal.GetDriverByName('MEM')
+    bands = [ds.GetRasterBand(n) for n in band_list]
+    geoms = {i: ogr.CreateGeometryFromWkb(wkb) for i, wkb in zone_wkbs.items()}
+
+    partials = {}
+    for window, zone_indexes in blocks:
+        data = [band.ReadAsArray(*window) for band in bands]
+        for i in zone_indexes:
+            mask = _zone_mask(geoms[i], window, xfm, memDriver)
+            if mask is not None and not mask.any():
+                continue
+            stats = partials.setdefault(i, [blockstats.BandStats() for n in band_list])
+            for band_stats, block, nodata_value in zip(stats, data, nodata_values):
+                band_stats.update(block if mask is None else block[mask], nodata_value)
+
+    bands = ds = None
+    return partials
+
+
+# Calculate zonal statistics for zones from read_zones. Yields (zone_id,
+# [BandStats per band]) as each zone completes. Zones that cover no pixel
+# centers are yielded with empty statistics.
+#
+#   band_list     - band numbers to process, default [1]
+#   workers       - pool size, default is the number of CPUs
+#   processes     - use a process pool instead of a thread pool
+#   ignore_nodata - exclude each band's nodata value from the statistics
+def zonal_statistics(rasterfile, zones, band_list=None, workers=None, processes=False,
+                     ignore_nodata=True):
+    if band_list is None:
+        band_list = [1]
+
+    ds = gdal.Open(rasterfile, gdal.GA_ReadOnly)
+    if ds is None:
+        raise IOError("Can't open raster data file " + rasterfile)
+
+    xfm = utils.GeoTransform(ds.GetGeoTransform())
+    raster_size = (ds.RasterXSize, ds.RasterYSize)
+    block_size = ds.GetRasterBand(band_list[0]).GetBlockSize()
+    nodata_values = [
+        ds.GetRasterBand(n).GetNoDataValue() if ignore_nodata else None for n in band_list]
+    ds = None
+
+    blocks = list(zone_blocks(zones, xfm, raster_size, block_size).items())
+
+    # Blocks still to be processed for each zone.
+    pending = defaultdict(int)
+    for window, zone_indexes in blocks:
+        for i in zone_indexes:
+            pending[i] += 1
+
+    results = {}
+
+    def finish(i):
+        stats = results.pop(i, None) or [blockstats.BandStats() for n in band_list]
+        return zones[i][0], stats
+
+    # Zones that miss the raster are done before any block is read.
+    for i in range(len(zones)):
+        if i not in pending:
+            yield finish(i)
+
+    workers = utils.worker_count(workers)
+    Executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with Executor(max_workers=workers) as executor:
+        futures = {}
+        for run in utils.split_runs(blocks, workers * TASKS_PER_WORKER):
+            zone_wkbs = {i: zones[i][1] for window, zone_indexes in run for i in zone_indexes}
+            future = executor.submit(
+                _zone_task, rasterfile, band_list, nodata_values, run, zone_wkbs)
+            futures[future] = run
+
+        for future in as_completed(futures):
+            for i, partial in future.result().items():
+                if i in results:
+                    for total, part in zip(results[i], partial):
+                        total.merge(part)
+                else:
+                    results[i] = partial
+
+            for window, zone_indexes in futures[future]:
+                for i in zone_indexes:
+                    pending[i] -= 1
+                    if pending[i] == 0:
+                        yield finish(i)
+
+
+# Write zonal statistics to a PostGIS table, replacing it. Rows are inserted in
+# transactions of INSERT_BATCH_SIZE as results arrive. Returns the row count.
+def write_zone_table(pgDS, schema, table, results, band_list, id_type='integer'):
+    columns = []
+    for n in band_list:
+        columns += [
+            'b{0}_count bigint'.format(n), 'b{0}_sum double precision'.format(n),
+            'b{0}_mean double precision'.format(n), 'b{0}_min double precision'.format(n),
+            'b{0}_max double precision'.format(n)]
+
+    qstr = """
+    DROP TABLE IF EXISTS {schema}.{table};
+    CREATE TABLE {schema}.{table} (
+      zone_id {id_type} NOT NULL,
+      {columns},
+      CONSTRAINT {table}_pkey PRIMARY KEY (zone_id))
+    WITH (OIDS=FALSE);
+    """.format(schema=schema, table=table, id_type=id_type, columns=',\n      '.join(columns))
+    pgDS.ExecuteSQL(qstr)
+
+    layer = pgDS.GetLayerByName(schema + '.' + table)
+    featureDefn = layer.GetLayerDefn()
+
+    count = 0
+    layer.StartTransaction()
+    for zone_id, stats in results:
+        feat = ogr.Feature(featureDefn)
+        feat.SetField('zone_id', zone_id)
+        for n, band_stats in zip(band_list, stats):
+            feat.SetField('b{0}_count'.format(n), band_stats.valid)
+            if band_stats.valid:
+                feat.SetField('b{0}_sum'.format(n), float(band_stats.sum))
+                feat.SetField('b{0}_mean'.format(n), float(band_stats.mean))
+                feat.SetField('b{0}_min'.format(n), float(band_stats.min))
+                feat.SetField('b{0}_max'.format(n), float(band_stats.max))
+        layer.CreateFeature(feat)
+
+        count += 1
+        if count % INSERT_BATCH_SIZE == 0:
+            layer.CommitTransaction()
+            layer.StartTransaction()
+    layer.CommitTransaction()
+    return count